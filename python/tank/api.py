@@ -15,6 +15,7 @@ Classes for the main Sgtk API.
 import os
 import glob
 import threading
+import weakref
 
 from tank_vendor import yaml
 
@@ -58,6 +59,8 @@ class Tank(object):
 
         # execute a tank_init hook for developers to use.
         self.execute_core_hook(platform_constants.TANK_INIT_HOOK_NAME)
+        
+        _register_live_instance(self)
 
     def __repr__(self):
         return "<Sgtk Core %s@0x%08x Config %s>" % (self.version, id(self), self.__pipeline_config.get_path())
@@ -469,6 +472,24 @@ class Tank(object):
 
         return paths
 
+    def paths_from_entities(self, entities):
+        """
+        Finds paths associated with a list of entities. This is a lot 
+        quicker than calling paths_from_entity() for each entity.
+
+        :param entities: List of (entity_type, entity_id) tuples
+
+        :returns: Matching file paths for each entity, keyed by (entity_type, entity_id)
+        :rtype: Dictionary of lists of strings.
+        """
+
+        # Use the path cache to look up all paths associated with these entities
+        path_cache = PathCache(self)
+        paths = path_cache.get_paths_many(entities, primary_only=True)
+        path_cache.close()
+
+        return paths
+
     def entity_from_path(self, path):
         """
         Returns the shotgun entity associated with a path
@@ -520,6 +541,31 @@ class Tank(object):
         """
         return context.from_entity(self, entity_type, entity_id)
 
+    def contexts_from_paths(self, paths, previous_context=None):
+        """
+        Derive contexts from a list of paths. This is a lot quicker than 
+        calling context_from_path() for each path.
+
+        :param paths: list of file system paths
+        :param previous_context: a context object to use to try to automatically extend the generated
+                                 contexts, see context_from_path()
+        :returns: Context objects, keyed by path
+        :rtype: Dictionary of Context objects.
+        """
+        return context.from_paths(self, paths, previous_context)
+
+    def contexts_from_entities(self, entities):
+        """
+        Derives contexts from a list of Shotgun entities. This is a lot quicker 
+        than calling context_from_entity() for each entity.
+
+        :param entities: List of (entity_type, entity_id) tuples
+
+        :returns: Context objects, keyed by (entity_type, entity_id)
+        :rtype: Dictionary of Context objects.
+        """
+        return context.from_entities(self, entities)
+
     def synchronize_filesystem_structure(self, full_sync=False):
         """
         Ensures that the filesystem structure on this machine is in sync
@@ -609,6 +655,46 @@ def tank_from_entity(entity_type, entity_id):
     pc = pipelineconfig_factory.from_entity(entity_type, entity_id)
     return Tank(pc)
 
+# the most recently created Sgtk API instance for each pipeline configuration,
+# keyed by normalized pipeline configuration path
+_live_instances = weakref.WeakValueDictionary()
+_live_instances_lock = threading.Lock()
+
+def get_live_instance(pipeline_config_path):
+    """
+    Returns an Sgtk API instance for a pipeline configuration which is already
+    in use in this process. 
+    
+    :param pipeline_config_path: Path to the pipeline configuration
+    :returns: Sgtk API instance or None if there is no instance for the 
+              pipeline configuration.
+    """
+    _live_instances_lock.acquire()
+    try:
+        return _live_instances.get(_get_live_instance_key(pipeline_config_path))
+    finally:
+        _live_instances_lock.release()
+
+def _register_live_instance(tk):
+    """
+    Records an Sgtk API instance so that it can be found via get_live_instance().
+    Instances are only held for as long as they are in use elsewhere.
+    
+    :param tk: Sgtk API instance
+    """
+    _live_instances_lock.acquire()
+    try:
+        _live_instances[_get_live_instance_key(tk.pipeline_configuration.get_path())] = tk
+    finally:
+        _live_instances_lock.release()
+
+def _get_live_instance_key(pipeline_config_path):
+    """
+    Returns the key used for a pipeline configuration path in the registry 
+    of live Sgtk API instances.
+    """
+    return os.path.normcase(os.path.normpath(pipeline_config_path))
+
 ##########################################################################################
 # sgtk API aliases
 
@@ -16,16 +16,31 @@ Management of the current context, e.g. the current shotgun entity/step/task.
 import os
 import pickle
 import copy
+import itertools
+import threading
+import time
+import weakref
 
 from tank_vendor import yaml
 
+# use api json to cover py 2.5
+from tank_vendor import shotgun_api3  
+json = shotgun_api3.shotgun.json
+
 from .util import login
 from .util import shotgun_entity
 from .util import shotgun
 from .errors import TankError
-from .path_cache import PathCache
+from .path_cache import PathCache, add_change_listener, check_for_changes, _LookupCache
 from .template import TemplatePath
 
+# version of the JSON format written by serialize()
+SERIALIZATION_VERSION = 1
+
+# max number of ids to request in a single shotgun query when looking
+# up records in bulk
+SG_MAX_IDS_PER_QUERY = 500
+
 
 class Context(object):
     """
@@ -50,6 +65,9 @@ class Context(object):
         Instead, use the factory methods.
         """
         self.__tk = tk
+        # pipeline configuration to create the api instance for on first access, 
+        # see _bind_lazily()
+        self.__pipeline_config_path = None
         self.__project = project
         self.__entity = entity
         self.__step = step
@@ -57,6 +75,10 @@ class Context(object):
         self.__user = user
         self.__additional_entities = additional_entities or []
         self._entity_fields_cache = {}
+        # see _get_identity_key()
+        self.__identity_key = None
+        # results of as_template_fields(), keyed by template
+        self._template_fields_cache = {}
 
     def __repr__(self):
         # multi line repr
@@ -87,7 +109,7 @@ class Context(object):
             # e.g. Shot ABC_123
             
             # resolve custom entities to their real display
-            entity_display_name = shotgun.get_entity_type_display_name(self.__tk, 
+            entity_display_name = shotgun.get_entity_type_display_name(self.tank, 
                                                                        self.entity.get("type"))
             
             ctx_name = "%s %s" % (entity_display_name, self.entity.get("name"))
@@ -103,7 +125,7 @@ class Context(object):
             # e.g. Lighting, Shot ABC_123
             
             # resolve custom entities to their real display
-            entity_display_name = shotgun.get_entity_type_display_name(self.__tk, 
+            entity_display_name = shotgun.get_entity_type_display_name(self.tank, 
                                                                        self.entity.get("type"))
             
             ctx_name = "%s, %s %s" % (task_step, 
@@ -120,63 +142,28 @@ class Context(object):
         :returns:       True if self represents the same context as other, 
                         otherwise False
         """
-        def _entity_dicts_eq(d1, d2):
-            """
-            Test to see if two entity dictionaries are equal.  They are considered
-            equal if both are dictionaries containing 'type' and 'id' with the same
-            values for both keys, For example:
-            
-            Comparing these two dictionaries would return True:
-            - {"type":"Shot", "id":123, "foo":"foo"}
-            - {"type":"Shot", "id":123, "foo":"bar", "bar":"foo"}
-            
-            But comparing these two dictionaries would return False:
-            - {"type":"Shot", "id":123, "foo":"foo"}
-            - {"type":"Shot", "id":567, "foo":"foo"} 
-    
-            :param d1:  First entity dictionary
-            :param d2:  Second entity dictionary
-            :returns:   True if d1 and d2 are considered equal, otherwise False.
-            """
-            if d1 == d2 == None:
-                return True
-            if d1 == None or d2 == None:
-                return False
-            return d1["type"] == d2["type"] and d1["id"] == d2["id"]        
-        
         if not isinstance(other, Context):
             return NotImplemented
 
-        if not _entity_dicts_eq(self.project, other.project):
-            return False
-        
-        if not _entity_dicts_eq(self.entity, other.entity):
-            return False
-        
-        if not _entity_dicts_eq(self.step, other.step):
-            return False
-        
-        if not _entity_dicts_eq(self.task, other.task):
+        if self._get_identity_key() != other._get_identity_key():
             return False
         
-        # compare additional entities
-        if self.additional_entities and other.additional_entities:
-            # compare type, id tuples of all additional entities to ensure they are exactly the same.
-            # this compare ignores duplicates in either list and just ensures that the intersection
-            # of both lists contains all unique elements from both lists. 
-            types_and_ids = set([(e["type"], e["id"]) for e in self.additional_entities if e])
-            other_types_and_ids = set([(e["type"], e["id"]) for e in other.additional_entities if e])
-            if types_and_ids != other_types_and_ids:
-                return False
-        elif self.additional_entities or other.additional_entities:
-            return False
-
         # finally compare the user - this may result in a Shotgun look-up 
         # so do this last!
-        if not _entity_dicts_eq(self.user, other.user):
-            return False
+        return _entity_identity_key(self.user) == _entity_identity_key(other.user)
+
+    def __hash__(self):
+        """
+        Returns a hash for this Context instance, so that contexts can be 
+        used in sets and as dictionary keys. Contexts which are equal have
+        the same hash.
+        
+        Note that the user is left out of the hash as looking it up may 
+        result in a Shotgun look-up.
         
-        return True 
+        :returns: integer hash
+        """
+        return hash(self._get_identity_key())
 
     def __ne__(self, other):
         """
@@ -197,6 +184,7 @@ class Context(object):
         """
         # construct copy with current api instance:
         ctx_copy = Context(self.__tk)
+        ctx_copy.__pipeline_config_path = self.__pipeline_config_path
         
         # deepcopy all other members:
         ctx_copy.__project = copy.deepcopy(self.__project, memo)
@@ -277,7 +265,7 @@ class Context(object):
         # so make sure we get rid of those. We should make sure we return the data
         # in a consistent way, similar to all other entities. No more. No less.
         if self.__user is None:
-            user = login.get_current_user(self.__tk)
+            user = login.get_current_user(self.tank)
             if user is not None:
                 self.__user = {"type": user.get("type"), 
                                "id": user.get("id"), 
@@ -304,7 +292,7 @@ class Context(object):
         if self.entity is None:
             return []
 
-        paths = self.__tk.paths_from_entity(self.entity["type"], self.entity["id"])
+        paths = self.tank.paths_from_entity(self.entity["type"], self.entity["id"])
 
         return paths
 
@@ -319,16 +307,16 @@ class Context(object):
         # walk up task -> entity -> project -> site
         
         if self.task is not None:
-            return "%s/detail/%s/%d" % (self.__tk.shotgun.base_url, "Task", self.task["id"])            
+            return "%s/detail/%s/%d" % (self.tank.shotgun.base_url, "Task", self.task["id"])            
         
         if self.entity is not None:
-            return "%s/detail/%s/%d" % (self.__tk.shotgun.base_url, self.entity["type"], self.entity["id"])            
+            return "%s/detail/%s/%d" % (self.tank.shotgun.base_url, self.entity["type"], self.entity["id"])            
 
         if self.project is not None:
-            return "%s/detail/%s/%d" % (self.__tk.shotgun.base_url, "Project", self.project["id"])            
+            return "%s/detail/%s/%d" % (self.tank.shotgun.base_url, "Project", self.project["id"])            
         
         # fall back on just the site main url
-        return self.__tk.shotgun.base_url
+        return self.tank.shotgun.base_url
         
     @property
     def filesystem_locations(self):
@@ -342,18 +330,19 @@ class Context(object):
         
         # first handle special cases: project context
         if self.entity is None:
-            return self.__tk.paths_from_entity("Project", self.project["id"])
+            return self.tank.paths_from_entity("Project", self.project["id"])
             
         # at this stage we know that the context contains an entity
         # start off with all the paths matching this entity and then cull it down 
         # based on constraints.
-        entity_paths = self.__tk.paths_from_entity(self.entity["type"], self.entity["id"])
+        entity_paths = self.tank.paths_from_entity(self.entity["type"], self.entity["id"])
                 
-        # for each of these paths, get the context and compare it against our context
-        # todo: optimize this!
+        # for each of these paths, get the context and compare it against our context.
+        # The contexts for all paths are resolved in a single path cache pass.
+        path_contexts = self.tank.contexts_from_paths(entity_paths)
         matching_paths = []
         for p in entity_paths:
-            ctx = self.__tk.context_from_path(p)
+            ctx = path_contexts[p]
             # the stuff we need to compare against are all the "child" levels
             # below entity: task and user
             matching = False
@@ -387,6 +376,9 @@ class Context(object):
         """
         An Sgtk API instance
         """
+        if self.__tk is None and self.__pipeline_config_path is not None:
+            self.__tk = _get_tank_instance(self.__pipeline_config_path)
+            self.__pipeline_config_path = None
         return self.__tk
 
     ################################################################################################
@@ -414,6 +406,18 @@ class Context(object):
         :returns: Dictionary of template files representing the context.
                   Handy to pass in to the various Sgtk API methods
         """
+        return self.as_template_fields_many([template])[template]
+
+    def as_template_fields_many(self, templates):
+        """
+        Returns the context object as template fields for a list of templates.
+        This is equivalent to calling as_template_fields() for each template, 
+        but the values of keys coming from Shotgun are fetched in one go.
+        
+        :param templates: List of templates for which the fields will be used.
+        
+        :returns: Dictionary of template fields for each template, keyed by template
+        """
         # Get all entities into a dictionary
         entities = {}
 
@@ -434,39 +438,84 @@ class Context(object):
             if add_entity["type"] not in entities:
                 entities[add_entity["type"]] = add_entity
 
-        fields = {}
+        template_fields = {}
+        
+        # templates which are not in the cache of results from previous calls
+        templates_to_resolve = []
+        
+        # the cached results are valid until the path cache changes. Changes made 
+        # by other processes need to be looked for in the db. This is also done 
+        # before anything is cached, so that the state the results are based on 
+        # is recorded.
+        path_cache_file = self.tank.pipeline_configuration.get_path_cache_location()
+        if path_cache_file is not None:
+            check_for_changes(path_cache_file)
+        generation = _path_cache_generation
+        for template in templates:
+            cached = self._template_fields_cache.get(template)
+            if cached and cached[0] == generation:
+                template_fields[template] = cached[1].copy()
+            elif template not in templates_to_resolve:
+                templates_to_resolve.append(template)
+        
+        if not templates_to_resolve:
+            return template_fields
+        
+        # the locations and paths of the context entities are shared by all templates
+        entity_locations = None
+        entity_paths = None
         
-        # Try to populate fields using paths caches for entity
-        if isinstance(template, TemplatePath):
+        # results of validating paths against templates, shared by all templates 
+        # so that the templates higher up in the tree are only validated once
+        validation_cache = {}
+        
+        for template in templates_to_resolve:
             
-            # first, sanity check that we actually have a path cache entry
-            # this relates to ticket 22541 where it is possible to create 
-            # a context object purely from Shotgun without having it in the path cache
-            # (using tk.context_from_entity(Task, 1234) for example)
-            #
-            # Such a context can result in erronous lookups in the later commands
-            # since these make the assumption that the path cache contains the information
-            # that is being saught after.
-            # 
-            # therefore, if the context object contains an entity object and this entity is
-            # not represented in the path cache, raise an exception.
-            if self.entity and len(self.entity_locations) == 0:
-                # context has an entity associated but no path cache entries
-                raise TankError("Cannot resolve template data for context '%s' - this context "
-                                "does not have any associated folders created on disk yet and "
-                                "therefore no template data can be extracted. Please run the folder "
-                                "creation for %s and try again!" % (self, self.shotgun_url))
+            fields = {}
             
-            # first look at which ENTITY paths are associated with this context object
-            # and use these to extract the right fields for this template
-            fields = self._fields_from_entity_paths(template)
+            # Try to populate fields using paths caches for entity
+            if isinstance(template, TemplatePath):
+                
+                if entity_locations is None:
+                    entity_locations = self.entity_locations
+                    entity_paths = self._get_entity_paths(entities)
+                
+                # first, sanity check that we actually have a path cache entry
+                # this relates to ticket 22541 where it is possible to create 
+                # a context object purely from Shotgun without having it in the path cache
+                # (using tk.context_from_entity(Task, 1234) for example)
+                #
+                # Such a context can result in erronous lookups in the later commands
+                # since these make the assumption that the path cache contains the information
+                # that is being saught after.
+                # 
+                # therefore, if the context object contains an entity object and this entity is
+                # not represented in the path cache, raise an exception.
+                if self.entity and len(entity_locations) == 0:
+                    # context has an entity associated but no path cache entries
+                    raise TankError("Cannot resolve template data for context '%s' - this context "
+                                    "does not have any associated folders created on disk yet and "
+                                    "therefore no template data can be extracted. Please run the folder "
+                                    "creation for %s and try again!" % (self, self.shotgun_url))
+                
+                # first look at which ENTITY paths are associated with this context object
+                # and use these to extract the right fields for this template
+                fields = self._fields_from_entity_paths(template, entity_locations, validation_cache)
+                
+                # Determine field values by walking down the template tree
+                fields.update(self._fields_from_template_tree(template, fields, entities, 
+                                                              entity_paths, validation_cache))
             
-            # Determine field values by walking down the template tree
-            fields.update(self._fields_from_template_tree(template, fields, entities))
+            template_fields[template] = fields
 
-        # get values for shotgun query keys in template
-        fields.update(self._fields_from_shotgun(template, entities))
-        return fields
+        # get values for shotgun query keys in templates
+        for (template, fields) in self._fields_from_shotgun(templates_to_resolve, entities).iteritems():
+            template_fields[template].update(fields)
+        
+        for template in templates_to_resolve:
+            self._template_fields_cache[template] = (generation, template_fields[template].copy())
+        
+        return template_fields
 
     def create_copy_for_user(self, user):
         """
@@ -484,17 +533,76 @@ class Context(object):
     ################################################################################################
     # private methods
 
-    def _fields_from_shotgun(self, template, entities):
+    def _get_identity_key(self):
         """
-        Query Shotgun server for keys used by this template whose values come directly
-        from Shotgun fields.
+        Returns a key identifying this context, made up of the type and id of
+        the project, entity, step, task and additional entities. Two contexts 
+        are equal if they have the same key and the same user. 
+        
+        Other fields in the entity dictionaries are ignored, as are duplicates 
+        in the additional entities, so these two entities are considered equal:
+        
+        - {"type":"Shot", "id":123, "foo":"foo"}
+        - {"type":"Shot", "id":123, "foo":"bar", "bar":"foo"}
+        
+        The key is only worked out once per context.
+        
+        :returns: tuple
         """
-        fields = {}
-        # for any sg query field
-        for key in template.keys.values():
+        if self.__identity_key is None:
+            additional_entities = None
+            if self.__additional_entities:
+                additional_entities = frozenset([ (e["type"], e["id"]) for e in self.__additional_entities if e ])
+            
+            self.__identity_key = (_entity_identity_key(self.__project),
+                                   _entity_identity_key(self.__entity),
+                                   _entity_identity_key(self.__step),
+                                   _entity_identity_key(self.__task),
+                                   additional_entities)
+        return self.__identity_key
+
+    def _bind_lazily(self, pipeline_config_path):
+        """
+        Makes the context create its Sgtk API instance on first access, 
+        rather than up front. This is used when deserializing contexts.
+        
+        :param pipeline_config_path: Path to the pipeline configuration 
+                                     to create the instance for
+        """
+        self.__pipeline_config_path = pipeline_config_path
+
+    def _fields_from_shotgun(self, templates, entities):
+        """
+        Query Shotgun server for keys used by a list of templates whose values come 
+        directly from Shotgun fields. All fields needed from an entity are fetched 
+        in a single query. 
+        
+        Values are cached on the context, and for a limited time, in a cache shared 
+        by all contexts using the same Sgtk API instance.
+        
+        :param templates: List of templates
+        :param entities: Dictionary of the context entities, keyed by entity type
+        :returns: Dictionary of fields for each template, keyed by template
+        """
+        sg_field_cache = _get_sg_field_cache(self.tank)
+        
+        # the keys to resolve for each template
+        template_keys = {}
+        
+        # shotgun fields to fetch for each entity type, with the first 
+        # key and template they were needed for
+        fields_to_fetch = {}
+        
+        for template in templates:
+            template_keys[template] = []
             
-            # check each key to see if it has shotgun query information that we should resolve
-            if key.shotgun_field_name:
+            # for any sg query field
+            for key in template.keys.values():
+                
+                # check each key to see if it has shotgun query information that we should resolve
+                if not key.shotgun_field_name:
+                    continue
+                
                 # this key is a shotgun value that needs fetching! 
                 
                 # ensure that the context actually provides the desired entities
@@ -502,75 +610,120 @@ class Context(object):
                     raise TankError("Key '%s' in template '%s' could not be populated by "
                                     "context '%s' because the context does not contain a "
                                     "shotgun entity of type '%s'!" % (key, template, self, key.shotgun_entity_type))
-                    
+                
+                template_keys[template].append(key)
+                
                 entity = entities[key.shotgun_entity_type]
                 
                 # check the context cache 
                 cache_key = (entity["type"], entity["id"], key.shotgun_field_name)
                 if cache_key in self._entity_fields_cache:
-                    # already have the value cached - no need to fetch from shotgun
-                    fields[key.name] = self._entity_fields_cache[cache_key]
+                    continue
+                
+                # and the cache shared with other contexts
+                (found, value) = sg_field_cache.get(cache_key)
+                if found:
+                    self._entity_fields_cache[cache_key] = value
+                    continue
+                
+                if key.shotgun_entity_type not in fields_to_fetch:
+                    fields_to_fetch[key.shotgun_entity_type] = (key, template, set())
+                fields_to_fetch[key.shotgun_entity_type][2].add(key.shotgun_field_name)
+        
+        for (entity_type, (key, template, query_fields)) in fields_to_fetch.iteritems():
+            
+            entity = entities[entity_type]
+            
+            # get the values from shotgun
+            filters = [["id", "is", entity["id"]]]
+            result = self.tank.shotgun.find_one(entity_type, filters, list(query_fields))
+            if not result:
+                # no record with that id in shotgun!
+                raise TankError("Could not retrieve Shotgun data for key '%s' in "
+                                "template '%s'. No records in Shotgun are matching "
+                                "entity '%s' (Which is part of the current "
+                                "context '%s')" % (key, template, entity, self))                        
+            
+            for field_name in query_fields:
+                value = result.get(field_name)
+
+                # note! It is perfectly possible (and may be valid) to return None values from 
+                # shotgun at this point. In these cases, a None field will be returned in the 
+                # fields dictionary from as_template_fields, and this may be injected into
+                # a template with optional fields.
+
+                if value is None:
+                    processed_val = None
                 
                 else:
-                    # get the value from shotgun
-                    filters = [["id", "is", entity["id"]]]
-                    query_fields = [key.shotgun_field_name]
-                    result = self.__tk.shotgun.find_one(key.shotgun_entity_type, filters, query_fields)
-                    if not result:
-                        # no record with that id in shotgun!
-                        raise TankError("Could not retrieve Shotgun data for key '%s' in "
-                                        "template '%s'. No records in Shotgun are matching "
-                                        "entity '%s' (Which is part of the current "
-                                        "context '%s')" % (key, template, entity, self))                        
-
-                    value = result.get(key.shotgun_field_name)
-
-                    # note! It is perfectly possible (and may be valid) to return None values from 
-                    # shotgun at this point. In these cases, a None field will be returned in the 
-                    # fields dictionary from as_template_fields, and this may be injected into
-                    # a template with optional fields.
-    
-                    if value is None:
-                        processed_val = None
-                    
-                    else:
-
-                        # now convert the shotgun value to a string.
-                        # note! This means that there is no way currently to create an int key
-                        # in a tank template which matches an int field in shotgun, since we are
-                        # force converting everything into strings...
-                                 
-                        processed_val = shotgun_entity.sg_entity_to_string(self.__tk,
-                                                                           key.shotgun_entity_type,
-                                                                           entity.get("id"),
-                                                                           key.shotgun_field_name, 
-                                                                           value)
-                    
-                        if not key.validate(processed_val):                    
-                            raise TankError("Template validation failed for value '%s'. This "
-                                            "value was retrieved from entity %s in Shotgun to "
-                                            "represent key '%s' in "
-                                            "template '%s'." % (processed_val, entity, key, template))
-                            
-                    # all good!
-                    # populate dictionary and cache
-                    fields[key.name] = processed_val
-                    self._entity_fields_cache[cache_key] = processed_val
 
+                    # now convert the shotgun value to a string.
+                    # note! This means that there is no way currently to create an int key
+                    # in a tank template which matches an int field in shotgun, since we are
+                    # force converting everything into strings...
+                             
+                    processed_val = shotgun_entity.sg_entity_to_string(self.tank,
+                                                                       entity_type,
+                                                                       entity.get("id"),
+                                                                       field_name, 
+                                                                       value)
+                
+                # populate caches
+                cache_key = (entity_type, entity["id"], field_name)
+                self._entity_fields_cache[cache_key] = processed_val
+                sg_field_cache.set(cache_key, processed_val)
+        
+        template_fields = {}
+        for template in templates:
+            fields = {}
+            for key in template_keys[template]:
+                entity = entities[key.shotgun_entity_type]
+                processed_val = self._entity_fields_cache[(entity["type"], entity["id"], key.shotgun_field_name)]
+                
+                if processed_val is not None and not key.validate(processed_val):
+                    raise TankError("Template validation failed for value '%s'. This "
+                                    "value was retrieved from entity %s in Shotgun to "
+                                    "represent key '%s' in "
+                                    "template '%s'." % (processed_val, entity, key, template))
+                
+                # all good!
+                fields[key.name] = processed_val
+            
+            template_fields[template] = fields
 
-        return fields
+        return template_fields
 
 
-    def _fields_from_entity_paths(self, template):
+    def _get_entity_paths(self, entities):
+        """
+        Looks up the primary paths for the context entities in the path cache.
+        
+        :param entities: Dictionary of the context entities, keyed by entity type
+        :returns: Dictionary keyed by (entity_type, entity_id), holding a list 
+                  of paths for each entity
+        """
+        path_cache = PathCache(self.tank)
+        try:
+            return path_cache.get_paths_many([(x["type"], x["id"]) for x in entities.values()], 
+                                             primary_only=True)
+        finally:
+            path_cache.close()
+
+    def _fields_from_entity_paths(self, template, path_cache_locations, validation_cache):
         """
         Determines template's key values based on context by walking up the context entities paths until
         matches for the template are found.
+        
+        :param template: Template to find values for
+        :param path_cache_locations: The locations on disk for the context entity
+        :param validation_cache: Dictionary of previous validation results, see _validate_and_get_fields()
         """
         fields = {}
-        project_roots = self.__tk.pipeline_configuration.get_data_roots().values()
+        project_roots = self.tank.pipeline_configuration.get_data_roots().values()
 
-        # get all locations on disk for our context object from the path cache
-        path_cache_locations = self.entity_locations 
+        # use the same template instance as the template ancestors so that 
+        # validation results are shared with templates further down the tree
+        template = _get_template_ancestors(template)[-1]
         
         # now loop over all those locations and check if one of the locations 
         # are matching the template that is passed in. In that case, try to
@@ -579,8 +732,8 @@ class Context(object):
             
             # walk up path until we reach the project root and get values
             while cur_path not in project_roots:
-                if template.validate(cur_path):
-                    cur_fields = template.get_fields(cur_path)
+                cur_fields = _validate_and_get_fields(template, cur_path, None, validation_cache)
+                if cur_fields is not None:
                     # If there are conflicts, there is ambiguity in the schema
                     for key, value in cur_fields.items():
                         if value != fields.get(key, value):
@@ -593,10 +746,16 @@ class Context(object):
                     
         return fields
 
-    def _fields_from_template_tree(self, template, fields, entities):
+    def _fields_from_template_tree(self, template, fields, entities, entity_paths, validation_cache):
         """
         Determines values for a template's keys based on the context by walking down the template tree
         matching template keys with entity types.
+        
+        :param template: Template to find values for
+        :param fields: Fields found so far for the template
+        :param entities: Dictionary of the context entities, keyed by entity type
+        :param entity_paths: The primary paths for the context entities, as returned by _get_entity_paths()
+        :param validation_cache: Dictionary of previous validation results, see _validate_and_get_fields()
         """
         
         # Step 1 - Cull out ambigious templates
@@ -620,43 +779,221 @@ class Context(object):
         #  <Sgtk TemplatePath maya_shot_publish: sequences/{Sequence}/{Shot}/{Step}/publish/maya/{name}.v{version}.ma>]
         templates = _get_template_ancestors(template)
 
-        # get a path cache handle
-        path_cache = PathCache(self.__tk)
-
         # Step 3 - walk templates from the root down,
         # for each template, get all paths we have stored in the database
         # and find any fields we can for it
-        try:
-            # build up a list of fields as we go so that each level matches
-            # at least the fields from the previous level
-            found_fields = {}
-
-            for cur_template in templates:
-                for key in cur_template.keys.values():
-                    # If we don't already have a value, look for it
-                    if fields.get(key.name) is not None:
-                        # already have value so skip:
-                        found_fields[key.name] = fields[key.name]
-                        continue
-                    
-                    # only care about entities as this is what we'll look for in the path cache:
-                    entity = entities.get(key.name)
-                    if entity:
-                        # context contains an entity for this Shotgun entity type!
-                        temp_fields = _values_from_path_cache(entity, cur_template, path_cache, 
-                                                              required_fields=found_fields)
-                        # make sure the next iteration finds the same fields: 
-                        found_fields.update(temp_fields)
-            
-            # update the list of fields with all the ones we found:
-            fields.update(found_fields)
-
-        finally:    
-            path_cache.close()
+        
+        # build up a list of fields as we go so that each level matches
+        # at least the fields from the previous level
+        found_fields = {}
+
+        for cur_template in templates:
+            for key in cur_template.keys.values():
+                # If we don't already have a value, look for it
+                if fields.get(key.name) is not None:
+                    # already have value so skip:
+                    found_fields[key.name] = fields[key.name]
+                    continue
+                
+                # only care about entities as this is what we'll look for in the path cache:
+                entity = entities.get(key.name)
+                if entity:
+                    # context contains an entity for this Shotgun entity type!
+                    temp_fields = _values_from_path_cache(entity, 
+                                                          cur_template, 
+                                                          entity_paths[(entity["type"], entity["id"])], 
+                                                          required_fields=found_fields,
+                                                          validation_cache=validation_cache)
+                    # make sure the next iteration finds the same fields: 
+                    found_fields.update(temp_fields)
+        
+        # update the list of fields with all the ones we found:
+        fields.update(found_fields)
         
         return fields
 
 
+################################################################################################
+# process wide cache of the entities found in the folders leading up to a path
+
+# environment variable which can be used to turn on the entity chain cache used by
+# from_path(). The value is the maximum number of folders to hold.
+ENTITY_CHAIN_CACHE_SIZE_ENV_VAR = "TANK_CONTEXT_CACHE_SIZE"
+
+# entity chain cache, keyed by (pipeline configuration path, folder)
+_entity_chain_cache = None
+_entity_chain_cache_lock = threading.Lock()
+
+# max number of folders in the entity chain cache. 0 means that the cache is turned off.
+_entity_chain_cache_size = None
+
+# incremented whenever a path cache changes, see _on_path_cache_change(). The 
+# template fields cached by contexts are only valid for the generation they were found in.
+_path_cache_generation = 0
+
+def set_entity_chain_cache_size(max_items):
+    """
+    Sets the max number of folders for which from_path() keeps the entities
+    found in the path cache in memory. Files share the cached entities of their
+    folder. Setting this to zero turns the cache off and releases all cached 
+    data. This overrides any value set via the environment.
+    
+    The cache is cleared whenever a path cache changes. Each call to from_path()
+    checks the path cache db for changes made by other processes first.
+    
+    :param max_items: Max number of folders to cache
+    """
+    global _entity_chain_cache, _entity_chain_cache_size
+    _entity_chain_cache_lock.acquire()
+    try:
+        _entity_chain_cache_size = max(int(max_items), 0)
+        if _entity_chain_cache_size == 0:
+            _entity_chain_cache = None
+        elif _entity_chain_cache is not None:
+            _entity_chain_cache.resize(_entity_chain_cache_size)
+    finally:
+        _entity_chain_cache_lock.release()
+
+def get_entity_chain_cache_stats():
+    """
+    Returns usage statistics for the entity chain cache used by from_path().
+    
+    :returns: dictionary with keys hits, misses, evictions, size and max_size
+              or None if the cache is turned off.
+    """
+    entity_chain_cache = _get_entity_chain_cache()
+    if entity_chain_cache is None:
+        return None
+    return entity_chain_cache.get_stats()
+
+def _get_entity_chain_cache():
+    """
+    Returns the entity chain cache.
+    
+    :returns: _LookupCache instance or None if the cache is turned off
+    """
+    global _entity_chain_cache, _entity_chain_cache_size
+    _entity_chain_cache_lock.acquire()
+    try:
+        if _entity_chain_cache_size is None:
+            # not set via the API - check the environment
+            try:
+                _entity_chain_cache_size = max(int(os.environ.get(ENTITY_CHAIN_CACHE_SIZE_ENV_VAR, 0)), 0)
+            except ValueError:
+                _entity_chain_cache_size = 0
+        
+        if _entity_chain_cache_size == 0:
+            return None
+        
+        if _entity_chain_cache is None:
+            _entity_chain_cache = _LookupCache(_entity_chain_cache_size)
+        return _entity_chain_cache
+    finally:
+        _entity_chain_cache_lock.release()
+
+def _on_path_cache_change(path_cache_file):
+    """
+    Clears the entity chain cache and the template fields cached by contexts 
+    when this process has changed a path cache or has detected changes made 
+    by other processes.
+    
+    :param path_cache_file: Path to the path cache db file which was changed
+    """
+    global _path_cache_generation
+    _path_cache_generation += 1
+    
+    entity_chain_cache = _entity_chain_cache
+    if entity_chain_cache is not None:
+        entity_chain_cache.invalidate()
+
+add_change_listener(_on_path_cache_change)
+
+
+################################################################################################
+# shotgun field values shared by all contexts using the same api instance
+
+# number of seconds for which shotgun field values fetched by one context 
+# are reused by other contexts
+SG_FIELD_CACHE_TTL = 60
+
+# shotgun field caches, keyed by api instance
+_sg_field_caches = weakref.WeakKeyDictionary()
+_sg_field_caches_lock = threading.Lock()
+
+def _get_sg_field_cache(tk):
+    """
+    Returns the shotgun field cache for an api instance.
+    
+    :param tk: Sgtk API instance
+    :returns: _ShotgunFieldCache instance
+    """
+    _sg_field_caches_lock.acquire()
+    try:
+        if tk not in _sg_field_caches:
+            _sg_field_caches[tk] = _ShotgunFieldCache(SG_FIELD_CACHE_TTL)
+        return _sg_field_caches[tk]
+    finally:
+        _sg_field_caches_lock.release()
+
+
+class _ShotgunFieldCache(object):
+    """
+    Store of shotgun field values used to populate template keys, keyed by 
+    (entity type, entity id, field name). Values expire after a fixed time 
+    so that changes made in Shotgun are picked up.
+    """
+    
+    def __init__(self, ttl):
+        """
+        Constructor
+        
+        :param ttl: Number of seconds for which values are kept
+        """
+        self._ttl = ttl
+        self._items = {}
+        self._next_purge = time.time() + ttl
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """
+        Returns a cached value.
+        
+        :param key: Lookup key
+        :returns: (found, value) tuple
+        """
+        self._lock.acquire()
+        try:
+            item = self._items.get(key)
+            if item is None:
+                return (False, None)
+            if item[0] < time.time():
+                del self._items[key]
+                return (False, None)
+            return (True, item[1])
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value):
+        """
+        Stores a value.
+        
+        :param key: Lookup key
+        :param value: Value to store
+        """
+        self._lock.acquire()
+        try:
+            now = time.time()
+            if now > self._next_purge:
+                # drop expired items every now and then so that the cache doesn't keep growing
+                for (item_key, item) in self._items.items():
+                    if item[0] < now:
+                        del self._items[item_key]
+                self._next_purge = now + self._ttl
+            self._items[key] = (now + self._ttl, value)
+        finally:
+            self._lock.release()
+
+
 ################################################################################################
 # factory methods for constructing new Context objects, primarily called from the Tank object
 
@@ -682,67 +1019,140 @@ def from_entity(tk, entity_type, entity_id):
 
     :returns: a context object
     """
+    return from_entities(tk, [(entity_type, entity_id)])[(entity_type, entity_id)]
+
+def from_entities(tk, entities):
+    """
+    Constructs contexts for a list of shotgun entities. This is equivalent to 
+    calling from_entity() for each entity, but Shotgun and the path cache are 
+    queried in bulk.
     
-    if entity_type is None:
-        raise TankError("Cannot create a context from an entity type 'None'!")
+    :param tk:       Sgtk API handle
+    :param entities: List of (entity_type, entity_id) tuples
     
-    if entity_id is None:
-        raise TankError("Cannot create a context from an entity id set to 'None'!")
+    :returns: Dictionary of context objects, keyed by (entity_type, entity_id)
+    """
+    for (entity_type, entity_id) in entities:
+        if entity_type is None:
+            raise TankError("Cannot create a context from an entity type 'None'!")
+        
+        if entity_id is None:
+            raise TankError("Cannot create a context from an entity id set to 'None'!")
     
-    # prep our return data structure
-    context = {
-        "tk": tk,
-        "project": None,
-        "entity": None,
-        "step": None,
-        "user": None,
-        "task": None,
-        "additional_entities": []
-    }
-
-    if entity_type == "Task":
-        # For tasks get data from shotgun query
-        task_context = _task_from_sg(tk, entity_id)
-        context.update(task_context)
-
-    elif entity_type in ["PublishedFile", "TankPublishedFile"]:
+    # context data for each entity, keyed by (entity_type, entity_id)
+    context_data = {}
+    
+    ids_by_type = {}
+    for (entity_type, entity_id) in entities:
+        ids_by_type.setdefault(entity_type, set()).add(entity_id)
+    
+    # published files are based on the task, entity or project they are linked with.
+    # Resolve these links first so that the linked entities are looked up together 
+    # with the other entities. Keyed by (entity_type, entity_id) of the published file.
+    published_file_links = {}
+    
+    for entity_type in ["PublishedFile", "TankPublishedFile"]:
         
-        sg_entity = tk.shotgun.find_one(entity_type, 
-                                        [["id", "is", entity_id]], 
-                                        ["project", "entity", "task"])
+        entity_ids = ids_by_type.pop(entity_type, None)
+        if not entity_ids:
+            continue
         
-        if sg_entity is None:
-            raise TankError("Entity %s with id %s not found in Shotgun!" % (entity_type, entity_id))
+        sg_entities = _find_by_ids(tk, entity_type, entity_ids, ["project", "entity", "task"])
         
-        if sg_entity.get("task"):
-            # base the context on the task for the published file
-            return from_entity(tk, "Task", sg_entity["task"]["id"])
+        for entity_id in entity_ids:
+            sg_entity = sg_entities.get(entity_id)
+            if sg_entity is None:
+                raise TankError("Entity %s with id %s not found in Shotgun!" % (entity_type, entity_id))
+            
+            if sg_entity.get("task"):
+                # base the context on the task for the published file
+                link = ("Task", sg_entity["task"]["id"])
+            
+            elif sg_entity.get("entity"):
+                # base the context on the entity that the published is linked with
+                link = (sg_entity["entity"]["type"], sg_entity["entity"]["id"])
+            
+            elif sg_entity.get("project"):
+                # base the context on the project that the published is linked with
+                link = ("Project", sg_entity["project"]["id"])
+            
+            else:
+                link = None
+                context_data[(entity_type, entity_id)] = {}
+            
+            published_file_links[(entity_type, entity_id)] = link
+    
+    # links to other published files are resolved separately
+    resolved_contexts = {}
+    published_file_targets = [ x for x in set(published_file_links.values()) 
+                               if x is not None and x[0] in ["PublishedFile", "TankPublishedFile"] ]
+    if published_file_targets:
+        resolved_contexts = from_entities(tk, published_file_targets)
+    
+    for link in published_file_links.values():
+        if link is not None and link not in resolved_contexts:
+            ids_by_type.setdefault(link[0], set()).add(link[1])
+    
+    for (entity_type, entity_ids) in ids_by_type.iteritems():
         
-        elif sg_entity.get("entity"):
-            # base the context on the entity that the published is linked with
-            return from_entity(tk, sg_entity["entity"]["type"], sg_entity["entity"]["id"])
+        if entity_type == "Task":
+            # ask hook for extra Task entity fields we should query and insert into the additional_entities list.
+            additional_fields = tk.execute_core_hook("context_additional_entities").get("entity_fields_on_task", [])
+            
+            task_ids = entity_ids
+            if not additional_fields and tk.pipeline_configuration.get_path_cache_contexts_enabled():
+                # use the task folders in the path cache where possible. Extra
+                # task fields can only be found in shotgun. 
+                for (task_id, task_context) in _tasks_from_cache(tk, task_ids).iteritems():
+                    context_data[("Task", task_id)] = task_context
+                task_ids = [ x for x in task_ids if ("Task", x) not in context_data ]
+            
+            if task_ids:
+                # For tasks get data from shotgun query
+                for (task_id, task_context) in _tasks_from_sg(tk, task_ids, additional_fields).iteritems():
+                    context_data[("Task", task_id)] = task_context
         
-        elif sg_entity.get("project"):
-            # base the context on the project that the published is linked with
-            return from_entity(tk, "Project", sg_entity["project"]["id"])
+        else:
+            # Get data from path cache
+            keys = [ (entity_type, entity_id) for entity_id in entity_ids ]
+            for (key, entity_context) in _context_data_from_cache(tk, keys).iteritems():
+                
+                # make sure this was actually found in the cache
+                # fall back on a shotgun lookup if not found
+                if entity_context["project"] is None:
+                    entity_context = _entity_from_sg(tk, key[0], key[1])
+                
+                context_data[key] = entity_context
     
-    else:
-        # Get data from path cache
-        entity_context = _context_data_from_cache(tk, entity_type, entity_id)
-                    
-        # make sure this was actually found in the cache
-        # fall back on a shotgun lookup if not found
-        if entity_context["project"] is None:
-            entity_context = _entity_from_sg(tk, entity_type, entity_id)
-        
+    for (key, entity_context) in context_data.iteritems():
+        # prep our return data structure
+        context = {
+            "tk": tk,
+            "project": None,
+            "entity": None,
+            "step": None,
+            "user": None,
+            "task": None,
+            "additional_entities": []
+        }
         context.update(entity_context)
-
-    if entity_type == "Project":
-        # no need to set entity to point at project in this case
-        # that only produces double entries.
-        context["entity"] = None
-
-    return Context(**context)
+        
+        if key[0] == "Project":
+            # no need to set entity to point at project in this case
+            # that only produces double entries.
+            context["entity"] = None
+        
+        resolved_contexts[key] = Context(**context)
+    
+    contexts = {}
+    for key in entities:
+        link = published_file_links.get(key)
+        if link is None:
+            contexts[key] = resolved_contexts[key]
+        else:
+            contexts[key] = resolved_contexts[link]
+    
+    return contexts
 
 def from_path(tk, path, previous_context=None):
     """
@@ -761,41 +1171,125 @@ def from_path(tk, path, previous_context=None):
                              path passed in via the path argument.
     :returns: a context object
     """
+    return from_paths(tk, [path], previous_context)[path]
 
-    # prep our return data structure
-    context = {
-        "tk": tk,
-        "project": None,
-        "entity": None,
-        "step": None,
-        "user": None,
-        "task": None,
-        "additional_entities": []
-    }
-
+def from_paths(tk, paths, previous_context=None):
+    """
+    Constructs contexts for a list of paths to folders or files. This is equivalent
+    to calling from_path() for each path, but the path cache is queried in bulk for
+    all the folders leading up to the paths.
+    
+    :param tk:    Sgtk API handle
+    :param paths: list of file system paths
+    :param previous_context: a context object to use to try to automatically extend the 
+                             generated contexts, see from_path()
+    :returns: Dictionary of context objects, keyed by path
+    """
     # ask hook for extra entity types we should recognize and insert into the additional_entities list.
     additional_types = tk.execute_core_hook("context_additional_entities").get("entity_types_in_path", [])
 
-    # get a cache handle
-    path_cache = PathCache(tk)
-
     # gather all roots as lower case
     project_roots = [x.lower() for x in tk.pipeline_configuration.get_data_roots().values()]
+    
+    path_cache = PathCache(tk)
+    try:
+        return _from_paths(tk, path_cache, paths, additional_types, project_roots, previous_context)
+    finally:
+        path_cache.close()
+
+def _from_paths(tk, path_cache, paths, additional_types, project_roots, previous_context):
+    """
+    Constructs contexts for a list of paths, see from_paths().
+    
+    :param tk:    Sgtk API handle
+    :param path_cache: PathCache instance to look up the entities in
+    :param paths: list of file system paths
+    :param additional_types: Entity types to add to the additional entities of the contexts
+    :param project_roots: Lower case project root paths
+    :param previous_context: a context object to use to try to automatically extend the 
+                             generated contexts
+    :returns: Dictionary of context objects, keyed by path
+    """
+    entity_chain_cache = _get_entity_chain_cache()
+    if entity_chain_cache is not None:
+        # drop the cached entities if another process has changed the path cache
+        path_cache.check_for_changes()
+        generation = entity_chain_cache.generation
+        pc_path = tk.pipeline_configuration.get_path()
+    
+    # the folder to start looking for entities at for each path. Files are never 
+    # registered in the path cache, so for cached lookups, files start at their 
+    # parent folder and share its entities.
+    start_folders = {}
+    for path in paths:
+        if entity_chain_cache is None:
+            start_folders[path] = path
+        elif os.path.isfile(path):
+            start_folders[path] = os.path.abspath(os.path.join(path, ".."))
+        else:
+            start_folders[path] = os.path.normpath(path)
+    
+    # primary and secondary entities found in the folders leading 
+    # up to each start folder, keyed by start folder
+    entity_chains = {}
+    
+    # the folders to look at for each start folder, from the start folder up to its project root
+    path_chains = {}
+    for folder in set(start_folders.values()):
+        if entity_chain_cache is not None:
+            (found, entity_chain) = entity_chain_cache.get((pc_path, folder))
+            if found:
+                entity_chains[folder] = entity_chain
+                continue
+        path_chains[folder] = _get_path_chain(folder, project_roots)
+    
+    if path_chains:
+        # look up the entities for all the folders in one go
+        folder_entities = path_cache.get_entities_many(set(itertools.chain(*path_chains.values())))
+    
+    for (folder, path_chain) in path_chains.iteritems():
+        # first gather entities
+        entities = []
+        secondary_entities = []
+        for curr_path in path_chain:
+            (curr_entity, curr_secondary_entities) = folder_entities[curr_path]
+            if curr_entity:
+                # Don't worry about entity types we've already got in the context. In the future
+                # we should look for entity ids that conflict in order to flag a degenerate schema.
+                entities.append(curr_entity)
+            
+            # add secondary entities
+            secondary_entities.extend(curr_secondary_entities)
+        
+        entity_chains[folder] = (entities, secondary_entities)
+        if entity_chain_cache is not None:
+            entity_chain_cache.set((pc_path, folder), (entities, secondary_entities), generation)
+    
+    contexts = {}
+    for (path, folder) in start_folders.iteritems():
+        (entities, secondary_entities) = entity_chains[folder]
+        contexts[path] = _context_from_path_entities(tk, 
+                                                     [x.copy() for x in entities], 
+                                                     [x.copy() for x in secondary_entities], 
+                                                     additional_types, 
+                                                     previous_context)
+    
+    return contexts
 
-    # first gather entities
-    entities = []
-    secondary_entities = []
+def _get_path_chain(path, project_roots):
+    """
+    Returns a path and all its parent folders, up to the project root
+    containing it, or up to the disk root if the path is outside the project.
+    
+    :param path: a file system path
+    :param project_roots: list of project roots, in lower case
+    :returns: list of paths, starting with the given path
+    """
+    path_chain = []
     curr_path = path
     while True:
-        curr_entity = path_cache.get_entity(curr_path)
-        if curr_entity:
-            # Don't worry about entity types we've already got in the context. In the future
-            # we should look for entity ids that conflict in order to flag a degenerate schema.
-            entities.append(curr_entity)
+        path_chain.append(curr_path)
         
-        # add secondary entities
-        secondary_entities.extend( path_cache.get_secondary_entities(curr_path) )
-
         if curr_path.lower() in project_roots:
             #TODO this could fail with windows path variations
             # we have reached a root!
@@ -809,8 +1303,31 @@ def from_path(tk, path, previous_context=None):
             break
         else:
             curr_path = parent_path
+    
+    return path_chain
 
-    path_cache.close()
+def _context_from_path_entities(tk, entities, secondary_entities, additional_types, previous_context):
+    """
+    Constructs a context from the entities found in the folders leading up to a path.
+    
+    :param tk:                 Sgtk API handle
+    :param entities:           list of primary entities, starting with the deepest folder
+    :param secondary_entities: list of secondary entities, starting with the deepest folder
+    :param additional_types:   entity types to treat as additional entities
+    :param previous_context:   a context object to use to try to automatically extend 
+                               the generated context, see from_path()
+    :returns: a context object
+    """
+    # prep our return data structure
+    context = {
+        "tk": tk,
+        "project": None,
+        "entity": None,
+        "step": None,
+        "user": None,
+        "task": None,
+        "additional_entities": []
+    }
 
     # now populate the context
     # go from the root down, so that in the case there are a path with
@@ -886,9 +1403,14 @@ def from_path(tk, path, previous_context=None):
 ################################################################################################
 # serialization
 
-def serialize(context):
+def serialize(context, use_json=False):
     """
     Serializes the context into a string
+    
+    :param context: Context object to serialize
+    :param use_json: Write compact, versioned JSON rather than a pickle. Strings
+                     written in this format can't be read by older versions of Toolkit.
+    :returns: Serialized context
     """
     data = {
         "project": context.project,
@@ -899,30 +1421,85 @@ def serialize(context):
         "additional_entities": context.additional_entities,
         "_pc_path": context.tank.pipeline_configuration.get_path()
     }
-    return pickle.dumps(data)
+    if not use_json:
+        return pickle.dumps(data)
+    
+    data["_version"] = SERIALIZATION_VERSION
+    return json.dumps(data, separators=(",", ":"))
     
     
 def deserialize(context_str):
     """
-    Deserializaes a string created with serialize() into a context object
+    Deserializaes a string created with serialize() into a context object.
+    Both the pickle and the JSON format are supported.
+    """
+    if context_str.lstrip().startswith("{"):
+        data = _str_from_unicode(json.loads(context_str))
+        
+        version = data.pop("_version", None)
+        if version != SERIALIZATION_VERSION:
+            raise TankError("Cannot deserialize a context written in format version %s. This version "
+                            "of Toolkit only supports version %s." % (version, SERIALIZATION_VERSION))
+    else:
+        data = pickle.loads(context_str)
+
+    return _from_serialized_data(data)
+
+
+def _from_serialized_data(data):
+    """
+    Creates a context from the data written when serializing it. If the pipeline
+    configuration is already in use in this process, its Sgtk API instance is 
+    used. Otherwise, an instance is created when first needed.
+    
+    :param data: Dictionary with the Context() constructor parameters, except for
+                 tk, and the pipeline configuration path in the _pc_path key. 
+    :returns: a context object
     """
     # lazy load this to avoid cyclic dependencies
-    from .api import Tank
+    from .api import get_live_instance
     
-    data = pickle.loads(context_str)
-
     # first get the pc path out of the dict
-    pipeline_config_path = data["_pc_path"] 
-    del data["_pc_path"]
+    pipeline_config_path = data.pop("_pc_path")
     
-    # create a Sgtk API instance.
-    tk = Tank(pipeline_config_path)
+    tk = get_live_instance(pipeline_config_path)
+    
+    # and lastly make the obejct
+    context = Context(tk, **data)
+    if tk is None:
+        context._bind_lazily(pipeline_config_path)
+    return context
 
-    # add it to the constructor instance
-    data["tk"] = tk
 
-    # and lastly make the obejct
-    return Context(**data)
+def _get_tank_instance(pipeline_config_path):
+    """
+    Returns an Sgtk API instance for a pipeline configuration, reusing an 
+    instance already in use in this process if possible.
+    
+    :param pipeline_config_path: Path to the pipeline configuration
+    :returns: Sgtk API instance
+    """
+    # lazy load this to avoid cyclic dependencies
+    from .api import Tank, get_live_instance
+    
+    return get_live_instance(pipeline_config_path) or Tank(pipeline_config_path)
+
+
+def _str_from_unicode(value):
+    """
+    Converts all unicode strings in json data to utf-8 encoded strings,
+    the way the Shotgun API returns them.
+    
+    :param value: Data returned by json.loads()
+    :returns: Data with str instead of unicode strings
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, list):
+        return [ _str_from_unicode(x) for x in value ]
+    elif isinstance(value, dict):
+        return dict([ (_str_from_unicode(k), _str_from_unicode(v)) for (k, v) in value.iteritems() ])
+    return value
     
 
 
@@ -959,24 +1536,10 @@ def context_yaml_constructor(loader, node):
     Custom deserializer.
     Constructs a context object given the yaml data provided.
     """
-    # lazy load this to avoid cyclic dependencies
-    from .api import Tank
-    
     # get the dict from yaml
     context_constructor_dict = loader.construct_mapping(node)
     
-    # first get the pc path out of the dict
-    pipeline_config_path = context_constructor_dict["_pc_path"] 
-    del context_constructor_dict["_pc_path"]
-    
-    # create a Sgtk API instance.
-    tk = Tank(pipeline_config_path)
-
-    # add it to the constructor instance
-    context_constructor_dict["tk"] = tk
-
-    # and lastly make the obejct
-    return Context(**context_constructor_dict)
+    return _from_serialized_data(context_constructor_dict)
 
 yaml.add_representer(Context, context_yaml_representer)
 yaml.add_constructor(u'!TankContext', context_yaml_constructor)
@@ -984,20 +1547,63 @@ yaml.add_constructor(u'!TankContext', context_yaml_constructor)
 ################################################################################################
 # utility methods
 
+def _entity_identity_key(entity):
+    """
+    Returns the (type, id) tuple identifying an entity dictionary, 
+    or None if the entity is None.
+    """
+    if entity is None:
+        return None
+    return (entity["type"], entity["id"])
+
+def _find_by_ids(tk, entity_type, entity_ids, fields):
+    """
+    Fetches shotgun records for a list of ids. The ids are requested 
+    in chunks, so that the filters stay within reasonable limits.
+    
+    :param tk:          a Sgtk API instance
+    :param entity_type: The shotgun entity type to query
+    :param entity_ids:  The shotgun entity ids to query
+    :param fields:      List of fields to return
+    :returns:           Dictionary of shotgun records, keyed by id. Records which 
+                        could not be found are omitted.
+    """
+    entity_ids = list(entity_ids)
+    records = {}
+    for idx in xrange(0, len(entity_ids), SG_MAX_IDS_PER_QUERY):
+        chunk = entity_ids[idx:idx+SG_MAX_IDS_PER_QUERY]
+        for sg_entity in tk.shotgun.find(entity_type, [["id", "in", chunk]], fields):
+            records[sg_entity["id"]] = sg_entity
+    return records
+
 def _task_from_sg(tk, task_id):
     """
     Constructs a context from a shotgun task.
     Because we are constructing the context from a task, we will get a context
     which has both a project, an entity a step and a task associated with it.
 
-    Manne 9 April 2013: could we use the path cache primarily and fall back onto
-                        a shotgun lookup? 
+    Note that from_entity() can use the path cache primarily and fall back onto 
+    a shotgun lookup, see _tasks_from_cache().
 
     :param tk:           a Sgtk API instance
     :param task_id:      The shotgun task id to produce a context for.
     """
-    context = {}
+    # ask hook for extra Task entity fields we should query and insert into the additional_entities list.
+    additional_fields = tk.execute_core_hook("context_additional_entities").get("entity_fields_on_task", [])
+    
+    return _tasks_from_sg(tk, [task_id], additional_fields)[task_id]
 
+def _tasks_from_sg(tk, task_ids, additional_fields):
+    """
+    Constructs context data for a list of shotgun tasks, see _task_from_sg().
+    All tasks are fetched from Shotgun in bulk.
+    
+    :param tk:                a Sgtk API instance
+    :param task_ids:          The shotgun task ids to produce context data for.
+    :param additional_fields: Extra Task entity fields to insert into the additional_entities list,
+                              as returned by the context_additional_entities hook.
+    :returns:                 Dictionary of context data, keyed by task id
+    """
     # Look up task's step and entity. This information should be static in practice, so we could
     # likely cache it in the future.
 
@@ -1005,39 +1611,78 @@ def _task_from_sg(tk, task_id):
     # theses keys map directly to linked entities, users will be handled separately
     context_keys = ["project", "entity", "step", "task"]
 
-    # ask hook for extra Task entity fields we should query and insert into the additional_entities list.
-    additional_fields = tk.execute_core_hook("context_additional_entities").get("entity_fields_on_task", [])
-
-    task = tk.shotgun.find_one("Task", [["id","is",task_id]], standard_fields + additional_fields)
-    if not task:
-        raise TankError("Unable to locate Task with id %s in Shotgun" % task_id)
-
-    # add task so it can be processed with other shotgun entities
-    task["task"] = {"type": "Task", "id": task_id, "name": task["content"]}
-
-    for key in context_keys + additional_fields:
-        data = task.get(key)
-        if data is None:
-            # gracefully skip stuff we don't have
-            # for example tasks may not have a step
-            continue
+    tasks = _find_by_ids(tk, "Task", task_ids, standard_fields + additional_fields)
+    
+    contexts = {}
+    for task_id in task_ids:
+        task = tasks.get(task_id)
+        if not task:
+            raise TankError("Unable to locate Task with id %s in Shotgun" % task_id)
+        
+        context = {}
+        
+        # add task so it can be processed with other shotgun entities
+        task["task"] = {"type": "Task", "id": task_id, "name": task["content"]}
+    
+        for key in context_keys + additional_fields:
+            data = task.get(key)
+            if data is None:
+                # gracefully skip stuff we don't have
+                # for example tasks may not have a step
+                continue
+    
+            # be explicit about what we pull in - make no assumptions about what is
+            # being returned from sg (the unit tests mocker doesn't return the same as the API)
+            value = {
+                "name": data.get("name"),
+                "id": data.get("id"),
+                "type": data.get("type")
+            }
+    
+            if key in context_keys:
+                context[key] = value
+            elif key in additional_fields:
+                additional_entities = context.get("additional_entities", [])
+                additional_entities.append(value)
+                context["additional_entities"] = additional_entities
+        
+        contexts[task_id] = context
 
-        # be explicit about what we pull in - make no assumptions about what is
-        # being returned from sg (the unit tests mocker doesn't return the same as the API)
-        value = {
-            "name": data.get("name"),
-            "id": data.get("id"),
-            "type": data.get("type")
-        }
+    return contexts
 
-        if key in context_keys:
-            context[key] = value
-        elif key in additional_fields:
-            additional_entities = context.get("additional_entities", [])
-            additional_entities.append(value)
-            context["additional_entities"] = additional_entities
 
-    return context
+def _tasks_from_cache(tk, task_ids):
+    """
+    Constructs context data for a list of shotgun tasks based on the task 
+    folders in the path cache. The project, entity and step are taken from 
+    the folders leading up to a task folder.
+    
+    :param tk:           a Sgtk API instance
+    :param task_ids:     The shotgun task ids to produce context data for.
+    :returns:            Dictionary of context data, keyed by task id. Tasks without a 
+                         task folder which resolves into a project, entity and step are 
+                         omitted, their step can only be found in shotgun.
+    """
+    path_cache = PathCache(tk)
+    try:
+        task_paths = path_cache.get_paths_many([ ("Task", x) for x in task_ids ], primary_only=True)
+    finally:
+        path_cache.close()
+    
+    path_contexts = from_paths(tk, list(itertools.chain(*task_paths.values())))
+    
+    contexts = {}
+    for task_id in task_ids:
+        for path in task_paths[("Task", task_id)]:
+            ctx = path_contexts[path]
+            if ctx.project and ctx.entity and ctx.step and ctx.task and ctx.task["id"] == task_id:
+                contexts[task_id] = {"project": ctx.project,
+                                     "entity": ctx.entity,
+                                     "step": ctx.step,
+                                     "task": ctx.task}
+                break
+    
+    return contexts
 
 
 def _entity_from_sg(tk, entity_type, entity_id):
@@ -1089,91 +1734,93 @@ def _entity_from_sg(tk, entity_type, entity_id):
     return context
 
 
-def _context_data_from_cache(tk, entity_type, entity_id):
-    """Adds data to context based on path cache.
+def _context_data_from_cache(tk, entities):
+    """Creates context data for a list of entities based on path cache.
 
     :param tk: a Sgtk API instance
-    :param entity_type: a Shotgun entity type
-    :param entity_id: a Shotgun entity id
+    :param entities: list of (entity_type, entity_id) tuples
+    :returns: Dictionary of context data, keyed by (entity_type, entity_id)
     """
-    context = {}
-
-    # Set entity info for input entity
-    context["entity"] = {"type": entity_type, "id": entity_id}
-
     # Map entity types to context fields
     types_fields = {"Project": "project",
                     "Step": "step",
                     "Task": "task"}
 
-    # Use the path cache to look up all paths linked to the entity and use that to extract
-    # extra entities we should include in the context
+    # Use the path cache to look up all paths linked to the entities, together
+    # with the entities of the folders above them. Use these to extract
+    # extra entities we should include in the contexts
     path_cache = PathCache(tk)
+    try:
+        entity_ancestry = path_cache.get_entity_ancestry_many(entities)
+        
+        # Special case for project as we have the primary data path, which 
+        # always points at a project. This is only needed for entities without
+        # a project folder above them. We only check if the associated configuration
+        # has any associated data roots, otherwise a primary config won't exist.
+        project = None
+        for ancestry in entity_ancestry.values():
+            project_folders = [ x for (path, chain) in ancestry for x in chain[1:] if x and x["type"] == "Project" ]
+            if not project_folders:
+                if tk.pipeline_configuration.has_associated_data_roots():
+                    project = path_cache.get_entity(tk.pipeline_configuration.get_primary_data_root())
+                break
+    
+    finally:
+        path_cache.close()
+    
+    contexts = {}
+    for (entity_type, entity_id) in entities:
+        context = {}
 
-    # Grab all project roots
-    project_roots = tk.pipeline_configuration.get_data_roots().values()
-
-    # Special case for project as we have the primary data path, which 
-    # always points at a project. We only check if the associated configuration
-    # has any associated data roots, otherwise a primary config won't exist.
-    if tk.pipeline_configuration.has_associated_data_roots():
-        context["project"] = path_cache.get_entity(tk.pipeline_configuration.get_primary_data_root())
-    else:
-        context["project"] = None
-
-    paths = path_cache.get_paths(entity_type, entity_id, primary_only=True)
-
-    for path in paths:
-        # now recurse upwards and look for entity types we haven't found yet
-        curr_path = path
-        curr_entity = path_cache.get_entity(curr_path)
-        
-        if curr_entity is None:
-            # this is some sort of anomaly! the path returned by get_paths
-            # does not resolve in get_entity. This can happen if the storage
-            # mappings are not consistent or if there is not a 1 to 1 relationship
-            #
-            # This can also happen if there are extra slashes at the end of the path
-            # in the local storage defs and in the pipeline_configuration.yml file.
-            raise TankError("The path '%s' associated with %s id %s does not " 
-                            "resolve correctly. This may be an indication of an issue "
-                            "with the local storage setup. Please contact " 
-                            "toolkitsupport@shotgunsoftware.com" % (curr_path, entity_type, entity_id))
-
-        # grab the name for the context entity
-        if curr_entity["type"] == entity_type and curr_entity["id"] == entity_id:
-            context["entity"]["name"] = curr_entity["name"]
-
-        # note - paths returned by get_paths are always prefixed with a
-        # project root so there is no risk we end up with an infinite loop here..
-        while curr_path not in project_roots:
-            curr_path = os.path.abspath(os.path.join(curr_path, ".."))
-            curr_entity = path_cache.get_entity(curr_path)
-            if curr_entity:
-                cur_type = curr_entity["type"]
-                if cur_type in types_fields:
-                    field_name = types_fields[cur_type]
-                    context[field_name] = curr_entity
+        # Set entity info for input entity
+        context["entity"] = {"type": entity_type, "id": entity_id}
+        context["project"] = project and project.copy()
 
-    path_cache.close()
-    return context
+        for (path, chain) in entity_ancestry[(entity_type, entity_id)]:
+            # now recurse upwards and look for entity types we haven't found yet
+            curr_entity = chain[0]
+            
+            if curr_entity is None:
+                # this is some sort of anomaly! the path returned by get_paths
+                # does not resolve in get_entity. This can happen if the storage
+                # mappings are not consistent or if there is not a 1 to 1 relationship
+                #
+                # This can also happen if there are extra slashes at the end of the path
+                # in the local storage defs and in the pipeline_configuration.yml file.
+                raise TankError("The path '%s' associated with %s id %s does not " 
+                                "resolve correctly. This may be an indication of an issue "
+                                "with the local storage setup. Please contact " 
+                                "toolkitsupport@shotgunsoftware.com" % (path, entity_type, entity_id))
+    
+            # grab the name for the context entity
+            if curr_entity["type"] == entity_type and curr_entity["id"] == entity_id:
+                context["entity"]["name"] = curr_entity["name"]
+    
+            for curr_entity in chain[1:]:
+                if curr_entity:
+                    cur_type = curr_entity["type"]
+                    if cur_type in types_fields:
+                        field_name = types_fields[cur_type]
+                        context[field_name] = curr_entity.copy()
+        
+        contexts[(entity_type, entity_id)] = context
+    
+    return contexts
 
 
-def _values_from_path_cache(entity, cur_template, path_cache, required_fields):
+def _values_from_path_cache(entity, cur_template, entity_paths, required_fields, validation_cache=None):
     """
     Determine values for template fields based on an entities cached paths.
                             
-    :param entity:          The entity to search for fields for
-    :param cur_template:    The template to use to search the path cache
-    :path_cache:            An instance of the path_cache to search in
-    :param required_fields: A list of fields that must exist in any matched path
+    :param entity:           The entity to search for fields for
+    :param cur_template:     The template to use to search the path cache
+    :param entity_paths:     The primary paths for the entity, as returned by the path cache
+    :param required_fields:  A list of fields that must exist in any matched path
+    :param validation_cache: Optional dictionary of previous validation results, see _validate_and_get_fields()
     :return:                Dictionary of fields found by matching the template against all paths
                             found for the entity
     """
     
-    # use the databsae to go from shotgun type/id --> paths
-    entity_paths = path_cache.get_paths(entity["type"], entity["id"], primary_only=True)
-    
     # Mapping for field values found in conjunction with this entities paths
     unique_fields = {}
     # keys whose values should be removed from return values
@@ -1182,7 +1829,7 @@ def _values_from_path_cache(entity, cur_template, path_cache, required_fields):
     for path in entity_paths:
         
         # validate path and get fields:
-        path_fields = cur_template.validate_and_get_fields(path, required_fields = required_fields)
+        path_fields = _validate_and_get_fields(cur_template, path, required_fields, validation_cache)
         if not path_fields:
             continue
         
@@ -1215,15 +1862,96 @@ def _values_from_path_cache(entity, cur_template, path_cache, required_fields):
     return unique_fields
 
 
+def _validate_and_get_fields(template, path, required_fields, validation_cache):
+    """
+    Validates a path against a template and returns the fields found, see
+    Template.validate_and_get_fields(). The fields found in the path are kept
+    in the validation cache, so that each template and path combination is
+    only parsed once. 
+    
+    :param template:         Template to validate against
+    :param path:             Path to validate
+    :param required_fields:  Optional dictionary of key names to key values which 
+                             must be found in the path
+    :param validation_cache: Dictionary of previous validation results, keyed by 
+                             (template, path). May be None to not cache anything.
+    :returns:                Dictionary of fields found in the path or None if 
+                             the path fails to validate
+    """
+    if validation_cache is None:
+        return template.validate_and_get_fields(path, required_fields=required_fields)
+    
+    cache_key = (template, path)
+    if cache_key in validation_cache:
+        path_fields = validation_cache[cache_key]
+    else:
+        path_fields = template.validate_and_get_fields(path)
+        validation_cache[cache_key] = path_fields
+    
+    if path_fields is None:
+        return None
+    
+    # Check that all required fields were found in the path:
+    for key, value in (required_fields or {}).items():
+        if path_fields.get(key) != value:
+            return None
+    
+    return path_fields.copy()
+
+# template ancestors, keyed by template
+_template_ancestors = weakref.WeakKeyDictionary()
+
+# the template instances used as ancestors. Templates with the same definition, 
+# root and keys share an instance. Keyed by _get_template_signature()
+_shared_templates = weakref.WeakValueDictionary()
+
+_template_ancestors_lock = threading.Lock()
+
+def _get_template_signature(template):
+    """
+    Returns a key identifying the paths matched by a template.
+    """
+    return (template.root_path, 
+            template.definition, 
+            frozenset([ (name, id(key)) for (name, key) in template.keys.iteritems() ]))
+
+def _get_shared_template(template):
+    """
+    Returns the template instance shared by all templates with the same 
+    signature as the given template. Must be called with the template 
+    ancestors lock held.
+    """
+    signature = _get_template_signature(template)
+    shared_template = _shared_templates.get(signature)
+    if shared_template is None:
+        shared_template = template
+        _shared_templates[signature] = shared_template
+    return shared_template
+
 def _get_template_ancestors(template):
     """Return templates branch of the template tree, ordered from first template
     below the project root down to and including the input template.
+    
+    The branch is only worked out once per template. Templates sharing parts of 
+    the tree get the same template instances for the shared parts, and the 
+    returned list ends with the shared instance equivalent to the input template.
     """
-    # TODO this would probably be better as the Template's responsibility
-    templates = [template]
-    cur_template = template
-    while cur_template.parent is not None and len(cur_template.parent.keys) > 0:
-        next_template = cur_template.parent
-        templates.insert(0, next_template)
-        cur_template = next_template
-    return templates
+    _template_ancestors_lock.acquire()
+    try:
+        # note that the input template itself is not stored with its ancestors
+        # as this would keep it from being garbage collected.
+        templates = _template_ancestors.get(template)
+        if templates is None:
+            # TODO this would probably be better as the Template's responsibility
+            templates = []
+            cur_template = template
+            while cur_template.parent is not None and len(cur_template.parent.keys) > 0:
+                next_template = cur_template.parent
+                templates.insert(0, _get_shared_template(next_template))
+                cur_template = next_template
+            
+            _template_ancestors[template] = templates
+        
+        return templates + [_get_shared_template(template)]
+    finally:
+        _template_ancestors_lock.release()
@@ -67,6 +67,11 @@ BUILT_IN_ACTIONS = [setup_project.SetupProjectAction,
                     path_cache.SynchronizePathCache,
                     path_cache.PathCacheMigrationAction,
                     path_cache.UnregisterFoldersAction,
+                    path_cache.FolderSyncAgentAction,
+                    path_cache.ExportFoldersAction,
+                    path_cache.ImportFoldersAction,
+                    path_cache.PathCacheMaintenanceAction,
+                    path_cache.PathCacheStatsAction,
                     clone_configuration.CloneConfigAction,
                     copy_apps.CopyAppsAction,
                     ]
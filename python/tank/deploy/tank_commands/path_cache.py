@@ -12,6 +12,8 @@
 Methods relating to the path cache
 """
 
+import time
+
 from ...errors import TankError
 from ... import path_cache
 from ... import folder 
@@ -120,6 +122,14 @@ class PathCacheMigrationAction(Action):
         """
         Tank command accessor
         """
+        if len(args) == 1 and args[0] == "--dry-run":
+            dry_run = True
+        
+        elif len(args) == 0:
+            dry_run = False
+            
+        else:
+            raise TankError("Syntax: upgrade_folders [--dry-run]")
                 
         log.info("Welcome to the folder sync upgrade command!")
         log.info("")
@@ -132,6 +142,18 @@ class PathCacheMigrationAction(Action):
             log.info("Looks like syncing is already turned on! Nothing to do!")
             return
         
+        if dry_run:
+            log.info("Dry run - checking which folder data would be pushed to Shotgun. "
+                     "No changes will be made.")
+            curr_pc = path_cache.PathCache(self.tk)
+            try:
+                curr_pc.ensure_all_entries_are_in_shotgun(log, dry_run=True)
+            finally:
+                curr_pc.close()
+            log.info("")
+            log.info("Run 'tank upgrade_folders' without the --dry-run flag to carry out the upgrade.")
+            return
+        
         log.info("Turning on folder sync will first do a full synchronization of the "
                  "existing folders. After that, syncing will happen incrementally in the "
                  "background.")
@@ -290,9 +312,17 @@ class UnregisterFoldersAction(Action):
         meta = {}
         # the api version used is always useful to know
         meta["core_api_version"] = self.tk.version
-        # shotgun ids created
+        # shotgun ids deleted
         meta["sg_folder_ids"] = [ x["sg_id"] for x in paths]
-        
+        # and a description of each deleted record. This allows the path cache sync
+        # to remove the corresponding entries incrementally rather than having
+        # to fall back on a full sync.
+        meta["sg_folders"] = [ {"id": x["sg_id"],
+                                "entity_type": x["entity"]["type"],
+                                "entity_id": x["entity"]["id"],
+                                "root": x["root"],
+                                "path": x["db_path"]} for x in paths ]
+
         sg_event_data = {}
         sg_event_data["event_type"] = "Toolkit_Folders_Delete"
         sg_event_data["description"] = "Toolkit %s: Unregistered %s folders." % (self.tk.version, len(paths))
@@ -318,3 +348,426 @@ class UnregisterFoldersAction(Action):
         log.info("")
         log.info("Unregister complete!")
         
+
+class FolderSyncAgentAction(Action):
+    """
+    Tank command which runs a long lived folder sync agent. The agent polls the Shotgun
+    event log at a regular interval and keeps the path cache up to date. While the agent
+    is running, other processes using the same path cache (for example render farm tasks 
+    on the same machine) will not check with Shotgun themselves but rely on the agent.
+    """
+    
+    def __init__(self):
+        """
+        Constructor
+        """
+        Action.__init__(self, 
+                        "folder_sync_agent", 
+                        Action.TK_INSTANCE, 
+                        ("Runs a folder sync agent which keeps the local folder data up to date "
+                         "with Shotgun on behalf of all other processes on this machine."), 
+                        "Admin")
+
+        # this method can be executed via the API
+        self.supports_api = True
+        self.parameters = {}        
+        self.parameters["interval"] = { "description": "Number of seconds between each poll of Shotgun", 
+                                         "default": 30.0, 
+                                         "type": "float" }
+        self.parameters["max_iterations"] = { "description": "Number of polls to carry out before exiting. "
+                                                             "Zero means that the agent runs until interrupted.", 
+                                              "default": 0, 
+                                              "type": "int" }
+        
+    def run_noninteractive(self, log, parameters):
+        """
+        API accessor
+        """
+        # validate params and seed default values
+        computed_params = self._validate_parameters(parameters)
+        return self._run(log, computed_params["interval"], computed_params["max_iterations"])
+    
+    def run_interactive(self, log, args):
+        """
+        Tank command accessor
+        """
+        interval = self.parameters["interval"]["default"]
+        
+        if len(args) == 1:
+            try:
+                interval = float(args[0])
+            except ValueError:
+                raise TankError("Syntax: folder_sync_agent [interval_in_seconds]")
+            
+        elif len(args) > 1:
+            raise TankError("Syntax: folder_sync_agent [interval_in_seconds]")
+
+        log.info("Starting folder sync agent, polling Shotgun every %s seconds. "
+                 "Press ctrl-c to exit." % interval)
+        return self._run(log, interval, 0)
+    
+    def _run(self, log, interval, max_iterations):
+        """
+        Actual business logic for command
+        
+        :param log: logger
+        :param interval: seconds between each poll
+        :param max_iterations: number of polls to carry out, zero for no limit
+        """
+        if interval <= 0:
+            raise TankError("The folder sync agent polling interval needs to be positive!")
+
+        if not self.tk.pipeline_configuration.get_shotgun_path_cache_enabled():
+            # remote cache not turned on for this project
+            log.error("Looks like this project doesn't synchronize its folders with Shotgun! "
+                      "If you want to turn on synchronization for this project, run "
+                      "the 'upgrade_folders' tank command.")
+            return
+        
+        pc = path_cache.PathCache(self.tk)
+        try:
+            iteration = 0
+            while True:
+                items = pc.sync_agent_poll(log, interval)
+                if len(items) > 0:
+                    log.info("Picked up %d new folders from Shotgun." % len(items))
+                
+                iteration += 1
+                if max_iterations and iteration >= max_iterations:
+                    break
+                
+                time.sleep(interval)
+        finally:
+            # processes go back to syncing themselves once the agent is gone 
+            pc.sync_agent_stop()
+            pc.close()
+        
+        log.info("Folder sync agent exiting.")
+
+
+class ExportFoldersAction(Action):
+    """
+    Tank command which writes the local folder data for a project to a snapshot file.
+    The snapshot can be imported on other machines using the import_folders command, 
+    which is a lot quicker than downloading all the folder data from Shotgun.
+    """
+    
+    def __init__(self):
+        """
+        Constructor
+        """
+        Action.__init__(self, 
+                        "export_folders", 
+                        Action.TK_INSTANCE, 
+                        ("Writes a snapshot of the local folder data to a file, for fast "
+                         "bootstrapping of other machines via the import_folders command."), 
+                        "Admin")
+
+        # this method can be executed via the API
+        self.supports_api = True
+        self.parameters = {}        
+        self.parameters["path"] = { "description": "Path to the snapshot file to write", 
+                                    "default": None, 
+                                    "type": "str" }
+        
+    def run_noninteractive(self, log, parameters):
+        """
+        API accessor
+        """
+        # validate params and seed default values
+        computed_params = self._validate_parameters(parameters)
+        return self._run(log, computed_params["path"])
+    
+    def run_interactive(self, log, args):
+        """
+        Tank command accessor
+        """
+        if len(args) != 1:
+            raise TankError("Syntax: export_folders snapshot_file")
+
+        return self._run(log, args[0])
+    
+    def _run(self, log, snapshot_file):
+        """
+        Actual business logic for command
+        
+        :param log: logger
+        :param snapshot_file: path to the snapshot file to write
+        """
+        if not self.tk.pipeline_configuration.get_shotgun_path_cache_enabled():
+            # remote cache not turned on for this project
+            log.error("Looks like this project doesn't synchronize its folders with Shotgun! "
+                      "If you want to turn on synchronization for this project, run "
+                      "the 'upgrade_folders' tank command.")
+            return
+        
+        pc = path_cache.PathCache(self.tk)
+        try:
+            log.info("Ensuring that the local folder representation is up to date...")
+            pc.synchronize(log)
+            num_records = pc.export_snapshot(snapshot_file)
+        finally:
+            pc.close()
+        
+        log.info("Wrote %d folder records to '%s'." % (num_records, snapshot_file))
+
+
+class ImportFoldersAction(Action):
+    """
+    Tank command which replaces the local folder data for a project with the contents
+    of a snapshot file written by the export_folders command. Once imported, only
+    the changes made since the snapshot was taken need to be downloaded from Shotgun.
+    """
+    
+    def __init__(self):
+        """
+        Constructor
+        """
+        Action.__init__(self, 
+                        "import_folders", 
+                        Action.TK_INSTANCE, 
+                        ("Replaces the local folder data with a snapshot written by the "
+                         "export_folders command and catches up with Shotgun."), 
+                        "Admin")
+
+        # this method can be executed via the API
+        self.supports_api = True
+        self.parameters = {}        
+        self.parameters["path"] = { "description": "Path to the snapshot file to import", 
+                                    "default": None, 
+                                    "type": "str" }
+        
+    def run_noninteractive(self, log, parameters):
+        """
+        API accessor
+        """
+        # validate params and seed default values
+        computed_params = self._validate_parameters(parameters)
+        return self._run(log, computed_params["path"])
+    
+    def run_interactive(self, log, args):
+        """
+        Tank command accessor
+        """
+        if len(args) != 1:
+            raise TankError("Syntax: import_folders snapshot_file")
+
+        return self._run(log, args[0])
+    
+    def _run(self, log, snapshot_file):
+        """
+        Actual business logic for command
+        
+        :param log: logger
+        :param snapshot_file: path to the snapshot file to import
+        """
+        if not self.tk.pipeline_configuration.get_shotgun_path_cache_enabled():
+            # remote cache not turned on for this project
+            log.error("Looks like this project doesn't synchronize its folders with Shotgun! "
+                      "If you want to turn on synchronization for this project, run "
+                      "the 'upgrade_folders' tank command.")
+            return
+        
+        pc = path_cache.PathCache(self.tk)
+        try:
+            num_records = pc.import_snapshot(snapshot_file, log)
+            log.info("Imported %d folder records from '%s'." % (num_records, snapshot_file))
+            
+            log.info("Picking up folder changes made since the snapshot was taken...")
+            pc.synchronize(log)
+        finally:
+            pc.close()
+        
+        log.info("Local folder information has been synchronized.")
+
+
+class PathCacheMaintenanceAction(Action):
+    """
+    Tank command which checks the path cache for inconsistencies, fixes them and 
+    compacts the path cache db. 
+    """
+    
+    def __init__(self):
+        """
+        Constructor
+        """
+        Action.__init__(self, 
+                        "path_cache_maintenance", 
+                        Action.TK_INSTANCE, 
+                        ("Checks the local folder data for inconsistencies, repairs "
+                         "them and compacts the path cache database."), 
+                        "Admin")
+
+        # this method can be executed via the API
+        self.supports_api = True
+        self.parameters = {}        
+        self.parameters["dry_run"] = { "description": "Only report problems, don't make any changes", 
+                                       "default": False, 
+                                       "type": "bool" }
+        
+    def run_noninteractive(self, log, parameters):
+        """
+        API accessor
+        """
+        # validate params and seed default values
+        computed_params = self._validate_parameters(parameters)
+        return self._run(log, computed_params["dry_run"])
+    
+    def run_interactive(self, log, args):
+        """
+        Tank command accessor
+        """
+        if len(args) == 1 and args[0] == "--dry-run":
+            dry_run = True
+        
+        elif len(args) == 0:
+            dry_run = False
+            
+        else:
+            raise TankError("Syntax: path_cache_maintenance [--dry-run]")
+
+        return self._run(log, dry_run)
+    
+    def _log_stats(self, log, label, stats):
+        """
+        Logs path cache measurements
+        
+        :param log: logger
+        :param label: description of the measurements
+        :param stats: dictionary with size, num_records and lookup_time keys
+        """
+        log.info("%s: %d records, %.1f KiB, %.3f ms per lookup." % (label,
+                                                                   stats["num_records"], 
+                                                                   stats["size"] / 1024.0, 
+                                                                   stats["lookup_time"] * 1000))
+    
+    def _run(self, log, dry_run):
+        """
+        Actual business logic for command
+        
+        :param log: logger
+        :param dry_run: boolean flag to indicate that only problems should be reported
+        """
+        pc = path_cache.PathCache(self.tk)
+        try:
+            log.info("Checking the path cache...")
+            result = pc.run_maintenance(log, dry_run)
+        finally:
+            pc.close()
+        
+        # problems which can only be resolved in Shotgun
+        report_only = set([x[0] for x in path_cache.MAINTENANCE_CHECKS if x[2] is None])
+        
+        log.info("")
+        for (description, count) in result["problems"]:
+            if dry_run:
+                log.info(" - %s: %d found" % (description, count))
+            elif description in report_only:
+                log.info(" - %s: %d found - please use the unregister_folders "
+                         "command to resolve these" % (description, count))
+            else:
+                log.info(" - %s: %d fixed" % (description, count))
+        
+        log.info("")
+        self._log_stats(log, "Before", result["before"])
+        if result["after"]:
+            self._log_stats(log, "After", result["after"])
+        
+        return result
+
+
+class PathCacheStatsAction(Action):
+    """
+    Tank command which replays a list of folder lookups against the path cache
+    and reports access statistics for them.
+    """
+    
+    def __init__(self):
+        """
+        Constructor
+        """
+        Action.__init__(self, 
+                        "path_cache_stats", 
+                        Action.TK_INSTANCE, 
+                        ("Replays the folder lookups in a workload file against the path "
+                         "cache and reports call counts and timings."), 
+                        "Admin")
+
+        # this method can be executed via the API
+        self.supports_api = True
+        self.parameters = {}        
+        self.parameters["path"] = { "description": "Path to a workload file, listing one path to look up per line", 
+                                    "default": None, 
+                                    "type": "str" }
+        self.parameters["repeat"] = { "description": "Number of times to replay the workload", 
+                                      "default": 1, 
+                                      "type": "int" }
+        
+    def run_noninteractive(self, log, parameters):
+        """
+        API accessor
+        """
+        # validate params and seed default values
+        computed_params = self._validate_parameters(parameters)
+        return self._run(log, computed_params["path"], computed_params["repeat"])
+    
+    def run_interactive(self, log, args):
+        """
+        Tank command accessor
+        """
+        if len(args) == 1:
+            repeat = self.parameters["repeat"]["default"]
+        
+        elif len(args) == 2:
+            try:
+                repeat = int(args[1])
+            except ValueError:
+                raise TankError("Repeat count needs to be a number!")
+        
+        else:
+            raise TankError("Syntax: path_cache_stats workload_file [repeat]")
+
+        return self._run(log, args[0], repeat)
+    
+    def _run(self, log, workload_file, repeat):
+        """
+        Actual business logic for command
+        
+        :param log: logger
+        :param workload_file: file listing one path per line. Empty lines and 
+                              lines starting with # are skipped.
+        :param repeat: number of times to replay the workload
+        :returns: statistics, as returned by path_cache.get_stats()
+        """
+        try:
+            fh = open(workload_file, "rt")
+            try:
+                paths = [ x.strip() for x in fh.readlines() ]
+            finally:
+                fh.close()
+        except IOError, e:
+            raise TankError("Could not read workload file '%s': %s" % (workload_file, e))
+        
+        paths = [ x for x in paths if x and not x.startswith("#") ]
+        
+        pc = path_cache.PathCache(self.tk)
+        path_cache.reset_stats()
+        stats_enabled = path_cache.enable_stats(True)
+        try:
+            log.info("Replaying %d lookups %d time(s)..." % (len(paths), repeat))
+            for x in range(repeat):
+                pc.synchronize(log)
+                for path in paths:
+                    entity = pc.get_entity(path)
+                    if entity:
+                        pc.get_paths(entity["type"], entity["id"], primary_only=True)
+            stats = path_cache.get_stats()
+        finally:
+            path_cache.enable_stats(stats_enabled)
+            pc.close()
+        
+        log.info("")
+        for line in path_cache.format_stats(stats):
+            log.info(line)
+        
+        return stats
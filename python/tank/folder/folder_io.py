@@ -123,7 +123,7 @@ class FolderIOReceiver(object):
                 # request that the path cache is synced against shotgun
                 # new items that were not locally available are returned
                 # as a list of dicts with keys id, type, name, configuration and path
-                rd = path_cache.synchronize()
+                rd = path_cache.synchronize(before_write=True)
                 
                 # for each item we get back from the path cache synchronization,
                 # issue a remote entity folder request and pass that down to 
@@ -14,10 +14,25 @@ all Tank items in the file system are kept.
 
 """
 
+import atexit
+import bisect
 import collections
+import gzip
+import hashlib
+import inspect
+import itertools
+import logging
+import Queue
+import re
 import sqlite3
+import socket
+import struct
+import subprocess
 import sys
 import os
+import tempfile
+import threading
+import time
 
 # use api json to cover py 2.5
 # todo - replace with proper external library  
@@ -40,6 +55,862 @@ SG_ENTITY_TYPE_FIELD = "linked_entity_type"
 SG_ENTITY_NAME_FIELD = "code"
 SG_PIPELINE_CONFIG_FIELD = "pipeline_configuration"
 
+# event log entries announcing changes to the folder records in Shotgun. 
+# Cores which predate Toolkit_Folders_Update events ignore them and pick up 
+# the updated records with their next full sync.
+SG_FOLDER_EVENT_TYPES = ["Toolkit_Folders_Create", "Toolkit_Folders_Delete", "Toolkit_Folders_Update"]
+
+# max number of records to send to Shotgun in a single batch call
+SG_BATCH_SIZE = 50
+
+# number of records to request per page when streaming records from Shotgun
+SG_PAGE_SIZE = 500
+
+# default number of parallel Shotgun connections to use for bulk updates
+SG_NUM_UPLOAD_THREADS = 4
+
+# a folder sync agent is considered active for this many polling 
+# intervals after its last poll
+SYNC_AGENT_GRACE_FACTOR = 2
+
+# indices for the path_cache table. The path is only stored in a single index,
+# since it makes up most of the size of a path cache file.
+#
+# - path_cache_tree is used for path -> entity lookups. It covers all the 
+#   selected columns, so a lookup never has to touch the table itself. 
+#   Paths are ordered bytewise within each storage so that all the entries 
+#   below a folder can also be found with a single range scan.
+#
+# - path_cache_all ensures that entries are unique and is used for entity -> 
+#   path lookups. It holds the integer path hash rather than the path itself.
+#
+PATH_CACHE_INDICES = """
+    CREATE UNIQUE INDEX IF NOT EXISTS path_cache_all ON path_cache(entity_type, entity_id, primary_entity, root_id, path_hash);
+    
+    CREATE INDEX IF NOT EXISTS path_cache_tree ON path_cache(root_id, path COLLATE BINARY, primary_entity, entity_type, entity_id, entity_name);
+    """
+
+# indices created by earlier versions of the db layout, which are no longer used
+OBSOLETE_PATH_CACHE_INDICES = ["path_cache_entity", "path_cache_path", "path_cache_root_path"]
+
+# integrity checks carried out by PathCache.run_maintenance(), in the order in
+# which problems are fixed. Each check is described by a tuple with a
+# description, a query counting the problems and a statement fixing them.
+# Problems without a fix statement are only reported, since resolving them 
+# requires changes to the records in Shotgun.
+MAINTENANCE_CHECKS = [
+    # path_cache_all makes records unique by path hash, so copies of a record 
+    # can only exist where the hash of one of them has gone stale. These have 
+    # to be removed before the hashes are corrected.
+    ("duplicate records with a stale path hash",
+     """SELECT count(*) FROM path_cache WHERE rowid NOT IN 
+        (SELECT min(rowid) FROM path_cache GROUP BY entity_type, entity_id, primary_entity, root_id, path)""",
+     """DELETE FROM path_cache WHERE rowid NOT IN 
+        (SELECT min(rowid) FROM path_cache GROUP BY entity_type, entity_id, primary_entity, root_id, path)"""),
+    # more than one primary entity for a path. The conflicting records also exist 
+    # in Shotgun and would come back with the next full sync, so these need to be 
+    # resolved using the unregister_folders command.
+    ("conflicting primary records",
+     """SELECT count(*) FROM path_cache WHERE primary_entity = 1 AND rowid NOT IN 
+        (SELECT max(rowid) FROM path_cache WHERE primary_entity = 1 GROUP BY root_id, path)""",
+     None),
+    ("records with an unknown storage root",
+     """SELECT count(*) FROM path_cache WHERE root_id IS NULL OR root_id NOT IN (SELECT id FROM path_cache_root)""",
+     """DELETE FROM path_cache WHERE root_id IS NULL OR root_id NOT IN (SELECT id FROM path_cache_root)"""),
+    ("records with a stale storage root name",
+     """SELECT count(*) FROM path_cache WHERE root IS NULL OR root != (SELECT name FROM path_cache_root WHERE id = root_id)""",
+     """UPDATE path_cache SET root = (SELECT name FROM path_cache_root WHERE id = root_id) 
+        WHERE root IS NULL OR root != (SELECT name FROM path_cache_root WHERE id = root_id)"""),
+    ("records with a stale path hash",
+     """SELECT count(*) FROM path_cache WHERE path_hash IS NULL OR path_hash != tk_path_hash(path)""",
+     """UPDATE path_cache SET path_hash = tk_path_hash(path) WHERE path_hash IS NULL OR path_hash != tk_path_hash(path)"""),
+    ("orphaned shotgun status records",
+     """SELECT count(*) FROM shotgun_status WHERE path_cache_id NOT IN (SELECT rowid FROM path_cache)""",
+     """DELETE FROM shotgun_status WHERE path_cache_id NOT IN (SELECT rowid FROM path_cache)"""),
+    ("stale event log markers",
+     """SELECT count(*) FROM event_log_sync WHERE rowid NOT IN 
+        (SELECT rowid FROM event_log_sync ORDER BY last_id DESC LIMIT 1)""",
+     """DELETE FROM event_log_sync WHERE rowid NOT IN 
+        (SELECT rowid FROM event_log_sync ORDER BY last_id DESC LIMIT 1)"""),
+    ("stale sync agent records",
+     """SELECT count(*) FROM sync_agent WHERE last_poll + interval * %d < CAST(strftime('%%s', 'now') AS REAL)""" % SYNC_AGENT_GRACE_FACTOR,
+     """DELETE FROM sync_agent WHERE last_poll + interval * %d < CAST(strftime('%%s', 'now') AS REAL)""" % SYNC_AGENT_GRACE_FACTOR),
+    ]
+
+# number of paths to look up when measuring the path cache lookup latency
+MAINTENANCE_NUM_SAMPLES = 500
+
+# identifier and version of the path cache snapshot file format
+SNAPSHOT_FORMAT = "tk_path_cache_snapshot"
+SNAPSHOT_VERSION = 1
+
+# version of the path cache db layout, stored in the sqlite user_version header 
+# field. Databases created before versioning was introduced report 0 and have 
+# their layout probed and upgraded. Bump this whenever the layout changes.
+PATH_CACHE_SCHEMA_VERSION = 4
+
+# page size for path cache dbs on local storage. The covering indices hold
+# full paths, so larger pages keep the index trees shallow.
+PATH_CACHE_PAGE_SIZE = 8192
+
+# file systems types on which sqlite's write-ahead log cannot be used, 
+# since it relies on shared memory between all processes accessing the db
+NETWORK_FILESYSTEM_TYPES = set(["nfs", "nfs4", "cifs", "smbfs", "smb2", "smb3", "ncpfs", "afs", 
+                                "coda", "9p", "lustre", "gpfs", "glusterfs", "ceph", "davfs",
+                                "fuse.sshfs", "fuse.glusterfs", "fuse.ceph", "fuse.davfs2"])
+
+# all tables and indices of a new path cache db. 
+#
+# Path cache dbs are shared with earlier core versions, for example by all the
+# pipeline configurations of a project using the legacy path cache in the 
+# project root. These read and write the storage root name and the path of 
+# each path_cache row and know nothing about the root_id and path_hash columns, 
+# so the root name is still stored alongside the root id. It is not indexed,
+# so lookups carried out by earlier core versions scan the table. Rows written 
+# by earlier core versions are completed when the db is opened, see 
+# PathCache._complete_legacy_rows().
+PATH_CACHE_TABLES = """
+    CREATE TABLE IF NOT EXISTS path_cache_root (id integer PRIMARY KEY, name text);
+    
+    CREATE UNIQUE INDEX IF NOT EXISTS path_cache_root_name ON path_cache_root(name);
+
+    CREATE TABLE IF NOT EXISTS path_cache (entity_type text, entity_id integer, entity_name text, root text, path text, primary_entity integer, root_id integer, path_hash integer);
+    
+    %s
+    
+    CREATE TABLE IF NOT EXISTS event_log_sync (last_id integer);
+    
+    CREATE TABLE IF NOT EXISTS shotgun_status (path_cache_id integer, shotgun_id integer);
+    
+    CREATE UNIQUE INDEX IF NOT EXISTS shotgun_status_id ON shotgun_status(path_cache_id);
+    
+    CREATE TABLE IF NOT EXISTS sync_agent (pid integer, host text, interval real, last_poll real);
+    """ % PATH_CACHE_INDICES
+
+# connection specific scratch table used to match batches of 
+# mappings against the path cache using joins
+MAPPING_INPUT_TABLE = """
+    CREATE TEMP TABLE IF NOT EXISTS mapping_input (seq integer, 
+                                                   entity_type text, 
+                                                   entity_id integer, 
+                                                   root_id integer, 
+                                                   path text, 
+                                                   path_hash integer, 
+                                                   primary_entity integer)"""
+
+# max number of values to bind in a single sqlite IN (...) expression.
+# Older sqlite builds have a default limit of 999 host parameters per statement.
+SQLITE_MAX_PARAMETERS = 900
+
+def _path_hash(path):
+    """
+    Computes a 64 bit integer hash for a path cache db path. Hashes are stored
+    alongside each path and allow the uniqueness of the entries to be enforced 
+    by a compact integer index rather than one holding long text values.
+    
+    :param path: db path, as a utf-8 str or unicode object
+    :returns: signed 64 bit integer
+    """
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+    return struct.unpack("<q", hashlib.md5(path).digest()[:8])[0]
+
+def _get_db_path_chain(db_path):
+    """
+    Returns a db path and the db paths of all its parent folders.
+    
+    /foo/bar --> ["/foo/bar", "/foo", ""]
+    
+    :param db_path: db path, relative to its storage root
+    :returns: list of db paths, starting with the given path and ending 
+              with the storage root
+    """
+    db_paths = [db_path]
+    while "/" in db_path:
+        db_path = db_path.rsplit("/", 1)[0]
+        db_paths.append(db_path)
+    if db_path != "":
+        db_paths.append("")
+    return db_paths
+
+def _copy_ancestry(ancestry):
+    """
+    Copies the entity ancestry for the paths of an entity, 
+    see PathCache.get_entity_ancestry_many()
+    """
+    return [ (path, [ x and x.copy() for x in chain ]) for (path, chain) in ancestry ]
+
+# file system checks carried out, keyed by path cache file
+_local_filesystem_lookup = {}
+
+def _is_local_filesystem(path):
+    """
+    Determines whether a file is located on local storage. When this cannot
+    be determined, the file is assumed to be on a network file system.
+    
+    :param path: Path to a file that exists on disk
+    :returns: True if the file is on a local file system, False otherwise
+    """
+    if path not in _local_filesystem_lookup:
+        is_local = False
+        try:
+            real_path = os.path.realpath(path)
+            if sys.platform.startswith("linux"):
+                is_local = _is_local_filesystem_linux(real_path)
+            elif sys.platform == "darwin":
+                is_local = _is_local_filesystem_mac(real_path)
+            elif sys.platform == "win32":
+                is_local = _is_local_filesystem_windows(real_path)
+        except Exception:
+            # play it safe
+            is_local = False
+        _local_filesystem_lookup[path] = is_local
+        
+    return _local_filesystem_lookup[path]
+    
+def _get_mount_point(path, mount_points):
+    """
+    Returns the mount point for a path.
+    
+    :param path: Absolute path
+    :param mount_points: List of mount point paths
+    :returns: The longest mount point containing the path, None if not found.
+    """
+    matches = [x for x in mount_points 
+               if path == x or path.startswith(x.rstrip("/") + "/")]
+    if len(matches) == 0:
+        return None
+    return max(matches, key=len)
+
+def _is_local_filesystem_linux(path):
+    """
+    Linux implementation of _is_local_filesystem(), based on /proc/mounts.
+    """
+    fs_types = {}
+    fh = open("/proc/mounts", "rt")
+    try:
+        for line in fh:
+            tokens = line.split()
+            if len(tokens) >= 3:
+                # spaces etc. are octal escaped in mount point paths
+                mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), tokens[1])
+                # later mounts on the same mount point hide earlier ones
+                fs_types[mount_point] = tokens[2]
+    finally:
+        fh.close()
+
+    mount_point = _get_mount_point(path, fs_types.keys())
+    if mount_point is None:
+        return False
+    
+    return fs_types[mount_point] not in NETWORK_FILESYSTEM_TYPES
+
+def _is_local_filesystem_mac(path):
+    """
+    Mac implementation of _is_local_filesystem(), based on the local 
+    flag reported by the mount command.
+    """
+    output = subprocess.Popen(["/sbin/mount"], stdout=subprocess.PIPE).communicate()[0]
+    
+    mount_options = {}
+    for line in output.splitlines():
+        # /dev/disk1s1 on / (apfs, local, journaled)
+        match = re.match(r"^.+ on (.+) \((.+)\)$", line)
+        if match:
+            mount_options[match.group(1)] = [x.strip() for x in match.group(2).split(",")]
+    
+    mount_point = _get_mount_point(path, mount_options.keys())
+    if mount_point is None:
+        return False
+    
+    return "local" in mount_options[mount_point]
+
+def _is_local_filesystem_windows(path):
+    """
+    Windows implementation of _is_local_filesystem(), based on the drive type.
+    """
+    import ctypes
+    
+    drive = os.path.splitdrive(path)[0]
+    if drive == "" or drive.startswith("\\\\"):
+        # UNC path
+        return False
+    
+    DRIVE_FIXED = 3
+    return ctypes.windll.kernel32.GetDriveTypeW(u"%s\\" % drive) == DRIVE_FIXED
+
+def _subtree_range(db_path):
+    """
+    Computes the range of db paths which are located below a db path. 
+    
+    Paths are compared bytewise, so all paths starting with "/foo/" sort 
+    at or after "/foo/" and before "/foo0", "0" being the character 
+    following the path separator.
+    
+    :param db_path: db path for a folder, e.g. /seq/shot_1
+    :returns: tuple (lower, upper), where lower is included in the range
+              and upper is excluded.
+    """
+    if not db_path.endswith("/"):
+        db_path += "/"
+    return (db_path, db_path[:-1] + "0")
+
+def _next_group(groups):
+    """
+    Returns the next group from an itertools.groupby iterator.
+    
+    :param groups: itertools.groupby iterator
+    :returns: tuple (key, list of items) or None if the iterator is exhausted
+    """
+    try:
+        (key, items) = groups.next()
+    except StopIteration:
+        return None
+    return (key, list(items))
+
+
+############################################################################################
+# in-memory lookup cache
+
+# environment variable which can be used to turn on the in-memory lookup cache.
+# The value is the maximum number of lookups to hold per path cache file.
+LOOKUP_CACHE_SIZE_ENV_VAR = "TANK_PATH_CACHE_LOOKUP_CACHE_SIZE"
+
+# lookup caches, keyed by path cache file
+_lookup_caches = {}
+_lookup_caches_lock = threading.Lock()
+
+# max number of items per lookup cache. 0 means that the cache is turned off.
+_lookup_cache_size = None
+
+def set_lookup_cache_size(max_items):
+    """
+    Sets the max number of lookups to keep in memory for each path cache file.
+    Setting this to zero turns off the in-memory lookup cache and releases all
+    cached data. This overrides any value set via the environment.
+    
+    The lookup cache is only used for projects which synchronize their path
+    cache with Shotgun. This is because the event log marker stored in the 
+    path cache is used to detect changes made by other processes.
+    
+    :param max_items: Max number of items to cache per path cache file
+    """
+    global _lookup_cache_size
+    _lookup_caches_lock.acquire()
+    try:
+        _lookup_cache_size = max(int(max_items), 0)
+        if _lookup_cache_size == 0:
+            _lookup_caches.clear()
+        else:
+            for lookup_cache in _lookup_caches.values():
+                lookup_cache.resize(_lookup_cache_size)
+    finally:
+        _lookup_caches_lock.release()
+
+def _get_lookup_cache(path_cache_file):
+    """
+    Returns the lookup cache for a path cache file.
+    
+    :param path_cache_file: Path to the path cache db file
+    :returns: _LookupCache instance or None if the lookup cache is turned off
+    """
+    global _lookup_cache_size
+    _lookup_caches_lock.acquire()
+    try:
+        if _lookup_cache_size is None:
+            # not set via the API - check the environment
+            try:
+                _lookup_cache_size = max(int(os.environ.get(LOOKUP_CACHE_SIZE_ENV_VAR, 0)), 0)
+            except ValueError:
+                _lookup_cache_size = 0
+        
+        if _lookup_cache_size == 0:
+            return None
+        
+        if path_cache_file not in _lookup_caches:
+            _lookup_caches[path_cache_file] = _LookupCache(_lookup_cache_size)
+        return _lookup_caches[path_cache_file]
+    finally:
+        _lookup_caches_lock.release()
+
+
+# callbacks run whenever this process changes the contents of a path cache
+_change_listeners = []
+
+def add_change_listener(callback):
+    """
+    Registers a callback which is run whenever this process has changed the 
+    contents of a path cache, e.g. after folders have been registered or 
+    synchronized from Shotgun. Changes made by other processes are reported 
+    once they have been detected by check_for_changes().
+    
+    :param callback: Callable taking the path to the path cache file as its only argument
+    """
+    _change_listeners.append(callback)
+
+# query returning a marker describing the state of a path cache db. New rows 
+# can also be added without the event log marker moving, see 
+# PathCache._register_uploaded_mappings(), so the max row id is included.
+DB_MARKER_SQL = "SELECT (SELECT max(last_id) FROM event_log_sync), (SELECT max(rowid) FROM path_cache)"
+
+# state of each path cache db the last time this process looked at it, 
+# keyed by path cache file. See check_for_changes()
+_db_markers = {}
+_db_markers_lock = threading.Lock()
+
+# connections used by check_for_changes(), keyed by path cache file. Each 
+# connection is stored together with the identity of the file it was opened for.
+_marker_connections = {}
+_marker_connections_lock = threading.Lock()
+
+def check_for_changes(path_cache_file):
+    """
+    Checks whether a path cache db has changed since this process last looked 
+    at it, for example because another process has registered or synchronized 
+    folders. If so, the in-memory lookup cache is cleared and the change 
+    listeners are run, so that data derived from the path cache can be 
+    discarded. The first check for a path cache db only records its state.
+    
+    The check is a single, cheap query carried out on a connection which is 
+    kept open for this purpose, so no PathCache instance is needed. 
+    
+    :param path_cache_file: Path to the path cache db file
+    :returns: True if changes were detected, False otherwise
+    """
+    try:
+        file_id = os.stat(path_cache_file)[1:3]
+    except OSError:
+        # nothing to check yet
+        return False
+    
+    _marker_connections_lock.acquire()
+    try:
+        (connection, connection_file_id) = _marker_connections.get(path_cache_file, (None, None))
+        if connection_file_id != file_id:
+            # the db file has been replaced
+            if connection is not None:
+                connection.close()
+            connection = sqlite3.connect(path_cache_file, check_same_thread=False)
+            _marker_connections[path_cache_file] = (connection, file_id)
+        marker = tuple(connection.execute(DB_MARKER_SQL).fetchone())
+    finally:
+        _marker_connections_lock.release()
+    
+    if not _update_db_marker(path_cache_file, marker):
+        return False
+    
+    _lookup_caches_lock.acquire()
+    try:
+        lookup_cache = _lookup_caches.get(path_cache_file)
+    finally:
+        _lookup_caches_lock.release()
+    if lookup_cache is not None:
+        lookup_cache.invalidate()
+    
+    for callback in _change_listeners:
+        callback(path_cache_file)
+    return True
+
+def _update_db_marker(path_cache_file, marker):
+    """
+    Records the state of a path cache db, as returned by DB_MARKER_SQL.
+    
+    :param path_cache_file: Path to the path cache db file
+    :param marker: Current marker of the db
+    :returns: True if the db has changed since its state was last recorded
+    """
+    _db_markers_lock.acquire()
+    try:
+        previous_marker = _db_markers.get(path_cache_file)
+        _db_markers[path_cache_file] = marker
+    finally:
+        _db_markers_lock.release()
+    
+    return previous_marker is not None and previous_marker != marker
+
+def _close_marker_connections():
+    """
+    Closes the connections used by check_for_changes() and forgets the
+    recorded state of all path cache dbs.
+    """
+    _marker_connections_lock.acquire()
+    try:
+        for (connection, _) in _marker_connections.values():
+            connection.close()
+        _marker_connections.clear()
+    finally:
+        _marker_connections_lock.release()
+    
+    _db_markers_lock.acquire()
+    try:
+        _db_markers.clear()
+    finally:
+        _db_markers_lock.release()
+
+
+class _LookupCache(object):
+    """
+    Size limited, least recently used store of path cache lookup results,
+    shared by all PathCache instances using the same path cache file.
+    
+    The cache is tagged with a marker describing the state of the path cache db 
+    at the time the data was read. If the marker changes, the data is discarded.
+    
+    Items are kept in order of use, least recently used first, so that 
+    both lookups and evictions take constant time.
+    """
+    
+    def __init__(self, max_items):
+        """
+        Constructor
+        
+        :param max_items: Max number of items to store
+        """
+        self._max_items = max_items
+        self._items = collections.OrderedDict()
+        self._marker = None
+        self._lock = threading.Lock()
+        # incremented whenever the data is discarded
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def resize(self, max_items):
+        """
+        Changes the max number of items stored.
+        
+        :param max_items: Max number of items to store
+        """
+        self._lock.acquire()
+        try:
+            self._max_items = max_items
+            self._evict()
+        finally:
+            self._lock.release()
+    
+    def validate(self, marker):
+        """
+        Ensures that the cached data was read at the given event log marker.
+        If not, the cache is cleared.
+        
+        :param marker: The current event log marker of the path cache db
+        """
+        self._lock.acquire()
+        try:
+            if marker != self._marker:
+                self._items.clear()
+                self._marker = marker
+                self.generation += 1
+        finally:
+            self._lock.release()
+    
+    def invalidate(self):
+        """
+        Clears all data. The cache needs to be validated again before it can be used.
+        """
+        self._lock.acquire()
+        try:
+            self._items.clear()
+            self._marker = None
+            self.generation += 1
+        finally:
+            self._lock.release()
+    
+    def get(self, key):
+        """
+        Returns a cached value.
+        
+        :param key: Lookup key
+        :returns: (found, value) tuple
+        """
+        self._lock.acquire()
+        try:
+            if key not in self._items:
+                self.misses += 1
+                return (False, None)
+            self.hits += 1
+            # move the item to the most recently used end
+            value = self._items.pop(key)
+            self._items[key] = value
+            return (True, value)
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value, generation):
+        """
+        Stores a value. 
+        
+        :param key: Lookup key
+        :param value: Value to store
+        :param generation: Cache generation at the time the value was read 
+                           from the database. If the cache has been cleared
+                           since, the value is discarded.
+        """
+        self._lock.acquire()
+        try:
+            if generation != self.generation:
+                return
+            self._items.pop(key, None)
+            self._items[key] = value
+            self._evict()
+        finally:
+            self._lock.release()
+    
+    def get_stats(self):
+        """
+        Returns usage statistics.
+        
+        :returns: dictionary with keys hits, misses, evictions, size and max_size
+        """
+        self._lock.acquire()
+        try:
+            return {"hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "size": len(self._items),
+                    "max_size": self._max_items}
+        finally:
+            self._lock.release()
+    
+    def _evict(self):
+        """
+        Removes the least recently used items if the cache is over its limit.
+        The caller needs to hold the lock.
+        """
+        while len(self._items) > self._max_items:
+            self._items.popitem(last=False)
+            self.evictions += 1
+
+
+############################################################################################
+# access statistics
+
+# environment variable which can be used to turn on the collection of path cache
+# access statistics. When set to a non-zero value, statistics are collected for 
+# all path caches and logged via the sgtk.path_cache logger when the process exits.
+PROFILE_ENV_VAR = "TANK_PATH_CACHE_PROFILE"
+
+# upper bounds, in seconds, of the latency histogram buckets. Calls slower than
+# the last bound are counted in an extra overflow bucket.
+LATENCY_BUCKETS = [0.0001, 0.001, 0.01, 0.1, 1.0]
+
+# access statistics for all path caches in this process, see _get_access_stats()
+_access_stats = None
+_access_stats_lock = threading.Lock()
+
+# whether access statistics are collected. None means that the environment
+# hasn't been checked yet.
+_access_stats_enabled = None
+
+def enable_stats(enabled):
+    """
+    Turns the collection of path cache access statistics on or off. This 
+    overrides any value set via the environment. Statistics collected so far
+    are kept.
+    
+    :param enabled: Boolean to indicate if statistics should be collected
+    :returns: True if statistics were collected prior to the call
+    """
+    global _access_stats_enabled
+    previous = _stats_enabled()
+    _access_stats_lock.acquire()
+    try:
+        _access_stats_enabled = bool(enabled)
+    finally:
+        _access_stats_lock.release()
+    return previous
+
+def reset_stats():
+    """
+    Clears all path cache access statistics collected so far.
+    """
+    global _access_stats
+    _access_stats_lock.acquire()
+    try:
+        _access_stats = None
+    finally:
+        _access_stats_lock.release()
+
+def get_stats():
+    """
+    Returns a copy of the path cache access statistics collected in this process.
+    
+    Statistics are held for each public path cache method called, keyed by 
+    method name, and for the waits for the db write lock at the start of write 
+    transactions. Each entry is a dictionary with keys:
+    
+    - calls: number of calls
+    - total_time: total time spent, in seconds
+    - max_time: time taken by the slowest call, in seconds
+    - histogram: list of call counts, one per bucket in LATENCY_BUCKETS
+      followed by a count of calls slower than the last bucket
+    
+    :returns: dictionary with keys methods, holding a dictionary of entries 
+              keyed by method name, and lock_waits, holding a single entry.
+    """
+    _access_stats_lock.acquire()
+    try:
+        if _access_stats is None:
+            return {"methods": {}, "lock_waits": _new_stats_entry()}
+        return {"methods": dict([ (name, _copy_stats_entry(entry)) 
+                                  for (name, entry) in _access_stats["methods"].items() ]),
+                "lock_waits": _copy_stats_entry(_access_stats["lock_waits"])}
+    finally:
+        _access_stats_lock.release()
+
+def format_stats(stats):
+    """
+    Formats path cache access statistics as a human readable report.
+    
+    :param stats: statistics, as returned by get_stats()
+    :returns: list of lines
+    """
+    bucket_names = [ "<%gms" % (x * 1000) for x in LATENCY_BUCKETS ] + [ ">%gms" % (LATENCY_BUCKETS[-1] * 1000) ]
+    
+    def _format_entry(name, entry):
+        if entry["calls"] == 0:
+            return "%s: no calls" % name
+        histogram = ", ".join([ "%s: %d" % (bucket, count) 
+                                for (bucket, count) in zip(bucket_names, entry["histogram"]) if count ])
+        return "%s: %d calls, %.3f ms avg, %.3f ms max (%s)" % (name, 
+                                                                entry["calls"],
+                                                                entry["total_time"] * 1000 / entry["calls"],
+                                                                entry["max_time"] * 1000,
+                                                                histogram)
+    
+    lines = []
+    for name in sorted(stats["methods"].keys()):
+        lines.append(_format_entry(name, stats["methods"][name]))
+    lines.append(_format_entry("write lock waits", stats["lock_waits"]))
+    return lines
+
+def _new_stats_entry():
+    """
+    Returns an empty statistics entry, see get_stats()
+    """
+    return {"calls": 0, "total_time": 0.0, "max_time": 0.0, "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+
+def _copy_stats_entry(entry):
+    """
+    Returns a copy of a statistics entry, see get_stats()
+    """
+    entry = entry.copy()
+    entry["histogram"] = list(entry["histogram"])
+    return entry
+
+def _stats_enabled():
+    """
+    Returns true if access statistics are collected. The environment is checked 
+    on first use, and if it turns statistics on, they are logged at exit.
+    """
+    global _access_stats_enabled
+    if _access_stats_enabled is None:
+        _access_stats_lock.acquire()
+        try:
+            if _access_stats_enabled is None:
+                _access_stats_enabled = os.environ.get(PROFILE_ENV_VAR, "0") not in ["", "0"]
+                if _access_stats_enabled:
+                    atexit.register(_log_stats_at_exit)
+        finally:
+            _access_stats_lock.release()
+    return _access_stats_enabled
+
+def _record_stats(name, elapsed):
+    """
+    Adds a timing to the access statistics.
+    
+    :param name: method name, or None for a write lock wait
+    :param elapsed: time taken, in seconds
+    """
+    global _access_stats
+    _access_stats_lock.acquire()
+    try:
+        if _access_stats is None:
+            _access_stats = {"methods": {}, "lock_waits": _new_stats_entry()}
+        if name is None:
+            entry = _access_stats["lock_waits"]
+        else:
+            entry = _access_stats["methods"].setdefault(name, _new_stats_entry())
+        entry["calls"] += 1
+        entry["total_time"] += elapsed
+        entry["max_time"] = max(entry["max_time"], elapsed)
+        entry["histogram"][bisect.bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+    finally:
+        _access_stats_lock.release()
+
+def _log_stats_at_exit():
+    """
+    Logs the access statistics collected during this session.
+    """
+    log = logging.getLogger("sgtk.path_cache")
+    log.info("Path cache access statistics for process %d:" % os.getpid())
+    for line in format_stats(get_stats()):
+        log.info(line)
+
+def _instrumented(method):
+    """
+    Decorator for path cache methods which records their timings in 
+    the access statistics when statistics are turned on.
+    
+    For generator methods, the time spent producing the items is recorded 
+    once the generator has been exhausted or closed.
+    """
+    if inspect.isgeneratorfunction(method):
+        def _generator_wrapper(*args, **kwargs):
+            if not _stats_enabled():
+                for item in method(*args, **kwargs):
+                    yield item
+                return
+            elapsed = 0.0
+            generator = method(*args, **kwargs)
+            try:
+                while True:
+                    start = time.time()
+                    try:
+                        item = generator.next()
+                    finally:
+                        elapsed += time.time() - start
+                    yield item
+            finally:
+                # StopIteration from the wrapped generator ends this one too
+                generator.close()
+                _record_stats(method.__name__, elapsed)
+        _generator_wrapper.__name__ = method.__name__
+        _generator_wrapper.__doc__ = method.__doc__
+        return _generator_wrapper
+    
+    def _wrapper(*args, **kwargs):
+        if not _stats_enabled():
+            return method(*args, **kwargs)
+        start = time.time()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _record_stats(method.__name__, time.time() - start)
+    _wrapper.__name__ = method.__name__
+    _wrapper.__doc__ = method.__doc__
+    return _wrapper
+
+
+class _IncompleteUploadError(TankError):
+    """
+    Raised when only some of the path cache records could be uploaded to Shotgun.
+    """
+    def __init__(self, msg, event_log_id, sg_id_lookup):
+        """
+        Constructor
+        
+        :param msg: Error message
+        :param event_log_id: Id of the event log entry written for the uploaded records
+        :param sg_id_lookup: Dictionary of path cache row ids and their corresponding 
+                             shotgun ids for the uploaded records.
+        """
+        TankError.__init__(self, msg)
+        self.event_log_id = event_log_id
+        self.sg_id_lookup = sg_id_lookup
+
+
 class PathCache(object):
     """
     A global cache which holds the mapping between a shotgun entity and a location on disk.
@@ -58,16 +929,111 @@ class PathCache(object):
         self._tk = tk
         self._sync_with_sg = tk.pipeline_configuration.get_shotgun_path_cache_enabled()
         
+        # in-memory cache of lookups, see _get_lookup_cache()
+        self._lookup_cache = None
+        self._lookup_cache_validated = False
+        
+        # storage root name <-> path_cache_root id lookups
+        self._root_ids = {}
+        self._root_names = {}
+        
         if tk.pipeline_configuration.has_associated_data_roots():
             self._path_cache_disabled = False
-            self._init_db()
             self._roots = tk.pipeline_configuration.get_data_roots()
+            self._init_db()
+            
+            if self._sync_with_sg:
+                # changes to the path cache can only be detected when
+                # syncing with shotgun
+                self._lookup_cache = _get_lookup_cache(self._path_cache_file)
 
         else:
             # no primary location found. Path cache therefore does not exist!
             # go into a no-path-cache-mode
             self._path_cache_disabled = True
     
+    def _get_validated_lookup_cache(self):
+        """
+        Returns the in-memory lookup cache for this path cache. The first time 
+        this is called, the cached data is validated against the event log 
+        marker in the database in order to pick up changes made by other processes.
+        
+        :returns: _LookupCache instance or None if lookups should not be cached
+        """
+        if self._lookup_cache is None:
+            return None
+        
+        if not self._lookup_cache_validated:
+            self.check_for_changes()
+        
+        return self._lookup_cache
+    
+    def check_for_changes(self):
+        """
+        Checks whether the path cache db has changed since this process last 
+        looked at it, see check_for_changes(). This uses the connection of this
+        path cache and also validates its in-memory lookup cache.
+        
+        :returns: True if changes were detected, False otherwise
+        """
+        if self._path_cache_disabled:
+            return False
+        
+        c = self._connection.cursor()
+        try:
+            res = c.execute(DB_MARKER_SQL)
+            marker = tuple(res.fetchone())
+        finally:
+            c.close()
+        
+        changed = _update_db_marker(self._path_cache_file, marker)
+        if changed:
+            self._invalidate_lookup_cache()
+        
+        if self._lookup_cache is not None:
+            self._lookup_cache.validate(marker)
+            self._lookup_cache_validated = True
+        
+        return changed
+    
+    def _invalidate_lookup_cache(self):
+        """
+        Clears the in-memory lookup cache after the database has been changed
+        and lets the change listeners know.
+        """
+        if self._lookup_cache is not None:
+            self._lookup_cache.invalidate()
+            self._lookup_cache_validated = False
+        
+        for callback in _change_listeners:
+            callback(self._path_cache_file)
+    
+    def get_lookup_cache_stats(self):
+        """
+        Returns usage statistics for the in-memory lookup cache.
+        
+        :returns: dictionary with keys hits, misses, evictions, size and max_size
+                  or None if the lookup cache is not in use.
+        """
+        if self._lookup_cache is None:
+            return None
+        return self._lookup_cache.get_stats()
+    
+    def _begin_write(self, cursor):
+        """
+        Starts a write transaction, acquiring the db write lock straight away. 
+        The time spent waiting for other connections to release the lock is 
+        recorded in the access statistics.
+        
+        :param cursor: Sqlite database cursor
+        """
+        if not _stats_enabled():
+            cursor.execute("BEGIN IMMEDIATE")
+            return
+        start = time.time()
+        cursor.execute("BEGIN IMMEDIATE")
+        _record_stats(None, time.time() - start)
+    
     def _log_debug(self, log, msg):
         """
         Helper method. Logs a debug message if the logger is valid.
@@ -86,8 +1052,47 @@ class PathCache(object):
         # will ensure that there is a valid folder and file on
         # disk, created with all the right permissions etc.
         path_cache_file = self._get_path_cache_location()
+        self._path_cache_file = path_cache_file
         
-        self._connection = sqlite3.connect(path_cache_file)
+        self._connection = self._connect(path_cache_file)
+        
+        c = self._connection.cursor()
+        try:
+            
+            # path caches on local storage use write-ahead logging, so that 
+            # readers are not blocked while folders are being registered. 
+            # The legacy path cache, shared by all users in the project root, 
+            # always uses the default settings.
+            if self._sync_with_sg and _is_local_filesystem(path_cache_file):
+                self._configure_local_db(c)
+            
+            # the layout only needs to be checked for databases which 
+            # have been written by earlier versions of the code
+            ret = c.execute("PRAGMA user_version")
+            if ret.fetchone()[0] < PATH_CACHE_SCHEMA_VERSION:
+                self._upgrade_schema(c)
+        
+            # make sure that all the storages for this project are registered 
+            self._load_root_ids(c)
+            
+            # pick up any folders registered by earlier core versions
+            self._check_legacy_rows(c)
+            
+            # lastly, a connection specific scratch table used to match batches
+            # of mappings against the path cache using joins
+            c.execute(MAPPING_INPUT_TABLE)
+        
+        finally:
+            c.close()
+    
+    def _connect(self, db_file):
+        """
+        Opens a connection to a path cache db file.
+        
+        :param db_file: Path to the db file
+        :returns: Sqlite connection
+        """
+        connection = sqlite3.connect(db_file)
         
         # this is to handle unicode properly - make sure that sqlite returns 
         # str objects for TEXT fields rather than unicode. Note that any unicode
@@ -96,73 +1101,266 @@ class PathCache(object):
         # representation will work for any language, as long as data is either input
         # as UTF-8 (byte string) or unicode. And in the latter case, the returned data
         # will always be unicode.
-        self._connection.text_factory = str
+        connection.text_factory = str
         
-        c = self._connection.cursor()
-        try:
+        # path hashes are computed in python, make them available to sql statements
+        connection.create_function("tk_path_hash", 1, _path_hash)
         
-            # get a list of tables in the current database
-            ret = c.execute("SELECT name FROM main.sqlite_master WHERE type='table';")
-            table_names = [x[0] for x in ret.fetchall()]
+        return connection
+    
+    def _configure_local_db(self, cursor):
+        """
+        Switches a path cache db on local storage to write-ahead logging with 
+        a larger page size. Commits are only synced to disk at checkpoints in 
+        this mode. This never corrupts the db, and the most recent changes can 
+        be picked up from Shotgun again if they are lost in a power failure.
+        
+        :param cursor: Sqlite database cursor
+        """
+        if sqlite3.sqlite_version_info < (3, 7, 0):
+            # write-ahead logging not supported
+            return
+        
+        journal_mode = cursor.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode.lower() != "wal":
+            try:
+                # the page size only takes effect if the db is empty
+                cursor.execute("PRAGMA page_size = %d" % PATH_CACHE_PAGE_SIZE)
+                journal_mode = cursor.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+            except sqlite3.OperationalError:
+                # the db is in use by another process. Stick 
+                # with the default settings for now. 
+                return
+        
+        if journal_mode.lower() == "wal":
+            cursor.execute("PRAGMA synchronous = NORMAL")
+    
+    def _upgrade_schema(self, cursor):
+        """
+        Creates all the tables and indices in a new path cache db, or
+        brings the layout of a db created by an earlier version up to date.
+        The schema version is recorded in the db once done.
+        
+        :param cursor: Sqlite database cursor
+        """
+        # get a list of tables in the current database
+        ret = cursor.execute("SELECT name FROM main.sqlite_master WHERE type='table';")
+        table_names = [x[0] for x in ret.fetchall()]
+        
+        if len(table_names) == 0:
+            # we have a brand new database. Create all tables and indices
+            cursor.executescript(PATH_CACHE_TABLES)
+            self._connection.commit()
             
-            if len(table_names) == 0:
-                # we have a brand new database. Create all tables and indices
-                c.executescript("""
-                    CREATE TABLE path_cache (entity_type text, entity_id integer, entity_name text, root text, path text, primary_entity integer);
-                
-                    CREATE INDEX path_cache_entity ON path_cache(entity_type, entity_id);
-                
-                    CREATE INDEX path_cache_path ON path_cache(root, path, primary_entity);
-                
-                    CREATE UNIQUE INDEX path_cache_all ON path_cache(entity_type, entity_id, root, path, primary_entity);
-                    
-                    CREATE TABLE event_log_sync (last_id integer);
-                    
-                    CREATE TABLE shotgun_status (path_cache_id integer, shotgun_id integer);
+        else:
+            
+            # we have an existing database! Ensure it is up to date
+            if "event_log_sync" not in table_names:
+                # this is a pre-0.15 setup where the path cache does not have event log sync
+                cursor.executescript("CREATE TABLE event_log_sync (last_id integer);")
+                self._connection.commit()
+            
+            if "shotgun_status" not in table_names:
+                # this is a pre-0.15 setup where the path cache does not have the shotgun_status table
+                cursor.executescript("""CREATE TABLE shotgun_status (path_cache_id integer, shotgun_id integer);
+                                   CREATE UNIQUE INDEX shotgun_status_id ON shotgun_status(path_cache_id);""")
+                self._connection.commit()
+            
+            if "sync_agent" not in table_names:
+                # this is a setup from before the folder sync agent was introduced
+                cursor.executescript("CREATE TABLE sync_agent (pid integer, host text, interval real, last_poll real);")
+                self._connection.commit()
+
+            # now ensure that some key fields that have been added during the dev cycle are there
+            ret = cursor.execute("PRAGMA table_info(path_cache)")
+            field_names = [ x[1] for x in ret.fetchall() ]
+            
+            # check for primary entity field - this was added back in 0.12.x
+            if "primary_entity" not in field_names:
+                cursor.executescript("""
+                    ALTER TABLE path_cache ADD COLUMN primary_entity integer;
+                    UPDATE path_cache SET primary_entity=1;
+
+                    DROP INDEX IF EXISTS path_cache_path;
+                    CREATE INDEX IF NOT EXISTS path_cache_path ON path_cache(root, path, primary_entity);
                     
-                    CREATE UNIQUE INDEX shotgun_status_id ON shotgun_status(path_cache_id);
+                    DROP INDEX IF EXISTS path_cache_all;
+                    CREATE UNIQUE INDEX IF NOT EXISTS path_cache_all ON path_cache(entity_type, entity_id, root, path, primary_entity);
                     """)
+
                 self._connection.commit()
                 
-            else:
+            # check for the normalized storage roots and path hashes
+            if "root_id" not in field_names:
+                self._upgrade_to_normalized_roots(cursor)
+            
+            elif "root" not in field_names:
+                # layout 2 stored the root ids only, which broke earlier core
+                # versions sharing the db. Bring back the root names.
+                cursor.executescript("""
+                    ALTER TABLE path_cache ADD COLUMN root text;
+                    UPDATE path_cache SET root = (SELECT name FROM path_cache_root WHERE id = path_cache.root_id);
+                    """)
+                self._connection.commit()
+            
+            # check for indices which are no longer used or have changed
+            ret = cursor.execute("SELECT name, sql FROM main.sqlite_master WHERE type='index' AND tbl_name='path_cache'")
+            index_sql = dict(ret.fetchall())
+            statements = [ "DROP INDEX %s" % x for x in OBSOLETE_PATH_CACHE_INDICES if x in index_sql ]
+            if "path_hash" not in index_sql.get("path_cache_all", "path_hash"):
+                # layout 3 held the path in the unique index
+                statements.append("DROP INDEX path_cache_all")
+            if statements or "path_cache_all" not in index_sql or "path_cache_tree" not in index_sql:
+                cursor.executescript("%s;\n%s" % (";\n".join(statements), PATH_CACHE_INDICES))
+                self._connection.commit()
+        
+        cursor.execute("PRAGMA user_version = %d" % PATH_CACHE_SCHEMA_VERSION)
+        self._connection.commit()
+    
+    def _upgrade_to_normalized_roots(self, cursor):
+        """
+        Migrates a path cache where the storage root name and the path are stored
+        in text form in every row to a layout where storage roots are also held in 
+        a separate table, keyed by integer, and where each path carries a hash 
+        used for equality lookups. The lookup indices are rebuilt to cover all 
+        the columns that are being selected.
+        
+        The existing columns are left in place, so that earlier core versions 
+        sharing the db keep working, see PATH_CACHE_TABLES.
+        
+        :param cursor: Sqlite database cursor
+        """
+        # run the migration as a single transaction. Python's sqlite module
+        # commits implicitly before any schema statements, so temporarily 
+        # take over transaction handling.
+        self._connection.isolation_level = None
+        try:
+            self._begin_write(cursor)
+            try:
+                # now that we hold the lock, check that another process didn't 
+                # already carry out the upgrade
+                ret = cursor.execute("PRAGMA table_info(path_cache)")
+                field_names = [ x[1] for x in ret.fetchall() ]
                 
-                # we have an existing database! Ensure it is up to date
-                if "event_log_sync" not in table_names:
-                    # this is a pre-0.15 setup where the path cache does not have event log sync
-                    c.executescript("CREATE TABLE event_log_sync (last_id integer);")
-                    self._connection.commit()
+                if "root_id" not in field_names:
+                    # the previous indices are replaced
+                    for statement in ["""DROP INDEX IF EXISTS path_cache_entity""",
+                                      """DROP INDEX IF EXISTS path_cache_path""",
+                                      """DROP INDEX IF EXISTS path_cache_all""",
+                                      """CREATE TABLE IF NOT EXISTS path_cache_root (id integer PRIMARY KEY, name text)""",
+                                      """CREATE UNIQUE INDEX IF NOT EXISTS path_cache_root_name ON path_cache_root(name)""",
+                                      """ALTER TABLE path_cache ADD COLUMN root_id integer""",
+                                      """ALTER TABLE path_cache ADD COLUMN path_hash integer"""]:
+                        cursor.execute(statement)
+                    
+                    self._complete_legacy_rows(cursor)
+                    
+                    for statement in PATH_CACHE_INDICES.split(";"):
+                        if statement.strip():
+                            cursor.execute(statement)
                 
-                if "shotgun_status" not in table_names:
-                    # this is a pre-0.15 setup where the path cache does not have the shotgun_status table
-                    c.executescript("""CREATE TABLE shotgun_status (path_cache_id integer, shotgun_id integer);
-                                       CREATE UNIQUE INDEX shotgun_status_id ON shotgun_status(path_cache_id);""")
-                    self._connection.commit()
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
+        finally:
+            self._connection.isolation_level = ""
 
-                
-                # now ensure that some key fields that have been added during the dev cycle are there
-                ret = c.execute("PRAGMA table_info(path_cache)")
-                field_names = [ x[1] for x in ret.fetchall() ]
-                
-                # check for primary entity field - this was added back in 0.12.x
-                if "primary_entity" not in field_names:
-                    c.executescript("""
-                        ALTER TABLE path_cache ADD COLUMN primary_entity integer;
-                        UPDATE path_cache SET primary_entity=1;
-        
-                        DROP INDEX IF EXISTS path_cache_path;
-                        CREATE INDEX IF NOT EXISTS path_cache_path ON path_cache(root, path, primary_entity);
-                        
-                        DROP INDEX IF EXISTS path_cache_all;
-                        CREATE UNIQUE INDEX IF NOT EXISTS path_cache_all ON path_cache(entity_type, entity_id, root, path, primary_entity);
-                        """)
+    def _complete_legacy_rows(self, cursor):
+        """
+        Fills in the storage root id and path hash for path_cache rows which 
+        only have a storage root name, as written by earlier core versions 
+        sharing the db. Must be called as part of a write transaction.
         
-                    self._connection.commit()
+        Rows which turn out to duplicate an existing row are removed, along with
+        their shotgun status records.
+        
+        :param cursor: Sqlite database cursor
+        """
+        for statement in ["""INSERT OR IGNORE INTO path_cache_root(name) 
+                             SELECT DISTINCT root FROM path_cache WHERE root_id IS NULL AND root IS NOT NULL""",
+                          """UPDATE OR IGNORE path_cache 
+                             SET root_id = (SELECT id FROM path_cache_root WHERE name = path_cache.root), 
+                                 path_hash = tk_path_hash(path) 
+                             WHERE root_id IS NULL AND root IS NOT NULL""",
+                          """UPDATE OR IGNORE path_cache 
+                             SET root = (SELECT name FROM path_cache_root WHERE id = path_cache.root_id), 
+                                 path_hash = tk_path_hash(path) 
+                             WHERE path_hash IS NULL""",
+                          """DELETE FROM shotgun_status WHERE path_cache_id IN 
+                             (SELECT rowid FROM path_cache WHERE root_id IS NULL OR path_hash IS NULL)""",
+                          """DELETE FROM path_cache WHERE root_id IS NULL OR path_hash IS NULL"""]:
+            cursor.execute(statement)
+
+    def _check_legacy_rows(self, cursor):
+        """
+        Completes any rows written to the path cache by earlier core 
+        versions since the db was last opened, see _complete_legacy_rows().
+        
+        :param cursor: Sqlite database cursor
+        """
+        # earlier core versions only write the storage root name, so look 
+        # for rows without a root id. This is an index lookup on path_cache_tree.
+        ret = cursor.execute("SELECT count(*) FROM (SELECT 1 FROM path_cache WHERE root_id IS NULL LIMIT 1)")
+        if ret.fetchone()[0] == 0:
+            return
         
+        self._connection.isolation_level = None
+        try:
+            self._begin_write(cursor)
+            try:
+                self._complete_legacy_rows(cursor)
+                cursor.execute("COMMIT")
+            except:
+                cursor.execute("ROLLBACK")
+                raise
         finally:
-            c.close()
+            self._connection.isolation_level = ""
         
+        self._invalidate_lookup_cache()
+
+    def _load_root_ids(self, cursor):
+        """
+        Loads the storage root name to id mappings from the path_cache_root table.
+        Any storage roots for the current project that are not yet in the database
+        are registered.
+        
+        :param cursor: Sqlite database cursor
+        """
+        res = cursor.execute("SELECT id, name FROM path_cache_root")
+        data = res.fetchall()
+        
+        registered_names = set([x[1] for x in data])
+        missing_names = [x for x in self._roots if x not in registered_names]
+        
+        if len(missing_names) > 0:
+            cursor.executemany("INSERT OR IGNORE INTO path_cache_root(name) VALUES(?)", 
+                               [(x, ) for x in missing_names])
+            self._connection.commit()
+            res = cursor.execute("SELECT id, name FROM path_cache_root")
+            data = res.fetchall()
+        
+        self._root_ids = {}
+        self._root_names = {}
+        for (root_id, root_name) in data:
+            self._root_ids[root_name] = root_id
+            self._root_names[root_id] = root_name
     
     def _get_path_cache_location(self):
+        """
+        Returns the location of the path cache file on disk. The location is 
+        resolved and the file created the first time this is called for a 
+        pipeline configuration object, which then remembers the location.
+        
+        :returns: The path to the path cache file
+        """
+        path = self._tk.pipeline_configuration.get_path_cache_location()
+        if path is None:
+            path = self._create_path_cache_location()
+            self._tk.pipeline_configuration.set_path_cache_location(path)
+        return path
+    
+    def _create_path_cache_location(self):
         """
         Creates the path cache file and returns its location on disk.
         
@@ -282,15 +1480,23 @@ class PathCache(object):
     ############################################################################################
     # shotgun synchronization (SG data pushed into path cache database)
 
-    def synchronize(self, log=None, full_sync=False):
+    @_instrumented
+    def synchronize(self, log=None, full_sync=False, before_write=False):
         """
         Ensure the local path cache is in sync with Shotgun. 
         
         If the method decides to do a full sync, it will attempt to 
         launch the busy overlay window.
         
+        While a folder sync agent is active, the sync is normally skipped. 
+        The agent only catches up with Shotgun every polling interval though, 
+        so when new folders are about to be validated against the path cache 
+        and written to it, the sync is carried out regardless.
+        
         :param log: Std python logger object.
         :param full_sync: Boolean to indicate that a full sync should be carried out. 
+        :param before_write: Boolean to indicate that folders are about to be 
+                             added to the path cache.
         
         :returns: A list of remote items which were detected, created remotely
                   and not existing in this path cache. These are returned as a list of 
@@ -300,102 +1506,187 @@ class PathCache(object):
                     - path
         """
         
-        if self._path_cache_disabled:
-            self._log_debug(log, "This project does not have any associated folders.")
-            return []        
-        
-        if not self._sync_with_sg:
-            self._log_debug(log, "Folder synchronization is turned off for this project.")
-            return []
-                
+        if self._path_cache_disabled:
+            self._log_debug(log, "This project does not have any associated folders.")
+            return []        
+        
+        if not self._sync_with_sg:
+            self._log_debug(log, "Folder synchronization is turned off for this project.")
+            return []
+                
+        c = self._connection.cursor()
+        
+        try:
+            if not full_sync and not before_write:
+                # if a sync agent is looking after this path cache, there is no need 
+                # for this process to check with shotgun. 
+                agent = self._get_sync_agent(c)
+                if agent:
+                    self._log_debug(log, "Path cache is kept up to date by the folder sync agent "
+                                         "running as process %s on %s. Skipping sync." % (agent["pid"], agent["host"]))
+                    return []
+            
+            return self._do_sync(c, log, full_sync)
+        
+        finally:       
+            c.close()
+
+    def _do_sync(self, cursor, log, full_sync):
+        """
+        Synchronizes the path cache with Shotgun, either incrementally or fully.
+        See synchronize() for details.
+        
+        :param cursor: Sqlite database cursor
+        :param log: Std python logger object.
+        :param full_sync: Boolean to indicate that a full sync should be carried out. 
+        :returns: A list of remote items which were detected, created remotely
+                  and not existing in this path cache.
+        """
+        # check if we should do a full sync
+        if full_sync:
+            return self._do_full_sync(cursor, log)
+        
+        # first get the last synchronized event log event.        
+        res = cursor.execute("SELECT max(last_id) FROM event_log_sync")
+        # get first item in the data set
+        data = list(res)[0]
+        
+        self._log_debug(log, "Path cache sync tracking marker in local sqlite db: %r" % data) 
+        
+        # expect back something like [(249660,)] for a running cache and [(None,)] for a clear
+        if len(data) != 1 or data[0] is None:
+            # we should do a full sync
+            return self._do_full_sync(cursor, log)
+
+        # we have an event log id - so check if there are any more recent events
+        event_log_id = data[0]
+        
+        project_link = {"type": "Project", 
+                        "id": self._tk.pipeline_configuration.get_project_id() }
+        
+        # note! We search for all events greater than the prev event_log_id-1.
+        # this way, the first record returned should be the last record that was 
+        # synced. This is a way of detecting that the event log chain is not broken.
+        # it could break for example if someone has culled the event log table and in 
+        # that case we should fall back on a full sync.
+        
+        self._log_debug(log, "Fetching folder event log entries...")
+        
+        response = self._tk.shotgun.find("EventLogEntry", 
+                                         [ ["event_type", "in", SG_FOLDER_EVENT_TYPES], 
+                                           ["id", "greater_than", (event_log_id - 1)],
+                                           ["project", "is", project_link] ],
+                                         ["id", "meta", "event_type"],
+                                         [{"field_name": "id", "direction": "asc"}] )   
+
+        self._log_debug(log, "Got %s event log entries" % len(response)) 
+    
+        # count creation, deletion and update entries
+        num_deletions = 0
+        num_creations = 0
+        num_updates = 0
+        for r in response:
+            if r["event_type"] == "Toolkit_Folders_Create":
+                num_creations += 1
+            if r["event_type"] == "Toolkit_Folders_Delete":
+                num_deletions += 1
+            if r["event_type"] == "Toolkit_Folders_Update":
+                num_updates += 1
+                
+        if len(response) == 0 or response[0]["id"] != event_log_id:
+            # there is either no event log data at all or a gap
+            # in the event log. Assume that some culling has occured and
+            # fall back on a full sync
+            self._log_debug(log, "Cannot align path cache track marker to SG Event Log. Doing Full Sync instead.")
+            return self._do_full_sync(cursor, log)        
+        
+        elif len(response) == 1 and response[0]["id"] == event_log_id:
+            # nothing has changed since the last sync
+            self._log_debug(log, "Path cache syncing not necessary - local folders already up to date!") 
+            return []
+        
+        elif num_creations > 0 or num_deletions > 0 or num_updates > 0:
+            # we have a complete trail of increments. 
+            # note that we skip the current entity.
+            return self._do_incremental_sync(cursor, log, response[1:])
+        
+        else:
+            # should never be here
+            raise Exception("Unknown error - please contact support.")
+
+    ############################################################################################
+    # sync agent support
+
+    def _get_sync_agent(self, cursor):
+        """
+        Returns details about the folder sync agent looking after this path cache.
+        An agent is considered active if it has polled Shotgun within 
+        SYNC_AGENT_GRACE_FACTOR times its polling interval.
+        
+        :param cursor: Sqlite database cursor
+        :returns: Dictionary with keys pid, host, interval and last_poll 
+                  or None if no agent is active.
+        """
+        res = cursor.execute("SELECT pid, host, interval, last_poll FROM sync_agent")
+        data = res.fetchone()
+        if data is None:
+            return None
+        
+        (pid, host, interval, last_poll) = data
+        if last_poll + interval * SYNC_AGENT_GRACE_FACTOR < time.time():
+            # agent has stopped polling
+            return None
+        
+        return {"pid": pid, "host": host, "interval": interval, "last_poll": last_poll}
+        
+    def sync_agent_poll(self, log, interval):
+        """
+        Synchronizes the path cache with Shotgun on behalf of a folder sync agent
+        and records the agent's heartbeat in the path cache. As long as the agent 
+        keeps polling at the given interval, other processes using this path cache 
+        will skip their own synchronization with Shotgun.
+        
+        :param log: Std python logger object.
+        :param interval: Number of seconds until the agent will poll again.
+        :returns: A list of remote items which were detected, see synchronize().
+        """
+        if self._path_cache_disabled or not self._sync_with_sg:
+            raise TankError("This project does not synchronize its folders with Shotgun!")
+        
         c = self._connection.cursor()
-        
         try:
-
-            # check if we should do a full sync
-            if full_sync:
-                return self._do_full_sync(c, log)
-            
-            # first get the last synchronized event log event.        
-            res = c.execute("SELECT max(last_id) FROM event_log_sync")
-            # get first item in the data set
-            data = list(res)[0]
+            data = self._do_sync(c, log, full_sync=False)
             
-            self._log_debug(log, "Path cache sync tracking marker in local sqlite db: %r" % data) 
-            
-            # expect back something like [(249660,)] for a running cache and [(None,)] for a clear
-            if len(data) != 1 or data[0] is None:
-                # we should do a full sync
-                return self._do_full_sync(c, log)
+            c.execute("DELETE FROM sync_agent")
+            c.execute("INSERT INTO sync_agent(pid, host, interval, last_poll) VALUES(?, ?, ?, ?)", 
+                      (os.getpid(), socket.gethostname(), interval, time.time()))
+            self._connection.commit()
+        finally:
+            c.close()
+        
+        return data
     
-            # we have an event log id - so check if there are any more recent events
-            event_log_id = data[0]
-            
-            project_link = {"type": "Project", 
-                            "id": self._tk.pipeline_configuration.get_project_id() }
-            
-            # note! We search for all events greater than the prev event_log_id-1.
-            # this way, the first record returned should be the last record that was 
-            # synced. This is a way of detecting that the event log chain is not broken.
-            # it could break for example if someone has culled the event log table and in 
-            # that case we should fall back on a full sync.
-            
-            self._log_debug(log, "Fetching folder event log entries...")
-            
-            response = self._tk.shotgun.find("EventLogEntry", 
-                                             [ ["event_type", "in", ["Toolkit_Folders_Create", 
-                                                                     "Toolkit_Folders_Delete"]], 
-                                               ["id", "greater_than", (event_log_id - 1)],
-                                               ["project", "is", project_link] ],
-                                             ["id", "meta", "event_type"],
-                                             [{"field_name": "id", "direction": "desc"}] )   
-
-            self._log_debug(log, "Got %s event log entries" % len(response)) 
-        
-            # count creation and deletion entries
-            num_deletions = 0
-            num_creations = 0
-            for r in response:
-                if r["event_type"] == "Toolkit_Folders_Create":
-                    num_creations += 1
-                if r["event_type"] == "Toolkit_Folders_Delete":
-                    num_deletions += 1
-                    
-            if len(response) == 0 or response[0]["id"] != event_log_id:
-                # there is either no event log data at all or a gap
-                # in the event log. Assume that some culling has occured and
-                # fall back on a full sync
-                self._log_debug(log, "Cannot align path cache track marker to SG Event Log. Doing Full Sync instead.")
-                return self._do_full_sync(c, log)        
-            
-            elif len(response) == 1 and response[0]["id"] == event_log_id:
-                # nothing has changed since the last sync
-                self._log_debug(log, "Path cache syncing not necessary - local folders already up to date!") 
-                return []
-            
-            elif num_deletions > 0:
-                # some stuff was deleted. fall back on full sync
-                self._log_debug(log, "Deletions detected, doing full sync") 
-
-                return self._do_full_sync(c, log)
-            
-            elif num_creations > 0:
-                # we have a complete trail of increments. 
-                # note that we skip the current entity.
-                return self._do_incremental_sync(c, log, response[1:])
-            
-            else:
-                # should never be here
-                raise Exception("Unknown error - please contact support.")
-
-        finally:       
+    def sync_agent_stop(self):
+        """
+        Removes the heartbeat of a folder sync agent from the path cache, meaning 
+        that processes will go back to synchronizing with Shotgun themselves.
+        """
+        if self._path_cache_disabled:
+            return
+        
+        c = self._connection.cursor()
+        try:
+            c.execute("DELETE FROM sync_agent")
+            self._connection.commit()
+        finally:
             c.close()
 
-    def _upload_cache_data_to_shotgun(self, data, event_log_desc, log=None):
+    def _upload_cache_data_to_shotgun(self, data, event_log_desc, log=None, num_threads=1, progress_callback=None):
         """
         Takes a standard chunk of Shotgun data and uploads it to Shotgun
-        using a single batch statement. Then writes a single event log entry record
-        which binds the created path records. Returns the id of this event log record.
+        using batch statements of at most SG_BATCH_SIZE items. Then writes a 
+        single event log entry record which binds the created path records. 
+        Returns the id of this event log record.
         
         data needs to be a list of dicts with the following keys:
         - entity - std sg entity dict with name, id and type
@@ -404,8 +1695,20 @@ class PathCache(object):
         - path - local os path
         - path_cache_row_id - the path cache db row id for the entry
         
+        If a batch fails after some of the records have already been created, 
+        the event log entry is written for the records created so far and an 
+        _IncompleteUploadError is raised, containing the event log id and the
+        row id lookup for those records. This allows the caller to keep the 
+        records which made it into Shotgun and a re-run to pick up where things 
+        left off. If the event log entry cannot be written, the created records 
+        are removed from Shotgun again.
+        
         :param data: List of dicts. See details above.
         :param event_log_desc: Description to add to the event log entry created.
+        :param log: Std python logger or None if logging is not required.
+        :param num_threads: Number of parallel Shotgun connections to use.
+        :param progress_callback: Optional method called with the number of records
+                                  uploaded so far and the total number of records.
         :returns: A tuple with (event_log_id, sg_id_lookup)
                   - event_log_id is the id for the event log entry which summarizes the 
                     creation event.
@@ -418,8 +1721,13 @@ class PathCache(object):
         
         project_link = {"type": "Project", 
                         "id": self._tk.pipeline_configuration.get_project_id() }
+        
+        current_user = get_current_user(self._tk)
     
         sg_batch_data = []
+        # map the created records back to path cache row ids. Note that several
+        # entities can be associated with a single path
+        rowid_lookup = {}
         for d in data:
                             
             # get a name for the clickable url in the path field
@@ -431,7 +1739,7 @@ class PathCache(object):
             req = {"request_type":"create", 
                    "entity_type": SHOTGUN_ENTITY, 
                    "data": {"project": project_link,
-                            "created_by": get_current_user(self._tk),
+                            "created_by": current_user,
                             SG_ENTITY_FIELD: d["entity"],
                             SG_IS_PRIMARY_FIELD: d["primary"],
                             SG_PIPELINE_CONFIG_FIELD: pc_link,
@@ -443,43 +1751,159 @@ class PathCache(object):
                             } }
             
             sg_batch_data.append(req)
+            rowid_lookup[(d["path"], d["entity"]["type"], d["entity"]["id"])] = d["path_cache_row_id"]
         
-        # push to shotgun in a single xact
         self._log_debug(log, "Uploading %s path entries to Shotgun..." % len(sg_batch_data))
         
-        try:    
-            response = self._tk.shotgun.batch(sg_batch_data)
-        except Exception, e:
-            raise TankError("Critical! Could not update Shotgun with folder "
-                            "data. Please contact support. Error details: %s" % e)
-        
-        # now create a dictionary where input path cache rowid (path_cache_row_id)
-        # is mapped to the shotgun ids that were just created
-        def _rowid_from_path(path):
-            for d in data:
-                if d["path"] == path:
-                    return d["path_cache_row_id"] 
-            raise TankError("Could not resolve row id for path! Please contact support! "
-                            "trying to resolve path '%s'. Source data set: %s" % (path, data))
+        # push to shotgun in chunks to keep each request at a reasonable size
+        (response, batch_error) = self._execute_sg_batches(sg_batch_data, log, num_threads, progress_callback)
         
         rowid_sgid_lookup = {}
+        created_sg_ids = []
         for sg_obj in response:
             sg_id = sg_obj["id"]
-            pc_row_id = _rowid_from_path( sg_obj[SG_PATH_FIELD]["local_path"] )
-            rowid_sgid_lookup[pc_row_id] = sg_id
+            created_sg_ids.append(sg_id)
+            key = (sg_obj[SG_PATH_FIELD]["local_path"], sg_obj[SG_ENTITY_TYPE_FIELD], sg_obj[SG_ENTITY_ID_FIELD])
+            if key not in rowid_lookup:
+                raise TankError("Could not resolve row id for path! Please contact support! "
+                                "trying to resolve path '%s'. Source data set: %s" % (key[0], data))
+            rowid_sgid_lookup[rowid_lookup[key]] = sg_id
+        
+        if batch_error and len(created_sg_ids) == 0:
+            # nothing was created - Shotgun is unchanged.
+            raise TankError("Critical! Could not update Shotgun with folder "
+                            "data. Please contact support. Error details: %s" % batch_error)
         
         # now register the created ids in the event log
         # this will later on be read by the synchronization            
-        # now, based on the entities we just created, assemble a metadata chunk that 
+        try:
+            event_log_id = self._create_folders_event(created_sg_ids, event_log_desc)
+        except TankError:
+            # without an event, other path caches won't pick up the records, so remove them
+            self._delete_sg_records(created_sg_ids, log)
+            raise
+        
+        if batch_error:
+            raise _IncompleteUploadError("Could not update Shotgun with all folder data. %s out "
+                                         "of %s records were created before the following error "
+                                         "occurred: %s. Please try again." % (len(created_sg_ids), 
+                                                                             len(sg_batch_data), 
+                                                                             batch_error), 
+                                         event_log_id, 
+                                         rowid_sgid_lookup)
+        
+        # return the event log id which represents this uploaded slab
+        return (event_log_id, rowid_sgid_lookup)
+
+    def _execute_sg_batches(self, sg_batch_data, log=None, num_threads=1, progress_callback=None):
+        """
+        Sends a list of batch requests to Shotgun in chunks of at most SG_BATCH_SIZE 
+        requests. With more than one thread, chunks are sent in parallel, each thread 
+        using its own Shotgun connection.
+        
+        If a chunk fails, no further chunks are started. Chunks already in 
+        flight are allowed to complete.
+        
+        :param sg_batch_data: List of Shotgun batch requests
+        :param log: Std python logger or None if logging is not required.
+        :param num_threads: Number of parallel Shotgun connections to use.
+        :param progress_callback: Optional method called with the number of requests
+                                  completed so far and the total number of requests.
+        :returns: Tuple (response, error). The response is the list of responses
+                  for all chunks which completed, in request order. The error is the 
+                  exception raised by the first failing chunk, or None if all chunks 
+                  completed.
+        """
+        chunks = [ sg_batch_data[idx:idx+SG_BATCH_SIZE] for idx in xrange(0, len(sg_batch_data), SG_BATCH_SIZE) ]
+        
+        chunk_queue = Queue.Queue()
+        for idx in range(len(chunks)):
+            chunk_queue.put(idx)
+        
+        responses = {}
+        errors = []
+        num_done = [0]
+        lock = threading.Lock()
+        
+        def _process_chunks():
+            while True:
+                lock.acquire()
+                try:
+                    if errors:
+                        return
+                finally:
+                    lock.release()
+                
+                try:
+                    idx = chunk_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                
+                try:
+                    # note - the tk shotgun connection is thread local
+                    response = self._tk.shotgun.batch(chunks[idx])
+                except Exception, e:
+                    lock.acquire()
+                    try:
+                        errors.append(e)
+                    finally:
+                        lock.release()
+                    return
+                
+                lock.acquire()
+                try:
+                    responses[idx] = response
+                    num_done[0] += len(chunks[idx])
+                    self._log_debug(log, "...%s/%s Shotgun requests processed." % (num_done[0], len(sg_batch_data)))
+                    if progress_callback:
+                        progress_callback(num_done[0], len(sg_batch_data))
+                finally:
+                    lock.release()
+        
+        num_threads = min(num_threads, len(chunks))
+        if num_threads <= 1:
+            _process_chunks()
+        else:
+            threads = [ threading.Thread(target=_process_chunks) for x in range(num_threads) ]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        
+        response = []
+        for idx in sorted(responses.keys()):
+            response.extend(responses[idx])
+        
+        if errors:
+            return (response, errors[0])
+        return (response, None)
+
+    def _create_folders_event(self, sg_ids, event_log_desc, event_type="Toolkit_Folders_Create"):
+        """
+        Writes a Toolkit_Folders_Create event log entry announcing a list
+        of created FilesystemLocation records.
+        
+        :param sg_ids: List of FilesystemLocation ids that were created
+        :param event_log_desc: Description to add to the event log entry created.
+        :param event_type: Type of event to write, one of SG_FOLDER_EVENT_TYPES.
+        :returns: The id of the event log entry
+        """
+        pc_link = {"type": "PipelineConfiguration",
+                   "id": self._tk.pipeline_configuration.get_shotgun_id() }
+        
+        project_link = {"type": "Project", 
+                        "id": self._tk.pipeline_configuration.get_project_id() }
+        
+        # based on the entities we just created, assemble a metadata chunk that 
         # the sync calls can use later on.
         meta = {}
         # the api version used is always useful to know
         meta["core_api_version"] = self._tk.version
-        # shotgun ids created
-        meta["sg_folder_ids"] = [ x["id"] for x in response]
+        # shotgun ids created, deleted or updated
+        meta["sg_folder_ids"] = sg_ids
         
         sg_event_data = {}
-        sg_event_data["event_type"] = "Toolkit_Folders_Create"
+        sg_event_data["event_type"] = event_type
         sg_event_data["description"] = "Toolkit %s: %s" % (self._tk.version, event_log_desc)
         sg_event_data["project"] = project_link
         sg_event_data["entity"] = pc_link
@@ -492,8 +1916,29 @@ class PathCache(object):
             raise TankError("Critical! Could not update Shotgun with folder data event log "
                             "history marker. Please contact support. Error details: %s" % e)            
         
-        # return the event log id which represents this uploaded slab
-        return (response["id"], rowid_sgid_lookup)
+        return response["id"]
+
+    def _delete_sg_records(self, sg_ids, log=None):
+        """
+        Removes FilesystemLocation records from Shotgun. This is used to roll back
+        records which could not be registered in the event log.
+        
+        :param sg_ids: List of FilesystemLocation ids to delete
+        :param log: Std python logger or None if logging is not required.
+        """
+        self._log_debug(log, "Removing %s path entries from Shotgun..." % len(sg_ids))
+        
+        for idx in xrange(0, len(sg_ids), SG_BATCH_SIZE):
+            chunk = sg_ids[idx:idx+SG_BATCH_SIZE]
+            sg_batch_data = [ {"request_type": "delete", 
+                               "entity_type": SHOTGUN_ENTITY, 
+                               "entity_id": sg_id} for sg_id in chunk ]
+            try:
+                self._tk.shotgun.batch(sg_batch_data)
+            except Exception, e:
+                raise TankError("Critical! Could not remove folder data from Shotgun after a failed "
+                                "upload. Please contact support. The following %s records need to be "
+                                "removed: %s. Error details: %s" % (SHOTGUN_ENTITY, sg_ids[idx:], e))
 
 
     def _do_full_sync(self, cursor, log):
@@ -520,7 +1965,7 @@ class PathCache(object):
             
             # find the max event log id. we will store this in the sync db later.
             sg_data = self._tk.shotgun.find_one("EventLogEntry", 
-                                                [["event_type", "in", ["Toolkit_Folders_Create", "Toolkit_Folders_Delete"]]], 
+                                                [["event_type", "in", SG_FOLDER_EVENT_TYPES]], 
                                                 ["id"], 
                                                 [{"field_name": "id", "direction": "desc"}])
     
@@ -545,7 +1990,8 @@ class PathCache(object):
         
         Assumptions:
         - sg_data list always contains some entries
-        - sg_data list only contains Toolkit_Folders_Create records
+        - sg_data list only contains Toolkit_Folders_Create, 
+          Toolkit_Folders_Delete and Toolkit_Folders_Update records
         
         This is a list of dicts ordered by id from low to high (old to new), 
         each with keys
@@ -559,6 +2005,11 @@ class PathCache(object):
                   'sg_folder_ids': [123, 124, 125, 126, 127, 128, 129, 130, 131, 132, 133]}, 
          'type': 'EventLogEntry', 
          'id': 249240}
+         
+        Deletion and update events carry the same sg_folder_ids list. Deletion
+        events written by the unregister_folders command in more recent cores 
+        also carry a sg_folders list describing each of the removed records - 
+        see _remove_db_mappings for details.
         
         :param cursor: Sqlite database cursor
         :param log: Std python logger or None if logging is not required. 
@@ -578,30 +2029,119 @@ class PathCache(object):
         max_event_log_id = max( [x["id"] for x in sg_data] )
         
         created_folder_ids = []
+        deleted_folder_ids = set()
+        deleted_folder_records = {}
         for d in sg_data:
             if d["event_type"] == "Toolkit_Folders_Create":
                 # this is a creation request! Replay it on our database
                 created_folder_ids.extend( d["meta"]["sg_folder_ids"] )
+            
+            elif d["event_type"] == "Toolkit_Folders_Delete":
+                # this is a deletion request. Shotgun ids are never reused, so 
+                # it is safe to collect them all up and process them in one go,
+                # ahead of the creation events. Records may have been updated 
+                # since, so only creations which precede the deletion are dropped. 
+                deleted_ids = set(d["meta"]["sg_folder_ids"])
+                created_folder_ids = [x for x in created_folder_ids if x not in deleted_ids]
+                deleted_folder_ids.update(deleted_ids)
+                for record in d["meta"].get("sg_folders", []):
+                    deleted_folder_records[ record["id"] ] = record
+            
+            elif d["event_type"] == "Toolkit_Folders_Update":
+                # records which have been updated in Shotgun are replaced, by 
+                # removing the local copies and replaying the records again.
+                updated_ids = set(d["meta"]["sg_folder_ids"])
+                created_folder_ids = [x for x in created_folder_ids if x not in updated_ids]
+                created_folder_ids.extend(d["meta"]["sg_folder_ids"])
+                deleted_folder_ids.update(updated_ids)
+                 
             else:
                 # should never come here
                 raise Exception("Unsupported event type '%s'" % d)
+        
+        if len(deleted_folder_ids) > 0:
+            self._log_debug(log, "Updating folders - Removing %s entries..." % len(deleted_folder_ids))
+            self._remove_db_mappings(cursor, log, deleted_folder_ids, deleted_folder_records)
                 
         if len(created_folder_ids) == 0:
-            # one or more folder creation events were detected but none of them had actually
-            # resulted in any actual folders being created!
+            # either only deletions were detected or one or more folder creation events 
+            # were detected but none of them had actually resulted in any actual folders 
+            # being created! Just move the sync marker forward.
+            cursor.execute("DELETE FROM event_log_sync")
+            cursor.execute("INSERT INTO event_log_sync(last_id) VALUES(?)", (max_event_log_id, ))
+            self._connection.commit()
+            self._invalidate_lookup_cache()
             return []
                 
         self._log_debug(log, "Updating folders - Applying %s updates..." % len(created_folder_ids)) 
 
         return self._replay_folder_entities(cursor, log, max_event_log_id, created_folder_ids)
 
+    def _remove_db_mappings(self, cursor, log, sg_ids, sg_records):
+        """
+        Removes the path cache entries associated with a list of deleted 
+        FilesystemLocation records. This is the incremental counterpart of 
+        the unregister_folders command.
+        
+        Entries are primarily resolved via the shotgun_status table, which binds
+        each path cache row to the Shotgun record it was pushed to or pulled from.
+        For any ids that cannot be resolved this way, the optional record 
+        descriptions from the event log metadata are used. These are dictionaries
+        with keys id, entity_type, entity_id, root and path, where root is the 
+        storage name and path the storage relative db path. Only rows which are
+        not bound to any other Shotgun record are removed in this case.
+        
+        The changes are not committed. 
+        
+        :param cursor: Sqlite database cursor
+        :param log: Std python logger or None if logging is not required.
+        :param sg_ids: Shotgun FilesystemLocation ids that have been deleted
+        :param sg_records: Dictionary of record descriptions, keyed by shotgun id.
+        """
+        sg_ids = list(sg_ids)
+        resolved_ids = set()
+        
+        # process in chunks to stay clear of the sqlite host parameter limit
+        for idx in xrange(0, len(sg_ids), SQLITE_MAX_PARAMETERS):
+            chunk = sg_ids[idx:idx+SQLITE_MAX_PARAMETERS]
+            placeholders = ",".join(["?"] * len(chunk))
+            
+            res = cursor.execute("SELECT shotgun_id FROM shotgun_status "
+                                 "WHERE shotgun_id IN (%s)" % placeholders, chunk)
+            resolved_ids.update([x[0] for x in res.fetchall()])
+            
+            cursor.execute("DELETE FROM path_cache WHERE rowid IN "
+                           "(SELECT path_cache_id FROM shotgun_status "
+                           " WHERE shotgun_id IN (%s))" % placeholders, chunk)
+            cursor.execute("DELETE FROM shotgun_status WHERE shotgun_id IN (%s)" % placeholders, chunk)
+        
+        for sg_id in sg_ids:
+            if sg_id in resolved_ids:
+                continue
+            
+            record = sg_records.get(sg_id)
+            if record is None:
+                # this record was never part of our path cache
+                self._log_debug(log, "Deleted folder id %s not in local path cache. Skipping." % sg_id)
+                continue
+            
+            root_id = self._root_ids.get(record["root"])
+            if root_id is None:
+                # storage not known to this path cache, so it cannot hold the entry
+                self._log_debug(log, "Deleted folder id %s has an unknown storage. Skipping." % sg_id)
+                continue
+            
+            cursor.execute("""DELETE FROM path_cache 
+                              WHERE entity_type = ? AND entity_id = ? AND root_id = ? AND path = ? 
+                              AND rowid NOT IN (SELECT path_cache_id FROM shotgun_status)""", 
+                           (record["entity_type"], record["entity_id"], root_id, record["path"]))
 
     def _replay_folder_entities(self, cursor, log, max_event_log_id, ids=None):
         """
         Does the actual download from shotgun and pushes those changes
         to the path cache. If ids is None, this indicates a full sync, and 
-        the path cache db table is cleared first. If not, the table
-        is appended to.
+        the path cache contents are replaced, see _rebuild_db(). If not, 
+        the tables are appended to.
 
         :param cursor: Sqlite database cursor
         :param log: Std python logger or None if logging is not required. 
@@ -647,15 +2187,143 @@ class PathCache(object):
                                   [{"field_name": "id", "direction": "asc"},])
         
         self._log_debug(log, "...Retrieved %s records." % len(sg_data))        
-            
-        # now start a single transaction in which we do all our work
+        
         if ids is None:
-            # complete sync - clear our tables first
+            # complete sync - replace all contents
+            return_data = self._rebuild_db(cursor, log, max_event_log_id, sg_data)
+        
+        else:
+            return_data = self._insert_sg_records(cursor, log, sg_data)
+            
+            # lastly, id of this event log entry for purpose of future syncing
+            # note - we don't maintain a list of event log entries but just a single
+            # value in the db, so start by clearing the table.
             cursor.execute("DELETE FROM event_log_sync")
-            cursor.execute("DELETE FROM shotgun_status")
-            cursor.execute("DELETE FROM path_cache")
+            cursor.execute("INSERT INTO event_log_sync(last_id) VALUES(?)", (max_event_log_id, ))
+            self._connection.commit()
+        
+        self._invalidate_lookup_cache()
+
+        return return_data
+    
+    def _rebuild_db(self, cursor, log, max_event_log_id, sg_data):
+        """
+        Replaces the contents of the path cache with a set of FilesystemLocation
+        records. The new tables are built in a separate shadow db, while other 
+        processes keep using the current path cache. Once done, the data is copied
+        across in a single transaction.
+        
+        :param cursor: Sqlite database cursor
+        :param log: Std python logger or None if logging is not required. 
+        :param max_event_log_id: Event log id the records are current with
+        :param sg_data: List of FilesystemLocation dictionaries
+        :returns: A list of items that were added to the path cache, see _insert_sg_records()
+        """
+        shadow_file = self._create_shadow_file(".sync")
+        try:
+            shadow = self._connect(shadow_file)
+            try:
+                c = shadow.cursor()
+                try:
+                    c.executescript(PATH_CACHE_TABLES)
+                    # storage root ids must match the ones in the path cache
+                    c.executemany("INSERT INTO path_cache_root(id, name) VALUES(?, ?)", self._root_names.items())
+                    c.execute(MAPPING_INPUT_TABLE)
+                    return_data = self._insert_sg_records(c, log, sg_data)
+                    shadow.commit()
+                finally:
+                    c.close()
+            finally:
+                shadow.close()
             
+            self._log_debug(log, "Replacing path cache contents...")
+            self._copy_from_shadow_db(cursor, shadow_file,
+                                      ["""DELETE FROM main.shotgun_status""",
+                                       """DELETE FROM main.path_cache""",
+                                       """DELETE FROM main.event_log_sync""",
+                                       """INSERT INTO main.path_cache(rowid, entity_type, entity_id, entity_name, 
+                                                                      root, root_id, path, path_hash, primary_entity)
+                                          SELECT rowid, entity_type, entity_id, entity_name, 
+                                                 root, root_id, path, path_hash, primary_entity 
+                                          FROM shadow.path_cache""",
+                                       """INSERT INTO main.shotgun_status(path_cache_id, shotgun_id)
+                                          SELECT path_cache_id, shotgun_id FROM shadow.shotgun_status""",
+                                       ("""INSERT INTO main.event_log_sync(last_id) VALUES(?)""", (max_event_log_id, ))])
+        finally:
+            if os.path.exists(shadow_file):
+                os.remove(shadow_file)
+        
+        return return_data
+    
+    def _create_shadow_file(self, suffix):
+        """
+        Creates an empty, uniquely named shadow db file next to the path cache. 
+        Several processes can be rebuilding the same path cache at the same time,
+        so each of them needs its own file. The caller is responsible for 
+        removing the file once done.
+        
+        :param suffix: File name suffix describing the purpose of the file
+        :returns: Path to the shadow db file
+        """
+        (fd, shadow_file) = tempfile.mkstemp(prefix="%s." % os.path.basename(self._path_cache_file),
+                                             suffix=suffix,
+                                             dir=os.path.dirname(self._path_cache_file))
+        os.close(fd)
+        return shadow_file
+    
+    def _copy_from_shadow_db(self, cursor, shadow_file, statements):
+        """
+        Attaches a shadow db to the path cache connection as 'shadow' and runs
+        a list of statements in a single write transaction.
+        
+        This is used instead of renaming the shadow db over the path cache file.
+        Other processes keep their connections to the path cache open and would
+        carry on using the previous file, and for dbs in write-ahead log mode, 
+        the new file would be paired with the previous log file. 
+        
+        :param cursor: Sqlite database cursor
+        :param shadow_file: Path to the shadow db
+        :param statements: List of sql statements, or (statement, parameters) tuples
+        """
+        self._connection.commit()
+        self._connection.isolation_level = None
+        try:
+            cursor.execute("ATTACH DATABASE ? AS shadow", (shadow_file, ))
+            try:
+                self._begin_write(cursor)
+                try:
+                    for statement in statements:
+                        if isinstance(statement, tuple):
+                            cursor.execute(*statement)
+                        else:
+                            cursor.execute(statement)
+                    cursor.execute("COMMIT")
+                except:
+                    cursor.execute("ROLLBACK")
+                    raise
+            finally:
+                cursor.execute("DETACH DATABASE shadow")
+        finally:
+            self._connection.isolation_level = ""
+    
+    def _insert_sg_records(self, cursor, log, sg_data):
+        """
+        Adds FilesystemLocation records to the path cache, skipping records
+        that already exist. Changes are not committed.
+        
+        :param cursor: Sqlite database cursor
+        :param log: Std python logger or None if logging is not required. 
+        :param sg_data: List of FilesystemLocation dictionaries
+        :returns: A list of remote items which were added to the path cache. 
+                  These are returned as a list of dictionaries, each containing keys:
+                    - entity
+                    - metadata 
+                    - path
+        """
         return_data = []
+        
+        # list of (shotgun id, mapping) for all valid records
+        sg_mappings = []
             
         for x in sg_data:
             
@@ -719,44 +2387,226 @@ class PathCache(object):
                 self._log_debug(log, "No local os path associated with entry for %s. Skipping." % entity)
                 continue
             
-            new_rowid = self._add_db_mapping(cursor, local_os_path, entity, is_primary)
+            sg_mappings.append( (x["id"], {"entity": entity, "path": local_os_path, "primary": is_primary}) )
+        
+        # now insert all records in one go
+        new_rowids = self._add_db_mappings(cursor, [m for (_, m) in sg_mappings])
+        
+        sg_status_rows = []
+        for ((sg_id, mapping), new_rowid) in zip(sg_mappings, new_rowids):
             if new_rowid:
                 # something was inserted into the db!
                 # because this record came from shotgun, insert a record in the
                 # shotgun_status table to indicate that this record exists in sg
-                cursor.execute("INSERT INTO shotgun_status(path_cache_id, shotgun_id) "
-                               "VALUES(?, ?)", (new_rowid, x["id"]) )
+                sg_status_rows.append( (new_rowid, sg_id) )
             
                 # and add this entry to our list of new things that we will return later on.
-                return_data.append({"entity": entity, 
-                                    "path": local_os_path, 
+                return_data.append({"entity": mapping["entity"], 
+                                    "path": mapping["path"], 
                                     "metadata": SG_METADATA_FIELD})
             
             else:
                 # Note: edge case - for some reason there was already an entry in the path cache
                 # representing this. This could be because of duplicate entries and is
                 # not necessarily an anomaly.
-                self._log_debug(log, "Found existing record for '%s', %s. Skipping." % (local_os_path, entity))
-                pass  
-            
-        # lastly, id of this event log entry for purpose of future syncing
-        # note - we don't maintain a list of event log entries but just a single
-        # value in the db, so start by clearing the table.
-        cursor.execute("DELETE FROM event_log_sync")
-        cursor.execute("INSERT INTO event_log_sync(last_id) VALUES(?)", (max_event_log_id, ))
-            
-        self._connection.commit()
+                self._log_debug(log, "Found existing record for '%s', %s. Skipping." % (mapping["path"], 
+                                                                                      mapping["entity"]))
+        
+        cursor.executemany("INSERT INTO shotgun_status(path_cache_id, shotgun_id) "
+                           "VALUES(?, ?)", sg_status_rows)
 
         return return_data
 
+    ############################################################################################
+    # snapshots
+
+    def export_snapshot(self, snapshot_file):
+        """
+        Writes the contents of the path cache to a snapshot file which can be used
+        to bootstrap the path cache on another machine without having to download
+        all folder data from Shotgun.
+        
+        The snapshot is a gzipped file holding a json header line followed by 
+        one json line per record, sorted by storage root and path. The header 
+        contains the event log marker of the path cache.
+        
+        :param snapshot_file: Path to the snapshot file to write
+        :returns: The number of records written
+        """
+        if self._path_cache_disabled or not self._sync_with_sg:
+            raise TankError("This project does not synchronize its folders with Shotgun!")
+        
+        c = self._connection.cursor()
+        try:
+            # read the marker before the records. Should another process sync
+            # in between, the snapshot may contain changes from after the marker,
+            # which are skipped when the events are replayed after the import.
+            res = c.execute("SELECT max(last_id) FROM event_log_sync")
+            event_log_id = res.fetchone()[0]
+            if event_log_id is None:
+                raise TankError("The path cache has not been synchronized with Shotgun yet!")
+            
+            header = {"format": SNAPSHOT_FORMAT,
+                      "version": SNAPSHOT_VERSION,
+                      "event_log_id": event_log_id,
+                      "project_id": self._tk.pipeline_configuration.get_project_id(),
+                      "core_api_version": self._tk.version }
+            
+            res = c.execute("""SELECT r.name, pc.path, pc.entity_type, pc.entity_id, pc.entity_name, 
+                                      pc.primary_entity, ss.shotgun_id 
+                               FROM path_cache pc 
+                               JOIN path_cache_root r ON r.id = pc.root_id
+                               LEFT JOIN shotgun_status ss ON ss.path_cache_id = pc.rowid
+                               ORDER BY r.name, pc.path, pc.entity_type, pc.entity_id, pc.primary_entity""")
+            
+            num_records = 0
+            fh = gzip.GzipFile(snapshot_file, "wb")
+            try:
+                fh.write("%s\n" % json.dumps(header))
+                for row in res:
+                    fh.write("%s\n" % json.dumps(row))
+                    num_records += 1
+            finally:
+                fh.close()
+        finally:
+            c.close()
+        
+        return num_records
+    
+    def _read_snapshot(self, snapshot_file):
+        """
+        Reads a snapshot file written by export_snapshot().
+        
+        :param snapshot_file: Path to the snapshot file
+        :returns: Tuple with the header dictionary and a generator yielding 
+                  records in the form (root, path, entity_type, entity_id, 
+                  entity_name, primary_entity, shotgun_id)
+        """
+        fh = gzip.GzipFile(snapshot_file, "rb")
+        try:
+            header = json.loads(fh.readline())
+        except Exception, e:
+            fh.close()
+            raise TankError("Could not read path cache snapshot '%s': %s" % (snapshot_file, e))
+        
+        if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT:
+            fh.close()
+            raise TankError("'%s' is not a path cache snapshot!" % snapshot_file)
+        
+        if header.get("version") != SNAPSHOT_VERSION:
+            fh.close()
+            raise TankError("Path cache snapshot '%s' uses format version %s. This version of "
+                            "Toolkit only supports version %s." % (snapshot_file, header.get("version"), SNAPSHOT_VERSION))
+        
+        def _records():
+            try:
+                for line in fh:
+                    (root, path, entity_type, entity_id, entity_name, primary_entity, shotgun_id) = json.loads(line)
+                    yield (root, path, entity_type, entity_id, entity_name, primary_entity, shotgun_id)
+            finally:
+                fh.close()
+        
+        return (header, _records())
+    
+    def import_snapshot(self, snapshot_file, log=None):
+        """
+        Replaces the contents of the path cache with the data in a snapshot
+        written by export_snapshot(). Subsequent syncs pick up from the event log
+        marker stored in the snapshot.
+        
+        The snapshot is first loaded into a separate shadow db next to the path cache,
+        so that a corrupt snapshot never affects the path cache. The data is then 
+        copied across in a single transaction. Other processes either see the 
+        previous or the imported data.
+        
+        :param snapshot_file: Path to the snapshot file to import
+        :param log: Std python logger object.
+        :returns: The number of records imported
+        """
+        if self._path_cache_disabled or not self._sync_with_sg:
+            raise TankError("This project does not synchronize its folders with Shotgun!")
+        
+        (header, records) = self._read_snapshot(snapshot_file)
+        
+        project_id = self._tk.pipeline_configuration.get_project_id()
+        if header.get("project_id") != project_id:
+            raise TankError("Path cache snapshot '%s' was exported from project id %s and cannot be "
+                            "imported into project id %s!" % (snapshot_file, header.get("project_id"), project_id))
+        
+        shadow_file = self._create_shadow_file(".import")
+        try:
+            # phase 1 - load the snapshot into the shadow db
+            self._log_debug(log, "Loading snapshot '%s'..." % snapshot_file)
+            shadow = self._connect(shadow_file)
+            try:
+                shadow.execute("""CREATE TABLE snapshot (root text, path text, path_hash integer, entity_type text, 
+                                                         entity_id integer, entity_name text, primary_entity integer, 
+                                                         shotgun_id integer)""")
+                try:
+                    shadow.executemany("""INSERT INTO snapshot(root, path, path_hash, entity_type, entity_id, 
+                                                               entity_name, primary_entity, shotgun_id) 
+                                          VALUES(?, ?, tk_path_hash(?), ?, ?, ?, ?, ?)""",
+                                       ((x[0], x[1], x[1]) + x[2:] for x in records))
+                except Exception, e:
+                    raise TankError("Could not read path cache snapshot '%s': %s" % (snapshot_file, e))
+                shadow.commit()
+            finally:
+                shadow.close()
+            
+            # phase 2 - replace the path cache contents in a single transaction
+            self._log_debug(log, "Replacing path cache contents...")
+            c = self._connection.cursor()
+            try:
+                self._copy_from_shadow_db(c, shadow_file, 
+                                          ["""DELETE FROM main.shotgun_status""",
+                                           """DELETE FROM main.path_cache""",
+                                           """DELETE FROM main.event_log_sync""",
+                                           """INSERT OR IGNORE INTO main.path_cache_root(name) 
+                                              SELECT DISTINCT root FROM shadow.snapshot""",
+                                           """INSERT INTO main.path_cache(rowid, entity_type, entity_id, entity_name, 
+                                                                          root, root_id, path, path_hash, primary_entity)
+                                              SELECT s.rowid, s.entity_type, s.entity_id, s.entity_name, 
+                                                     r.name, r.id, s.path, s.path_hash, s.primary_entity
+                                              FROM shadow.snapshot s JOIN main.path_cache_root r ON r.name = s.root""",
+                                           """INSERT INTO main.shotgun_status(path_cache_id, shotgun_id)
+                                              SELECT rowid, shotgun_id FROM shadow.snapshot 
+                                              WHERE shotgun_id IS NOT NULL""",
+                                           ("""INSERT INTO main.event_log_sync(last_id) VALUES(?)""", 
+                                            (header["event_log_id"], ))])
+                res = c.execute("SELECT count(*) FROM path_cache")
+                num_records = res.fetchone()[0]
+            except sqlite3.IntegrityError, e:
+                raise TankError("Path cache snapshot '%s' contains duplicate records: %s" % (snapshot_file, e))
+            finally:
+                c.close()
+        
+        finally:
+            if os.path.exists(shadow_file):
+                os.remove(shadow_file)
+        
+        # new storage roots may have been registered
+        c = self._connection.cursor()
+        try:
+            self._load_root_ids(c)
+        finally:
+            c.close()
+        self._invalidate_lookup_cache()
+        
+        return num_records
+
     ############################################################################################
     # pre-insertion validation
 
+    @_instrumented
     def validate_mappings(self, data):
         """
         Checks a series of path mappings to ensure that they don't conflict with
         existing path cache data.
         
+        The whole batch is checked against the database using a couple of set based
+        queries rather than per-item lookups. If several items are in conflict, the 
+        error for the first one in the list is raised.
+        
         :param data: list of dictionaries. Each dictionary should contain 
                      the following keys:
                       - entity: a dictionary with keys name, id and type
@@ -764,47 +2614,69 @@ class PathCache(object):
                       - primary: a boolean indicating if this is a primary entry
                       - metadata: configuration metadata
         """
-        for d in data:
-            self._validate_mapping(d["path"], d["entity"], d["primary"])
+        if self._path_cache_disabled:
+            # nothing to validate against
+            return
+        
+        # we only check primary items - for secondary items, multiple items can exist
+        primary_items = [d for d in data if d["primary"]]
+        if len(primary_items) == 0:
+            return
         
+        c = self._connection.cursor()
+        try:
+            (keys, _) = self._load_mapping_input(c, primary_items)
+            (entities_by_path, paths_by_entity) = self._get_mapping_input_conflicts(c)
+        finally:
+            # validation is read only - don't leave the temp table load hanging 
+            # around as an open transaction
+            self._connection.rollback()
+            c.close()
+        
+        for (d, key) in zip(primary_items, keys):
+            self._validate_mapping(d["path"], 
+                                   d["entity"], 
+                                   entities_by_path.get(key, []),
+                                   paths_by_entity.get((d["entity"]["type"], d["entity"]["id"]), []))
         
-    def _validate_mapping(self, path, entity, is_primary):
+        
+    def _validate_mapping(self, path, entity, entities_in_db, paths_in_db):
         """
-        Consistency checks happening prior to folder creation. May raise a TankError
-        if an inconsistency is detected.
+        Consistency checks happening prior to folder creation for a primary mapping. 
+        May raise a TankError if an inconsistency is detected.
         
         :param path: The path calculated
         :param entity: Sg entity dict with keys id, type and name
-        :param is_primary: indicates that this is a primary mapping - each folder may have
-                           both primary and secondary entity associations - the secondary
-                           being more loosely tied to the path.
+        :param entities_in_db: List of primary entities currently associated with the path
+        :param paths_in_db: List of paths currently associated with the entity
         """
         
         # Make sure that there isn't already a record with the same
         # name in the database and file system, but with a different id.
-        # We only do this for primary items - for secondary items, multiple items can exist
-        if is_primary:
-            entity_in_db = self.get_entity(path)
-            
-            if entity_in_db is not None:
-                if entity_in_db["id"] != entity["id"] or entity_in_db["type"] != entity["type"]:
-                    
-                    # there is already a record in the database for this path,
-                    # but associated with another entity! Display an error message
-                    # and ask that the user investigates using special tank commands.
-                    #
-                    # Note! We are only comparing against the type and the id
-                    # not against the name. It should be perfectly valid to rename something
-                    # in shotgun and if folders are then recreated for that item, nothing happens
-                    # because there is already a folder which represents that item. (although now with 
-                    # an incorrect name)
+        if len(entities_in_db) > 1:
+            # never supposed to happen!
+            raise TankError("More than one entry in path database for %s!" % path)
+        
+        if len(entities_in_db) == 1:
+            entity_in_db = entities_in_db[0]
+            if entity_in_db["id"] != entity["id"] or entity_in_db["type"] != entity["type"]:
+                
+                # there is already a record in the database for this path,
+                # but associated with another entity! Display an error message
+                # and ask that the user investigates using special tank commands.
+                #
+                # Note! We are only comparing against the type and the id
+                # not against the name. It should be perfectly valid to rename something
+                # in shotgun and if folders are then recreated for that item, nothing happens
+                # because there is already a folder which represents that item. (although now with 
+                # an incorrect name)
 
-                    msg  = "The path '%s' cannot be processed because it is already associated " % path
-                    msg += "with %s '%s' (id %s) in Shotgun. " % (entity_in_db["type"], entity_in_db["name"], entity_in_db["id"])
-                    msg += "You are now trying to associate it with %s '%s' (id %s). " % (entity["type"], entity["name"], entity["id"])
-                    msg += "If you want to unregister your previously created folders, you can run "
-                    msg += "the following command: 'tank %s %s unregister_folders' " % (entity_in_db["type"], entity_in_db["name"])
-                    raise TankError(msg)
+                msg  = "The path '%s' cannot be processed because it is already associated " % path
+                msg += "with %s '%s' (id %s) in Shotgun. " % (entity_in_db["type"], entity_in_db["name"], entity_in_db["id"])
+                msg += "You are now trying to associate it with %s '%s' (id %s). " % (entity["type"], entity["name"], entity["id"])
+                msg += "If you want to unregister your previously created folders, you can run "
+                msg += "the following command: 'tank %s %s unregister_folders' " % (entity_in_db["type"], entity_in_db["name"])
+                raise TankError(msg)
                 
         # Check 2. Check if a folder for this shot has already been created,
         # but with another name. This can happen if someone
@@ -818,28 +2690,116 @@ class PathCache(object):
         #
         # we only check for primary entities, doing the check for secondary
         # would only be to carry out the same check twice.
-        if is_primary:
-            for p in self.get_paths(entity["type"], entity["id"], primary_only=False):
-                # so we got a path that matches our entity
-                if p != path and os.path.dirname(p) == os.path.dirname(path):
-                    # this path is identical to our path we are about to create except for the name. 
-                    # there is still a folder on disk. Abort folder creation
-                    # with a descriptive error message
-                    msg  = "The path '%s' cannot be created because another " % path
-                    msg += "path '%s' is already associated with %s %s. " % (p, entity["type"], entity["name"])
-                    msg += "This typically happens if an item in Shotgun is renamed or "
-                    msg += "if the path naming in the folder creation configuration "
-                    msg += "is changed. In order to continue you can either change "
-                    msg += "the %s back to its previous name or you can unregister " % entity["type"]
-                    msg += "the currently associated folders by running the following command: "
-                    msg += "'tank %s %s unregister_folders' and then try again." % (entity["type"], entity["name"])                    
-                    raise TankError(msg)
+        for p in paths_in_db:
+            # so we got a path that matches our entity
+            if p != path and os.path.dirname(p) == os.path.dirname(path):
+                # this path is identical to our path we are about to create except for the name. 
+                # there is still a folder on disk. Abort folder creation
+                # with a descriptive error message
+                msg  = "The path '%s' cannot be created because another " % path
+                msg += "path '%s' is already associated with %s %s. " % (p, entity["type"], entity["name"])
+                msg += "This typically happens if an item in Shotgun is renamed or "
+                msg += "if the path naming in the folder creation configuration "
+                msg += "is changed. In order to continue you can either change "
+                msg += "the %s back to its previous name or you can unregister " % entity["type"]
+                msg += "the currently associated folders by running the following command: "
+                msg += "'tank %s %s unregister_folders' and then try again." % (entity["type"], entity["name"])                    
+                raise TankError(msg)
+
+    def _load_mapping_input(self, cursor, data):
+        """
+        Loads a list of mappings into the mapping_input temp table so that they 
+        can be matched against the path cache with joins. The temp table is 
+        cleared first. 
+        
+        If a path cannot be resolved into a storage, it is loaded without a
+        storage and path, meaning that it will only match on its entity.
+        
+        :param cursor: Sqlite database cursor
+        :param data: list of dictionaries with keys entity, path and primary
+        :returns: tuple with two lists, each with one item per input item. The first
+                  list holds the (root_id, db_path) key for each item, or None if its 
+                  path could not be resolved. The second one holds the TankError 
+                  raised when resolving the path, or None if it was resolved.
+        """
+        keys = []
+        errors = []
+        rows = []
+        for (seq, d) in enumerate(data):
+            try:
+                root_name, relative_path = self._separate_root(d["path"])
+            except TankError, e:
+                keys.append(None)
+                errors.append(e)
+                root_id = None
+                db_path = None
+                path_hash = None
+            else:
+                root_id = self._root_ids[root_name]
+                db_path = self._path_to_dbpath(relative_path)
+                path_hash = _path_hash(db_path)
+                keys.append( (root_id, db_path) )
+                errors.append(None)
+            
+            rows.append( (seq,
+                          d["entity"]["type"], 
+                          d["entity"]["id"],
+                          root_id,
+                          db_path,
+                          path_hash,
+                          d["primary"]) )
+        
+        cursor.execute("DELETE FROM mapping_input")
+        cursor.executemany("""INSERT INTO mapping_input(seq, entity_type, entity_id, root_id, path, path_hash, primary_entity)
+                              VALUES(?, ?, ?, ?, ?, ?, ?)""", rows)
+        
+        return (keys, errors)
 
+    def _get_mapping_input_conflicts(self, cursor):
+        """
+        Finds existing path cache data which may conflict with the contents
+        of the mapping_input temp table.
+        
+        :param cursor: Sqlite database cursor
+        :returns: tuple with two dictionaries. The first one contains the primary
+                  entities currently registered for each path, keyed by 
+                  (root_id, db_path). The second contains the local paths currently 
+                  registered for each entity, keyed by (entity_type, entity_id).
+        """
+        entities_by_path = {}
+        res = cursor.execute("""SELECT DISTINCT pc.rowid, pc.root_id, pc.path, pc.entity_type, pc.entity_id, pc.entity_name
+                                FROM mapping_input mi
+                                INNER JOIN path_cache pc ON pc.root_id = mi.root_id 
+                                                        AND pc.path = mi.path
+                                                        AND pc.primary_entity = 1
+                                ORDER BY pc.rowid""")
+        for (rowid, root_id, path, entity_type, entity_id, entity_name) in res:
+            # convert to string, not unicode!
+            entity = {"type": str(entity_type), "id": entity_id, "name": str(entity_name)}
+            entities_by_path.setdefault((root_id, path), []).append(entity)
+
+        paths_by_entity = {}
+        res = cursor.execute("""SELECT pc.entity_type, pc.entity_id, pc.root_id, pc.path
+                                FROM path_cache pc 
+                                WHERE pc.rowid IN (SELECT pc2.rowid 
+                                                   FROM mapping_input mi 
+                                                   INNER JOIN path_cache pc2 ON pc2.entity_type = mi.entity_type 
+                                                                            AND pc2.entity_id = mi.entity_id)
+                                ORDER BY pc.entity_type, pc.entity_id, pc.primary_entity, pc.root_id, pc.path""")
+        for (entity_type, entity_id, root_id, path) in res:
+            root_path = self._roots.get(self._root_names.get(root_id))
+            if not root_path:
+                # The root name doesn't match a recognized name, so skip this entry
+                continue
+            paths_by_entity.setdefault((entity_type, entity_id), []).append(self._dbpath_to_path(root_path, path))
+        
+        return (entities_by_path, paths_by_entity)
 
 
     ############################################################################################
     # database insertion methods
 
+    @_instrumented
     def add_mappings(self, data, entity_type, entity_ids):
         """
         Adds a collection of mappings to the path cache in case they are not 
@@ -866,18 +2826,20 @@ class PathCache(object):
         
         c = self._connection.cursor()
         try:
+            # take the write lock up front so that the checks against 
+            # existing records see the same data as the inserts
+            self._begin_write(c)
+            
             data_for_sg = []
             
-            for d in data:
-                new_rowid = self._add_db_mapping(c, d["path"], d["entity"], d["primary"]) 
+            new_rowids = self._add_db_mappings(c, data)
+            for (d, new_rowid) in zip(data, new_rowids):
                 if new_rowid:
                     # this entry wasn't already in the db. So add it to the list to
                     # potentially upload to SG later on
                     data_for_sg.append(d)
                     # append path cache row id to data
                     d["path_cache_row_id"] = new_rowid
-                    
-                
             
             if self._sync_with_sg:
 
@@ -886,14 +2848,24 @@ class PathCache(object):
                 desc = ("Created folders on disk for %ss with id: %s" % (entity_type, entity_ids))
 
                 # now push to shotgun
-                (event_log_id, sg_id_lookup) = self._upload_cache_data_to_shotgun(data_for_sg, desc)
-                # store insertion marker in the db
-                c.execute("DELETE FROM event_log_sync")
-                c.execute("INSERT INTO event_log_sync(last_id) VALUES(?)", (event_log_id, ))
-                # and indicate in the path cache that all these records have been pushed
-                for (pc_row_id, sg_id) in sg_id_lookup.items():
-                    c.execute("INSERT INTO shotgun_status(path_cache_id, shotgun_id) "
-                              "VALUES(?, ?)", (pc_row_id, sg_id) )
+                try:
+                    (event_log_id, sg_id_lookup) = self._upload_cache_data_to_shotgun(data_for_sg, desc)
+                except _IncompleteUploadError, e:
+                    # some of the records made it into shotgun. Keep those so that the path 
+                    # cache stays consistent with shotgun, drop the rest and commit. Re-running
+                    # the folder creation will then pick up the remaining records.
+                    not_uploaded = [ d["path_cache_row_id"] for d in data_for_sg 
+                                     if d["path_cache_row_id"] not in e.sg_id_lookup ]
+                    for idx in xrange(0, len(not_uploaded), SQLITE_MAX_PARAMETERS):
+                        chunk = not_uploaded[idx:idx+SQLITE_MAX_PARAMETERS]
+                        c.execute("DELETE FROM path_cache WHERE rowid IN (%s)" % ",".join(["?"] * len(chunk)), 
+                                  chunk)
+                    self._register_uploaded_mappings(c, e.event_log_id, e.sg_id_lookup)
+                    self._connection.commit()
+                    self._invalidate_lookup_cache()
+                    raise
+                
+                self._register_uploaded_mappings(c, event_log_id, sg_id_lookup)
                     
 
         except:
@@ -905,6 +2877,7 @@ class PathCache(object):
         else:
             # Shotgun insert complete! Now we can commit path cache transaction
             self._connection.commit()
+            self._invalidate_lookup_cache()
         
         finally:
             c.close()
@@ -912,78 +2885,162 @@ class PathCache(object):
 
 
 
-    def _add_db_mapping(self, cursor, path, entity, primary):
+    def _register_uploaded_mappings(self, cursor, event_log_id, sg_id_lookup):
+        """
+        Records that path cache entries have been uploaded to Shotgun.
+        The changes are not committed.
+        
+        :param cursor: Sqlite database cursor
+        :param event_log_id: Id of the event log entry written for the upload
+        :param sg_id_lookup: Dictionary of path cache row ids and their 
+                             corresponding shotgun ids.
+        """
+        # store insertion marker in the db. If a sync agent is looking after
+        # this path cache, it may not have processed all events prior to ours 
+        # yet. In that case, leave the marker for the agent to move forward - it
+        # will skip our records since they already exist.
+        if self._get_sync_agent(cursor) is None:
+            cursor.execute("DELETE FROM event_log_sync")
+            cursor.execute("INSERT INTO event_log_sync(last_id) VALUES(?)", (event_log_id, ))
+        # and indicate in the path cache that all these records have been pushed
+        cursor.executemany("INSERT INTO shotgun_status(path_cache_id, shotgun_id) "
+                           "VALUES(?, ?)", sg_id_lookup.items())
+
+    def _add_db_mappings(self, cursor, data):
         """
-        Adds an association to the database. If the association already exists, it will
-        do nothing, just return.
+        Adds a list of associations to the database. Associations which already 
+        exist are skipped.
+        
+        If there is another association which conflicts with an association that is 
+        to be inserted, a TankError is raised. Items are processed in order, including 
+        against items earlier in the list, so the first conflicting item is reported.
         
-        If there is another association which conflicts with the association that is 
-        to be inserted, a TankError is raised.
+        All rows are inserted in a single statement. The changes are not committed.
 
         :param cursor: database cursor to use
-        :param path: a path on disk representing the entity.
-        :param entity: a shotgun entity dict with keys type, id and name
-        :param primary: is this the primary entry for this particular path     
+        :param data: list of dictionaries. Each dictionary contains the following keys:
+                      - entity: a shotgun entity dict with keys type, id and name
+                      - path: a path on disk representing the entity.
+                      - primary: is this the primary entry for this particular path
         
-        :returns: None if nothing was added to the db, otherwise the ROWID for the new row   
+        :returns: List with one item per input item. This is None if nothing was 
+                  added to the db, otherwise the ROWID for the new row.
         """
+        if len(data) == 0:
+            return []
         
-        if primary:
-            # the primary entity must be unique: path/id/type 
-            # see if there are any records for this path
-            # note that get_entity does not return secondary entities
-            curr_entity = self.get_entity(path, cursor)
+        (keys, errors) = self._load_mapping_input(cursor, data)
+        (entities_by_path, paths_by_entity) = self._get_mapping_input_conflicts(cursor)
+        
+        # the (type, id, root_id, path) items currently in the db for all entities
+        # in the input list, regardless of whether they are primary or secondary.
+        existing_items = set()
+        res = cursor.execute("""SELECT pc.entity_type, pc.entity_id, pc.root_id, pc.path
+                                FROM mapping_input mi
+                                INNER JOIN path_cache pc ON pc.entity_type = mi.entity_type 
+                                                        AND pc.entity_id = mi.entity_id
+                                                        AND pc.root_id = mi.root_id
+                                                        AND pc.path_hash = mi.path_hash
+                                                        AND pc.path = mi.path""")
+        for (entity_type, entity_id, root_id, path) in res:
+            existing_items.add( (entity_type, entity_id, root_id, path) )
+        
+        new_rows = []
+        new_seqs = []
+        for (seq, d) in enumerate(data):
             
-            if curr_entity is not None:
-                # this path is already registered. Ensure it is connected to
-                # our entity! 
-                #
-                # Note! We are only comparing against the type and the id
-                # not against the name. It should be perfectly valid to rename something
-                # in shotgun and if folders are then recreated for that item, nothing happens
-                # because there is already a folder which repreents that item. (although now with 
-                # an incorrect name)
-                # 
-                # also note that we have already done this once as part of the validation checks -
-                # this time round, we are doing it more as an integrity check.
-                #                
-                if curr_entity["type"] != entity["type"] or curr_entity["id"] != entity["id"]:    
-                    raise TankError("Database concurrency problems: The path '%s' is " 
-                                    "already associated with Shotgun entity %s. Please re-run "
-                                    "folder creation to try again." % (path, str(curr_entity) ))
-                    
-                else:   
-                    # the entry that exists in the db matches what we are trying to insert so skip it
-                    return None
+            if keys[seq] is None:
+                # the path could not be associated with any storage
+                raise errors[seq]
+            
+            entity = d["entity"]
+            (root_id, db_path) = keys[seq]
+            item_key = (entity["type"], entity["id"], root_id, db_path)
+            
+            if d["primary"]:
+                # the primary entity must be unique: path/id/type 
+                # see if there are any records for this path
+                curr_entities = entities_by_path.get(keys[seq], [])
                 
-        else:
-            # secondary entity
-            # in this case, it is okay with more than one record for a path
-            # but we don't want to insert the exact same record over and over again
-            paths = self.get_paths(entity["type"], entity["id"], primary_only=False, cursor=cursor)
-
-            if path in paths:
-                # we already have the association present in the db.
-                return None
-
-        # there was no entity in the db. So let's create it!
-        root_name, relative_path = self._separate_root(path)
-        db_path = self._path_to_dbpath(relative_path)
-        cursor.execute("""INSERT INTO path_cache(entity_type,
-                                                 entity_id,
-                                                 entity_name,
-                                                 root,
-                                                 path,
-                                                 primary_entity)
-                           VALUES(?, ?, ?, ?, ?, ?)""", 
-                        (entity["type"], 
-                         entity["id"], 
-                         entity["name"], 
-                         root_name, 
-                         db_path, 
-                         primary))
+                if len(curr_entities) > 1:
+                    # never supposed to happen!
+                    raise TankError("More than one entry in path database for %s!" % d["path"])
+                
+                if len(curr_entities) == 1:
+                    curr_entity = curr_entities[0]
+                    # this path is already registered. Ensure it is connected to
+                    # our entity! 
+                    #
+                    # Note! We are only comparing against the type and the id
+                    # not against the name. It should be perfectly valid to rename something
+                    # in shotgun and if folders are then recreated for that item, nothing happens
+                    # because there is already a folder which repreents that item. (although now with 
+                    # an incorrect name)
+                    # 
+                    # also note that we have already done this once as part of the validation checks -
+                    # this time round, we are doing it more as an integrity check.
+                    #                
+                    if curr_entity["type"] != entity["type"] or curr_entity["id"] != entity["id"]:    
+                        raise TankError("Database concurrency problems: The path '%s' is " 
+                                        "already associated with Shotgun entity %s. Please re-run "
+                                        "folder creation to try again." % (d["path"], str(curr_entity) ))
+                        
+                    else:   
+                        # the entry that exists in the db matches what we are trying to insert so skip it
+                        continue
                 
-        return cursor.lastrowid
+                # later items in the list should see this one as registered
+                entities_by_path[keys[seq]] = [entity]
+                
+            else:
+                # secondary entity
+                # in this case, it is okay with more than one record for a path
+                # but we don't want to insert the exact same record over and over again
+                if item_key in existing_items:
+                    # we already have the association present in the db.
+                    continue
+
+            # there was no entity in the db. So let's create it!
+            existing_items.add(item_key)
+            new_seqs.append(seq)
+            new_rows.append( (entity["type"], 
+                              entity["id"], 
+                              entity["name"], 
+                              self._root_names[root_id],
+                              root_id, 
+                              db_path, 
+                              _path_hash(db_path),
+                              d["primary"]) )
+        
+        cursor.executemany("""INSERT INTO path_cache(entity_type,
+                                                     entity_id,
+                                                     entity_name,
+                                                     root,
+                                                     root_id,
+                                                     path,
+                                                     path_hash,
+                                                     primary_entity)
+                              VALUES(?, ?, ?, ?, ?, ?, ?, ?)""", new_rows)
+        
+        # now resolve the row ids for the items we just inserted. The unique index
+        # guarantees that each input item maps onto at most one row.
+        rowids_by_seq = {}
+        res = cursor.execute("""SELECT mi.seq, pc.rowid
+                                FROM mapping_input mi
+                                INNER JOIN path_cache pc ON pc.entity_type = mi.entity_type 
+                                                        AND pc.entity_id = mi.entity_id
+                                                        AND pc.primary_entity = mi.primary_entity
+                                                        AND pc.root_id = mi.root_id
+                                                        AND pc.path_hash = mi.path_hash
+                                                        AND pc.path = mi.path""")
+        for (seq, rowid) in res:
+            rowids_by_seq[seq] = rowid
+        
+        rowids = [None] * len(data)
+        for seq in new_seqs:
+            rowids[seq] = rowids_by_seq[seq]
+        
+        return rowids
 
 
     
@@ -993,49 +3050,123 @@ class PathCache(object):
     def get_folder_tree_from_sg_id(self, shotgun_id):
         """
         Returns a list of items making up the subtree below a certain shotgun id
-        Each item in the list is a dictionary with keys path and sg_id.
+        Each item in the list is a dictionary with keys path and sg_id. 
+        
+        Each item also carries the keys entity (a shotgun entity dict with keys 
+        type, id and name), root (the storage name) and db_path (the storage 
+        relative path, as stored in the path cache).
         
         :param shotgun_id: The shotgun filesystem location id which should be unregistered.
         :returns: A list of items making up the subtree below the given id
         """
         
         c = self._connection.cursor()
-        # first get the path
-        res = c.execute("""SELECT pc.root, pc.path 
-                          FROM path_cache pc
-                          INNER JOIN shotgun_status ss on pc.rowid = ss.path_cache_id
-                          WHERE ss.shotgun_id = ? """, (shotgun_id, ))
-         
-        res = list(res)
-        
-        if len(res) == 0:
-            return []
+        try:
+            # first get the path
+            res = c.execute("""SELECT pc.root_id, pc.path 
+                              FROM path_cache pc
+                              INNER JOIN shotgun_status ss on pc.rowid = ss.path_cache_id
+                              WHERE ss.shotgun_id = ? """, (shotgun_id, ))
+             
+            res = list(res)
+            
+            if len(res) == 0:
+                return []
+            
+            # returns something like [('primary', '/assets/Character/foo')]
+            root_id = res[0][0]
+            path = res[0][1]
+            
+            # now get the path itself and all paths that are child paths
+            (lower, upper) = _subtree_range(path)
+            res = c.execute("""SELECT pc.root_id, pc.path, ss.shotgun_id, pc.entity_type, pc.entity_id, pc.entity_name
+                              FROM path_cache pc
+                              INNER JOIN shotgun_status ss on pc.rowid = ss.path_cache_id
+                              WHERE ss.shotgun_id = ? 
+                              OR (pc.root_id = ? AND pc.path >= ? AND pc.path < ?)""", 
+                            (shotgun_id, root_id, lower, upper))
+            data = list(res)
+        finally:
+            c.close()
         
         matches = []
-        
-        # returns something like [('primary', '/assets/Character/foo')]
-        root_name = res[0][0]
-        path = res[0][1]
-        # first append this match
-        matches.append( {"path": self._dbpath_to_path(root_name, path), "sg_id": shotgun_id } )
-                         
-        
-        # now get all paths that are child paths
-        like_path = "%s/%%" % path
-        res = c.execute("""SELECT pc.root, pc.path, ss.shotgun_id
-                          FROM path_cache pc
-                          INNER JOIN shotgun_status ss on pc.rowid = ss.path_cache_id
-                          WHERE root = ? and path like ?""", (root_name, like_path))
-        
-        for x in list(res):
-            root_name = x[0]
-            path = x[1]
-            sg_id = x[2]
-            # first append this match
-            matches.append( {"path": self._dbpath_to_path(root_name, path), "sg_id": sg_id } )
+        # make sure the item we asked for comes first
+        data.sort(key=lambda x: x[2] != shotgun_id)
+        for (root_id, path, sg_id, entity_type, entity_id, entity_name) in data:
+            root_name = self._root_names.get(root_id)
+            root_path = self._roots.get(root_name)
+            if not root_path:
+                # The root name doesn't match a recognized name, so skip this entry
+                continue
+            
+            matches.append( {"path": self._dbpath_to_path(root_path, path), 
+                             "sg_id": sg_id,
+                             "entity": {"type": str(entity_type), "id": entity_id, "name": str(entity_name)},
+                             "root": root_name,
+                             "db_path": path } )
             
         return matches
 
+    @_instrumented
+    def get_entities_under(self, path, entity_types=None):
+        """
+        Returns all the entities registered for a folder and for any of the 
+        folders below it. Both primary and secondary entities are included.
+        
+        Rows are looked up with a range scan on the path and are yielded as 
+        they are read from the database, ordered by path. 
+
+        :param path: a path on disk
+        :param entity_types: Optional list of Shotgun entity types to limit the 
+                             search to. If None, all entities are returned.
+        :returns: generator yielding dictionaries with keys entity (a shotgun entity 
+                  dict with keys type, id and name), path (a path on disk) and 
+                  primary (a boolean indicating if this is a primary entry)
+        """
+        if self._path_cache_disabled:
+            # no entries because we don't have a path cache
+            return
+        
+        try:
+            root_name, relative_path = self._separate_root(path)
+        except TankError:
+            # fail gracefully if path is not a valid path
+            # eg. doesn't belong to the project
+            return
+        
+        root_path = self._roots[root_name]
+        db_path = self._path_to_dbpath(relative_path)
+        (lower, upper) = _subtree_range(db_path)
+        
+        # the range query starts at the folder itself. Paths such as /foo-bar sort 
+        # between /foo and /foo/ so only pick up the folder itself below the
+        # child path range.
+        sql = """SELECT path, entity_type, entity_id, entity_name, primary_entity
+                 FROM path_cache
+                 WHERE root_id = ? AND path >= ? AND path < ? AND (path >= ? OR path = ?)"""
+        params = [self._root_ids[root_name], db_path, upper, lower, db_path]
+        
+        if entity_types is not None:
+            entity_types = list(entity_types)
+            if len(entity_types) == 0:
+                return
+            sql += " AND entity_type IN (%s)" % ",".join(["?"] * len(entity_types))
+            params.extend(entity_types)
+        
+        sql += " ORDER BY path"
+        
+        c = self._connection.cursor()
+        try:
+            res = c.execute(sql, params)
+            for (item_path, entity_type, entity_id, entity_name, primary_entity) in res:
+                # convert to string, not unicode!
+                yield {"entity": {"type": str(entity_type), "id": entity_id, "name": str(entity_name)},
+                       "path": self._dbpath_to_path(root_path, item_path),
+                       "primary": bool(primary_entity)}
+        finally:
+            c.close()
+
+    @_instrumented
     def get_paths(self, entity_type, entity_id, primary_only, cursor=None):
         """
         Returns a path given a shotgun entity (type/id pair)
@@ -1051,6 +3182,18 @@ class PathCache(object):
             # no entries because we don't have a path cache
             return []
         
+        # lookups which are part of a larger transaction bypass the in-memory cache
+        lookup_cache = None
+        if cursor is None:
+            lookup_cache = self._get_validated_lookup_cache()
+        
+        if lookup_cache is not None:
+            cache_key = ("paths", entity_type, entity_id, bool(primary_only))
+            (found, paths) = lookup_cache.get(cache_key)
+            if found:
+                return list(paths)
+            generation = lookup_cache.generation
+        
         paths = []
         
         # use built in cursor unless specifically provided - means this
@@ -1059,12 +3202,12 @@ class PathCache(object):
         
         try:
             if primary_only:
-                res = c.execute("SELECT root, path FROM path_cache WHERE entity_type = ? AND entity_id = ? and primary_entity = 1", (entity_type, entity_id))
+                res = c.execute("SELECT root_id, path FROM path_cache WHERE entity_type = ? AND entity_id = ? and primary_entity = 1", (entity_type, entity_id))
             else:
-                res = c.execute("SELECT root, path FROM path_cache WHERE entity_type = ? AND entity_id = ?", (entity_type, entity_id))
+                res = c.execute("SELECT root_id, path FROM path_cache WHERE entity_type = ? AND entity_id = ?", (entity_type, entity_id))
     
             for row in res:
-                root_name = row[0]
+                root_name = self._root_names.get(row[0])
                 relative_path = row[1]
                 
                 root_path = self._roots.get(root_name)
@@ -1079,8 +3222,277 @@ class PathCache(object):
             if cursor is None:
                 c.close()
         
+        if lookup_cache is not None:
+            lookup_cache.set(cache_key, list(paths), generation)
+        
+        return paths
+
+    @_instrumented
+    def get_paths_many(self, entities, primary_only, cursor=None):
+        """
+        Returns the paths for a list of shotgun entities. This is equivalent to 
+        calling get_paths() for each entity, but the lookups are batched into a 
+        small number of queries.
+        
+        :param entities: List of (entity_type, entity_id) tuples
+        :param primary_only: Only return items marked as primary
+        :param cursor: Database cursor to use. If none, a new cursor will be created.
+        :returns: Dictionary keyed by (entity_type, entity_id), holding a list 
+                  of paths on disk for each of the given entities
+        """
+        paths = {}
+        for key in entities:
+            paths[key] = []
+        
+        if self._path_cache_disabled:
+            # no entries because we don't have a path cache
+            return paths
+        
+        # lookups which are part of a larger transaction bypass the in-memory cache
+        lookup_cache = None
+        if cursor is None:
+            lookup_cache = self._get_validated_lookup_cache()
+        
+        ids_to_look_for = collections.defaultdict(list)
+        if lookup_cache is not None:
+            generation = lookup_cache.generation
+            for (entity_type, entity_id) in paths:
+                (found, cached_paths) = lookup_cache.get(("paths", entity_type, entity_id, bool(primary_only)))
+                if found:
+                    paths[(entity_type, entity_id)] = list(cached_paths)
+                else:
+                    ids_to_look_for[entity_type].append(entity_id)
+        else:
+            for (entity_type, entity_id) in paths:
+                ids_to_look_for[entity_type].append(entity_id)
+        
+        if primary_only:
+            sql = """SELECT entity_id, root_id, path FROM path_cache 
+                     WHERE entity_type = ? AND entity_id IN (%s) AND primary_entity = 1"""
+        else:
+            sql = """SELECT entity_id, root_id, path FROM path_cache 
+                     WHERE entity_type = ? AND entity_id IN (%s)"""
+        
+        # use built in cursor unless specifically provided - means this
+        # is part of a larger transaction
+        c = cursor or self._connection.cursor()
+        
+        try:
+            for (entity_type, entity_ids) in ids_to_look_for.iteritems():
+                for idx in xrange(0, len(entity_ids), SQLITE_MAX_PARAMETERS):
+                    chunk = entity_ids[idx:idx+SQLITE_MAX_PARAMETERS]
+                    res = c.execute(sql % ",".join(["?"] * len(chunk)), [entity_type] + chunk)
+                    
+                    for (entity_id, root_id, relative_path) in res:
+                        root_path = self._roots.get(self._root_names.get(root_id))
+                        if not root_path:
+                            # The root name doesn't match a recognized name, so skip this entry
+                            continue
+                        paths[(entity_type, entity_id)].append(self._dbpath_to_path(root_path, relative_path))
+        finally:
+            if cursor is None:
+                c.close()
+        
+        if lookup_cache is not None:
+            for (entity_type, entity_ids) in ids_to_look_for.iteritems():
+                for entity_id in entity_ids:
+                    lookup_cache.set(("paths", entity_type, entity_id, bool(primary_only)), 
+                                     list(paths[(entity_type, entity_id)]), 
+                                     generation)
+        
         return paths
 
+    @_instrumented
+    def get_entity_ancestry_many(self, entities):
+        """
+        Returns the primary paths for a list of shotgun entities, together with 
+        the primary entities registered for the folders leading up to each path. 
+        
+        The parent folders of a path are found from the path itself, so all the 
+        folders are looked up in one query on the path hash index, regardless of
+        the depth of the folder schema.
+        
+        :param entities: List of (entity_type, entity_id) tuples
+        :returns: Dictionary keyed by (entity_type, entity_id), holding a list with 
+                  a tuple for each primary path of the entity. The tuple holds the 
+                  path on disk and a list of the primary entity dicts registered for
+                  the path and each of its parent folders, starting with the path 
+                  itself and ending with the storage root. Folders without an 
+                  entity are None.
+        """
+        ancestry = {}
+        for key in entities:
+            ancestry[key] = []
+        
+        if self._path_cache_disabled:
+            # no entries because we don't have a path cache
+            return ancestry
+        
+        lookup_cache = self._get_validated_lookup_cache()
+        if lookup_cache is not None:
+            generation = lookup_cache.generation
+        
+        ids_to_look_for = collections.defaultdict(list)
+        for (entity_type, entity_id) in ancestry:
+            if lookup_cache is not None:
+                (found, cached_ancestry) = lookup_cache.get(("ancestry", entity_type, entity_id))
+                if found:
+                    ancestry[(entity_type, entity_id)] = _copy_ancestry(cached_ancestry)
+                    continue
+            ids_to_look_for[entity_type].append(entity_id)
+        
+        # primary paths for each entity, keyed by (entity_type, entity_id), 
+        # holding lists of (root_id, db_path) tuples
+        entity_db_paths = {}
+        # the db paths of all folders leading up to the entity paths, keyed by 
+        # (root_id, db_path), holding a list of db paths starting with the path itself
+        folder_chains = {}
+        # primary entities of all the folders, keyed by (root_id, db_path)
+        folder_entities = {}
+        
+        c = self._connection.cursor()
+        try:
+            for (entity_type, entity_ids) in ids_to_look_for.iteritems():
+                for idx in xrange(0, len(entity_ids), SQLITE_MAX_PARAMETERS):
+                    chunk = entity_ids[idx:idx+SQLITE_MAX_PARAMETERS]
+                    res = c.execute("""SELECT entity_id, root_id, path FROM path_cache 
+                                       WHERE entity_type = ? AND entity_id IN (%s) AND primary_entity = 1""" 
+                                    % ",".join(["?"] * len(chunk)), [entity_type] + chunk)
+                    for (entity_id, root_id, db_path) in res:
+                        entity_db_paths.setdefault((entity_type, entity_id), []).append((root_id, db_path))
+                        folder_chains[(root_id, db_path)] = _get_db_path_chain(db_path)
+            
+            # folders are shared between entities, so look up each folder once
+            db_paths_by_root = {}
+            for ((root_id, _), db_paths) in folder_chains.iteritems():
+                db_paths_by_root.setdefault(root_id, set()).update(db_paths)
+            
+            for (root_id, db_paths) in db_paths_by_root.iteritems():
+                db_paths = list(db_paths)
+                for idx in xrange(0, len(db_paths), SQLITE_MAX_PARAMETERS):
+                    chunk = db_paths[idx:idx+SQLITE_MAX_PARAMETERS]
+                    res = c.execute("""SELECT path, entity_type, entity_id, entity_name FROM path_cache 
+                                       WHERE root_id = ? AND path IN (%s) AND primary_entity = 1""" 
+                                    % ",".join(["?"] * len(chunk)), [root_id] + chunk)
+                    for (db_path, entity_type, entity_id, entity_name) in res:
+                        key = (root_id, db_path)
+                        if key in folder_entities:
+                            # never supposed to happen!
+                            raise TankError("More than one entry in path database for %s!" % db_path)
+                        # convert to string, not unicode!
+                        folder_entities[key] = {"type": str(entity_type), "id": entity_id, "name": str(entity_name)}
+        finally:
+            c.close()
+        
+        for (entity_type, entity_ids) in ids_to_look_for.iteritems():
+            for entity_id in entity_ids:
+                key = (entity_type, entity_id)
+                for (root_id, db_path) in entity_db_paths.get(key, []):
+                    root_path = self._roots.get(self._root_names.get(root_id))
+                    if not root_path:
+                        # The root name doesn't match a recognized name, so skip this entry
+                        continue
+                    chain = [ folder_entities.get((root_id, x)) for x in folder_chains[(root_id, db_path)] ]
+                    ancestry[key].append((self._dbpath_to_path(root_path, db_path), chain))
+                
+                if lookup_cache is not None:
+                    lookup_cache.set(("ancestry", entity_type, entity_id), _copy_ancestry(ancestry[key]), generation)
+        
+        return ancestry
+
+    @_instrumented
+    def get_entities_many(self, paths):
+        """
+        Returns the primary and secondary entities for a list of paths. This is 
+        equivalent to calling get_entity() and get_secondary_entities() for each 
+        path, but the lookups are batched into a small number of queries.
+        
+        :param paths: List of paths on disk
+        :returns: Dictionary keyed by path, holding a tuple with the primary entity
+                  dict, or None if not found, and a list of secondary entity dicts.
+        """
+        entities = {}
+        for path in paths:
+            entities[path] = (None, [])
+        
+        if self._path_cache_disabled:
+            # no entries because we don't have a path cache
+            return entities
+        
+        lookup_cache = self._get_validated_lookup_cache()
+        if lookup_cache is not None:
+            generation = lookup_cache.generation
+        
+        # paths to look up in the db, keyed by (root_id, db_path)
+        paths_to_look_for = {}
+        for path in entities:
+            try:
+                root_name, relative_path = self._separate_root(path)
+            except TankError:
+                # fail gracefully if path is not a valid path
+                # eg. doesn't belong to the project
+                continue
+            
+            db_path = self._path_to_dbpath(relative_path)
+            
+            if lookup_cache is not None:
+                (found, entity) = lookup_cache.get(("entity", root_name, db_path))
+                if found:
+                    (found, matches) = lookup_cache.get(("secondary", root_name, db_path))
+                    if found:
+                        entities[path] = (entity and entity.copy(), [x.copy() for x in matches])
+                        continue
+            
+            key = (self._root_ids[root_name], db_path)
+            if key not in paths_to_look_for:
+                paths_to_look_for[key] = (root_name, [])
+            paths_to_look_for[key][1].append(path)
+        
+        # primary and secondary entities found, keyed by (root_id, db_path)
+        data = {}
+        # look up the paths of each storage in one go
+        db_paths_by_root = {}
+        for (root_id, db_path) in paths_to_look_for:
+            db_paths_by_root.setdefault(root_id, []).append(db_path)
+        
+        c = self._connection.cursor()
+        try:
+            for (root_id, db_paths) in db_paths_by_root.iteritems():
+                for idx in xrange(0, len(db_paths), SQLITE_MAX_PARAMETERS):
+                    chunk = db_paths[idx:idx+SQLITE_MAX_PARAMETERS]
+                    res = c.execute("""SELECT path, primary_entity, entity_type, entity_id, entity_name 
+                                       FROM path_cache WHERE root_id = ? AND path IN (%s)""" 
+                                    % ",".join(["?"] * len(chunk)), [root_id] + chunk)
+                    for (db_path, primary_entity, entity_type, entity_id, entity_name) in res:
+                        key = (root_id, db_path)
+                        if key not in data:
+                            data[key] = ([], [])
+                        # convert to string, not unicode!
+                        entity = {"type": str(entity_type), "id": entity_id, "name": str(entity_name)}
+                        if primary_entity:
+                            data[key][0].append(entity)
+                        else:
+                            data[key][1].append(entity)
+        finally:
+            c.close()
+        
+        for (key, (root_name, key_paths)) in paths_to_look_for.iteritems():
+            (primary, secondary) = data.get(key, ([], []))
+            if len(primary) > 1:
+                # never supposed to happen!
+                raise TankError("More than one entry in path database for %s!" % key_paths[0])
+            entity = (primary or [None])[0]
+            
+            for path in key_paths:
+                entities[path] = (entity and entity.copy(), [x.copy() for x in secondary])
+            
+            if lookup_cache is not None:
+                lookup_cache.set(("entity", root_name, key[1]), entity and entity.copy(), generation)
+                lookup_cache.set(("secondary", root_name, key[1]), [x.copy() for x in secondary], generation)
+        
+        return entities
+
+    @_instrumented
     def get_entity(self, path, cursor=None):
         """
         Returns an entity given a path.
@@ -1105,19 +3517,34 @@ class PathCache(object):
             return None
         
         try:
-            root_path, relative_path = self._separate_root(path)
+            root_name, relative_path = self._separate_root(path)
         except TankError:
             # fail gracefully if path is not a valid path
             # eg. doesn't belong to the project
             return None
 
+        db_path = self._path_to_dbpath(relative_path)
+        
+        # lookups which are part of a larger transaction bypass the in-memory cache
+        lookup_cache = None
+        if cursor is None:
+            lookup_cache = self._get_validated_lookup_cache()
+        
+        if lookup_cache is not None:
+            cache_key = ("entity", root_name, db_path)
+            (found, entity) = lookup_cache.get(cache_key)
+            if found:
+                return entity and entity.copy()
+            generation = lookup_cache.generation
+
         # use built in cursor unless specifically provided - means this
         # is part of a larger transaction
         c = cursor or self._connection.cursor()        
 
         try:
-            db_path = self._path_to_dbpath(relative_path)
-            res = c.execute("SELECT entity_type, entity_id, entity_name FROM path_cache WHERE path = ? AND root = ? and primary_entity = 1", (db_path, root_path))
+            res = c.execute("""SELECT entity_type, entity_id, entity_name FROM path_cache 
+                               WHERE root_id = ? AND path = ? AND primary_entity = 1""", 
+                            (self._root_ids[root_name], db_path))
             data = list(res)
         finally:
             if cursor is None:
@@ -1130,10 +3557,16 @@ class PathCache(object):
             # convert to string, not unicode!
             type_str = str(data[0][0])
             name_str = str(data[0][2])
-            return {"type": type_str, "id": data[0][1], "name": name_str }
+            entity = {"type": type_str, "id": data[0][1], "name": name_str }
         else:
-            return None
+            entity = None
+        
+        if lookup_cache is not None:
+            lookup_cache.set(cache_key, entity and entity.copy(), generation)
+        
+        return entity
 
+    @_instrumented
     def get_secondary_entities(self, path):
         """
         Returns all the secondary entities for a path.
@@ -1148,16 +3581,27 @@ class PathCache(object):
             return []
         
         try:
-            root_path, relative_path = self._separate_root(path)
+            root_name, relative_path = self._separate_root(path)
         except TankError:
             # fail gracefully if path is not a valid path
             # eg. doesn't belong to the project
             return []
 
+        db_path = self._path_to_dbpath(relative_path)
+        
+        lookup_cache = self._get_validated_lookup_cache()
+        if lookup_cache is not None:
+            cache_key = ("secondary", root_name, db_path)
+            (found, matches) = lookup_cache.get(cache_key)
+            if found:
+                return [x.copy() for x in matches]
+            generation = lookup_cache.generation
+
         c = self._connection.cursor()
         try:
-            db_path = self._path_to_dbpath(relative_path)
-            res = c.execute("SELECT entity_type, entity_id, entity_name FROM path_cache WHERE path = ? AND root = ? and primary_entity = 0", (db_path, root_path))
+            res = c.execute("""SELECT entity_type, entity_id, entity_name FROM path_cache 
+                               WHERE root_id = ? AND path = ? AND primary_entity = 0""", 
+                            (self._root_ids[root_name], db_path))
             data = list(res)
         finally:
             c.close()
@@ -1169,156 +3613,401 @@ class PathCache(object):
             name_str = str(d[2])
             matches.append( {"type": type_str, "id": d[1], "name": name_str } )
 
+        if lookup_cache is not None:
+            lookup_cache.set(cache_key, [x.copy() for x in matches], generation)
+
         return matches
     
 
-    def ensure_all_entries_are_in_shotgun(self, log):
+    def ensure_all_entries_are_in_shotgun(self, log, dry_run=False, num_threads=SG_NUM_UPLOAD_THREADS):
         """
         Ensures that all the path cache data in this database is also registered in Shotgun.
         
-        This will go through each entity in the path cache database and check if it exists in 
-        Shotgun. If not, it will be created.
+        The FilesystemLocation records in Shotgun and the records in the path cache
+        are both streamed ordered by entity id and compared one entity at a time,
+        so neither side has to be held in memory. The comparison finds
+        
+        - missing records, which exist in the path cache but not in Shotgun. 
+          These are created in Shotgun.
+        - mismatched records, which exist on both sides but where the primary flag
+          differs. These are updated in Shotgun to match the path cache.
+        - extra records, which exist in Shotgun but not in the path cache. These
+          are reported only - they will be picked up when the path cache is synchronized.
+        
+        Shotgun is updated using parallel batch requests, and a single event log entry 
+        is written for all created records. Updated records are announced with a 
+        Toolkit_Folders_Update event, so that other path caches replace their copies 
+        of these records the next time they are synchronized. 
         
         No updates will be made to the path cache database.
         
         :param log: Std python logger 
+        :param dry_run: If True, only report what would be changed.
+        :param num_threads: Number of parallel Shotgun connections to use for updates.
+        :returns: Dictionary with keys missing, mismatched, extra and invalid, each holding 
+                  the number of records found. Invalid records are missing records 
+                  which cannot be uploaded because their entity has been deleted in Shotgun.
         """
 
-        SG_BATCH_SIZE = 50
-
         log.info("")
-        log.info("Step 1 - Downloading current path data from Shotgun...")
+        log.info("Step 1 - Comparing path cache data with Shotgun...")
         
-        project_link = {"type": "Project", 
-                        "id": self._tk.pipeline_configuration.get_project_id() }        
-        
-        sg_data = self._tk.shotgun.find(SHOTGUN_ENTITY, 
-                                        [["project", "is", project_link]],
-                                        [SG_PATH_FIELD, SG_ENTITY_TYPE_FIELD, SG_ENTITY_ID_FIELD])
-        log.info(" - Got %s records." % len(sg_data))
-
-        # reshuffle these into a dictionary based on path and entity type
-        # this is so we can do fast lookups later
-        sg_existing_data = {}
-        for p in sg_data:
-            local_path = p[SG_PATH_FIELD].get("local_path") # using get() in case key is missing
-            # key dictionary by local path, entity type and entity id. This is so that we can 
-            # handle secondary entities correctly.
-            dict_key = (local_path, p[SG_ENTITY_TYPE_FIELD], p[SG_ENTITY_ID_FIELD])
-            sg_existing_data[dict_key] = p["id"]
-        
-        # free up memory
-        sg_data = None
-                
+        missing_records = []
+        mismatched_records = []
+        num_extra = 0
+        num_local = 0
+        num_sg = 0
         
         cursor = self._connection.cursor()
-
         try:
-            # get all records and check each one against shotgun.
-            pc_data = list(cursor.execute("""select pc.rowid,
-                                                    pc.entity_type, 
-                                                    pc.entity_id, 
-                                                    pc.entity_name, 
-                                                    pc.root, 
-                                                    pc.path, 
-                                                    pc.primary_entity 
-                                             from path_cache pc"""))
+            local_groups = itertools.groupby(self._iter_local_records(cursor, log), 
+                                             lambda x: x["entity"]["id"])
+            sg_groups = itertools.groupby(self._iter_sg_records(log), 
+                                          lambda x: x[SG_ENTITY_ID_FIELD])
+            
+            # merge the two sorted streams, one entity id at a time
+            local_group = _next_group(local_groups)
+            sg_group = _next_group(sg_groups)
+            
+            while local_group or sg_group:
+                
+                if sg_group is None or (local_group and local_group[0] < sg_group[0]):
+                    local_records = local_group[1]
+                    sg_records = []
+                    local_group = _next_group(local_groups)
+                
+                elif local_group is None or sg_group[0] < local_group[0]:
+                    local_records = []
+                    sg_records = sg_group[1]
+                    sg_group = _next_group(sg_groups)
+                
+                else:
+                    local_records = local_group[1]
+                    sg_records = sg_group[1]
+                    local_group = _next_group(local_groups)
+                    sg_group = _next_group(sg_groups)
+                
+                num_local += len(local_records)
+                num_sg += len(sg_records)
+                
+                # key records by local path, entity type and entity id. 
+                # This is so that we can handle secondary entities correctly.
+                sg_by_key = {}
+                for sg_record in sg_records:
+                    key = (sg_record[SG_PATH_FIELD].get("local_path"), 
+                           sg_record[SG_ENTITY_TYPE_FIELD], 
+                           sg_record[SG_ENTITY_ID_FIELD])
+                    sg_by_key.setdefault(key, sg_record)
+                
+                for local_record in local_records:
+                    key = (local_record["path"], local_record["entity"]["type"], local_record["entity"]["id"])
+                    sg_record = sg_by_key.pop(key, None)
+                    
+                    if sg_record is None:
+                        log.debug("Path '%s' (%s %s) is not in Shotgun." % key)
+                        missing_records.append(local_record)
+                    
+                    elif bool(sg_record[SG_IS_PRIMARY_FIELD]) != local_record["primary"]:
+                        log.debug("Path '%s' (%s %s) has a different primary flag in Shotgun (id %s)." % (key + (sg_record["id"],)))
+                        mismatched_records.append( (sg_record["id"], local_record) )
+                    
+                    else:
+                        log.debug("Path '%s' (%s %s) is already in Shotgun (id %s)." % (key + (sg_record["id"],)))
+                
+                for (key, sg_record) in sg_by_key.iteritems():
+                    log.debug("Path '%s' (%s %s) is only in Shotgun (id %s)." % (key + (sg_record["id"],)))
+                    num_extra += 1
         finally:
             cursor.close()
         
+        log.info(" - %s path cache records and %s Shotgun records compared." % (num_local, num_sg))
+        
+        # cull out stuff where the linked entity has been retired in shogun 
         log.info("")
-        log.info("Step 2 - Loading path cache data...")
-        log.info(" - %s paths loaded." % len(pc_data))
+        log.info("Step 2 - Ensuring all shotgun entity links are valid.")
+        
+        valid_records = self._get_records_with_valid_entities(missing_records, log)
+        
+        report = {"missing": len(valid_records), 
+                  "mismatched": len(mismatched_records), 
+                  "extra": num_extra,
+                  "invalid": len(missing_records) - len(valid_records)}
         
         log.info("")
-        log.info("Step 3 - Culling paths already in Shotgun.")
+        log.info(" - %s records need to be created in Shotgun." % report["missing"])
+        log.info(" - %s records need their primary flag updated in Shotgun." % report["mismatched"])
+        log.info(" - %s records only exist in Shotgun and will be picked up by the next sync." % report["extra"])
+        log.info(" - %s records are linked to deleted entities and will be skipped." % report["invalid"])
         
-        sg_records = []
-
-        # cull stuff that already exists in shotgun
-        for sql_record in pc_data:
-            log.debug("Processing db record %s..." % str(sql_record))
+        if dry_run:
+            log.info("")
+            log.info("Dry run - no changes were made to Shotgun.")
+            return report
+                        
+        # batch it and push it. All records should now be valid
+        def _progress(num_done, num_total):
+            log.info(" - %s/%s records processed..." % (num_done, num_total))
+        
+        if len(valid_records) > 0:
+            log.info("")
+            log.info("Step 3 - Uploading path entries to shotgun.")
+            event_log_description = "Path cache migration."
+            self._upload_cache_data_to_shotgun(valid_records, 
+                                               event_log_description, 
+                                               log, 
+                                               num_threads, 
+                                               _progress)
+        
+        if len(mismatched_records) > 0:
+            log.info("")
+            log.info("Step 4 - Updating path entries in shotgun.")
+            sg_batch_data = [ {"request_type": "update", 
+                               "entity_type": SHOTGUN_ENTITY, 
+                               "entity_id": sg_id, 
+                               "data": {SG_IS_PRIMARY_FIELD: local_record["primary"]}} 
+                              for (sg_id, local_record) in mismatched_records ]
+            (_, error) = self._execute_sg_batches(sg_batch_data, log, num_threads, _progress)
+            if error:
+                raise TankError("Could not update path entries in Shotgun. Please try "
+                                "again. Error details: %s" % error)
             
+            updated_ids = [sg_id for (sg_id, _) in mismatched_records]
+            self._create_folders_event(updated_ids, 
+                                       "Path cache migration - updated primary flags.",
+                                       "Toolkit_Folders_Update")
+        
+        log.info("")
+        log.info("Migration complete. %s records created and %s records updated "
+                 "in Shotgun." % (len(valid_records), len(mismatched_records)))
+        
+        return report
+
+    def _iter_local_records(self, cursor, log):
+        """
+        Streams the records in the path cache, ordered by entity id.
+        Records which don't belong to a storage of this project are skipped.
+        
+        :param cursor: Sqlite database cursor
+        :param log: Std python logger
+        :returns: generator yielding dictionaries with keys entity, path (local os path), 
+                  primary, metadata and path_cache_row_id, suitable for passing 
+                  to _upload_cache_data_to_shotgun.
+        """
+        res = cursor.execute("""SELECT pc.rowid,
+                                       pc.entity_type, 
+                                       pc.entity_id, 
+                                       pc.entity_name, 
+                                       pcr.name, 
+                                       pc.path, 
+                                       pc.primary_entity 
+                                FROM path_cache pc
+                                LEFT JOIN path_cache_root pcr ON pcr.id = pc.root_id
+                                ORDER BY pc.entity_id""")
+        
+        for (rowid, entity_type, entity_id, entity_name, root_name, db_path, primary_entity) in res:
             # resolve a local path from a root and a generic path
-            root_name = sql_record[4]
-            db_path = sql_record[5]
             root_path = self._roots.get(root_name)
             if not root_path:
                 # The root name doesn't match a recognized name, so skip this entry
                 log.debug("Skipping path '%s %s' which doesn't have a valid root." % (root_name, db_path))
                 continue
             
-            local_os_path = self._dbpath_to_path(root_path, db_path)
-            
-            entity_type = sql_record[1]
-            entity_id = sql_record[2]
-            
-            # see if we have this in shotgun already
-            sg_dict_key = (local_os_path, entity_type, entity_id)
+            yield {"entity": {"type": entity_type, "id": entity_id, "name": entity_name},
+                   "path": self._dbpath_to_path(root_path, db_path),
+                   "primary": bool(primary_entity),
+                   "metadata": {},
+                   "path_cache_row_id": rowid}
+
+    def _iter_sg_records(self, log):
+        """
+        Streams the FilesystemLocation records for the current project from Shotgun, 
+        page by page, ordered by entity id.
+        
+        :param log: Std python logger
+        :returns: generator yielding Shotgun FilesystemLocation dictionaries
+        """
+        project_link = {"type": "Project", 
+                        "id": self._tk.pipeline_configuration.get_project_id() }
+        
+        page = 1
+        prev_entity_id = None
+        while True:
+            sg_data = self._tk.shotgun.find(SHOTGUN_ENTITY, 
+                                            [["project", "is", project_link], 
+                                             [SG_ENTITY_ID_FIELD, "is_not", None]],
+                                            [SG_PATH_FIELD, SG_ENTITY_TYPE_FIELD, SG_ENTITY_ID_FIELD, SG_IS_PRIMARY_FIELD],
+                                            [{"field_name": SG_ENTITY_ID_FIELD, "direction": "asc"}, 
+                                             {"field_name": "id", "direction": "asc"}],
+                                            limit=SG_PAGE_SIZE,
+                                            page=page)
+            log.debug("Downloaded page %s with %s records from Shotgun." % (page, len(sg_data)))
             
-            # now check if we have any entry in the path cache already which has that path
-            if sg_dict_key in sg_existing_data:
-                log.info(" - Skipping '%s'" % local_os_path)
-                log.debug("Path '%s' (%s %s) is already in shotgun (id %s)" % (local_os_path, 
-                                                                               entity_type, 
-                                                                               entity_id, 
-                                                                               sg_existing_data[sg_dict_key]))
-            else:
+            for sg_record in sg_data:
+                # the merge relies on the ordering - make sure it is right
+                if prev_entity_id is not None and sg_record[SG_ENTITY_ID_FIELD] < prev_entity_id:
+                    raise TankError("Shotgun returned %s records in an unexpected order. "
+                                    "Please contact support." % SHOTGUN_ENTITY)
+                prev_entity_id = sg_record[SG_ENTITY_ID_FIELD]
+                
+                if sg_record[SG_PATH_FIELD] is None:
+                    # no path at all - this is an anomaly but handle it gracefully regardless
+                    log.debug("No path associated with %s %s. Skipping." % (SHOTGUN_ENTITY, sg_record["id"]))
+                    continue
+                
+                yield sg_record
             
-                # ok this record needs uploading and seems valid.
-                sg_record = {}
-                sg_record["entity"] = {}
-                sg_record["entity"]["type"] = sql_record[1]
-                sg_record["entity"]["id"] = sql_record[2]
-                sg_record["entity"]["name"] = sql_record[3]
-                sg_record["path"] = local_os_path
-                sg_record["primary"] = bool(sql_record[6])
-                sg_record["metadata"] = {}
-                sg_record["path_cache_row_id"] = sql_record[0]
-                sg_records.append(sg_record)
+            if len(sg_data) < SG_PAGE_SIZE:
+                break
+            page += 1
 
-        # cull out stuff where the linked entity has been retired in shogun 
-        log.info("")
-        log.info("Step 4 - Ensuring all shotgun entity links are valid.")
+    def _get_records_with_valid_entities(self, records, log):
+        """
+        Culls out records where the linked entity has been deleted in Shotgun.
         
-        ids_to_look_for = collections.defaultdict(list)
-        for sg_record in sg_records:
-            # look up all items in shotgun. 
+        :param records: List of dictionaries with an entity key
+        :param log: Std python logger
+        :returns: List of records linked to existing entities, in their original order
+        """
+        ids_to_look_for = collections.defaultdict(set)
+        for record in records:
             # group stuff by entity type
-            ids_to_look_for[ sg_record["entity"]["type"] ].append(sg_record)
+            ids_to_look_for[ record["entity"]["type"] ].add(record["entity"]["id"])
                             
         # now query shotgun for each of the types
-        ids_in_shotgun = {}
-        sg_valid_records = []
-        for (et, sg_records_for_et) in ids_to_look_for.iteritems():
-            
-            log.info(" - Checking %s %ss in Shotgun..." % (len(sg_records_for_et), et)) 
-            
-            # get the ids from shotgun for the current et.
-            sg_ids = [x["entity"]["id"] for x in sg_records_for_et]
-            ids = self._tk.shotgun.find(et, [["id", "in", sg_ids]])
-            # note the use of set here to make lookups O(1) later
-            raw_ids = set([x["id"] for x in ids])
-            
-            # check all our records for et and see if they have a match
-            for sg_record in sg_records_for_et:
-                if sg_record["entity"]["id"] in raw_ids:
-                    sg_valid_records.append(sg_record)
-                else:
-                    log.info(" - %s %s has been deleted in Shotgun. " % (et, sg_record["entity"]["id"]))
-                        
-                        
-        # batch it and push it. All records should now be valid
-        if len(sg_valid_records) > 0:
-            log.info("")
-            log.info("Step 5 - Uploading path entries to shotgun.")
-            sg_batches = [ sg_valid_records[x:x+SG_BATCH_SIZE] for x in xrange(0, len(pc_data), SG_BATCH_SIZE)]
-            event_log_description = "Path cache migration."
-            for batch_idx, curr_batch in enumerate(sg_batches):
-                log.info("Uploading batch %d/%d to Shotgun..." % (batch_idx+1, len(sg_batches)))
-                self._upload_cache_data_to_shotgun(curr_batch, event_log_description, log)
+        existing_ids = set()
+        for (et, ids) in ids_to_look_for.iteritems():
             
+            log.info(" - Checking %s %ss in Shotgun..." % (len(ids), et)) 
+            
+            ids = list(ids)
+            for idx in xrange(0, len(ids), SG_PAGE_SIZE):
+                sg_data = self._tk.shotgun.find(et, [["id", "in", ids[idx:idx+SG_PAGE_SIZE]]])
+                existing_ids.update([ (et, x["id"]) for x in sg_data ])
+        
+        valid_records = []
+        for record in records:
+            if (record["entity"]["type"], record["entity"]["id"]) in existing_ids:
+                valid_records.append(record)
+            else:
+                log.info(" - %s %s has been deleted in Shotgun. " % (record["entity"]["type"], 
+                                                                    record["entity"]["id"]))
         
-        log.info("")
-        log.info("Migration complete. %s records created in Shotgun" % len(sg_valid_records))
-     
+        return valid_records
+
+    ############################################################################################
+    # maintenance
+
+    def _get_maintenance_stats(self, cursor, sample_paths):
+        """
+        Measures the path cache db.
+        
+        :param cursor: Sqlite database cursor
+        :param sample_paths: List of (root_id, db_path) tuples to look up
+        :returns: Dictionary with keys size (in bytes, including any write-ahead log),
+                  num_records and lookup_time (average time in seconds per path lookup)
+        """
+        size = 0
+        for path in [self._path_cache_file, "%s-wal" % self._path_cache_file]:
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        
+        res = cursor.execute("SELECT count(*) FROM path_cache")
+        num_records = res.fetchone()[0]
+        
+        lookup_time = 0.0
+        if len(sample_paths) > 0:
+            start = time.time()
+            for (root_id, db_path) in sample_paths:
+                # same query as get_entity()
+                res = cursor.execute("""SELECT entity_type, entity_id, entity_name FROM path_cache 
+                                        WHERE root_id = ? AND path = ? AND primary_entity = 1""", 
+                                     (root_id, db_path))
+                res.fetchall()
+            lookup_time = (time.time() - start) / len(sample_paths)
+        
+        return {"size": size, "num_records": num_records, "lookup_time": lookup_time}
+    
+    def run_maintenance(self, log=None, dry_run=False):
+        """
+        Checks the path cache db for inconsistencies and fixes them, rebuilds 
+        its indices and compacts the db file. See MAINTENANCE_CHECKS for the 
+        problems that are being looked for. Problems which need to be resolved
+        in Shotgun are reported but left in place.
+        
+        :param log: Std python logger object.
+        :param dry_run: Only report problems, don't make any changes.
+        :returns: Dictionary with keys problems, a list of (description, count) 
+                  tuples, and before and after, both dictionaries with size, 
+                  num_records and lookup_time keys. The after key is None
+                  for a dry run.
+        """
+        if self._path_cache_disabled:
+            raise TankError("This project does not have a path cache!")
+        
+        c = self._connection.cursor()
+        try:
+            res = c.execute("PRAGMA quick_check")
+            result = [x[0] for x in res.fetchall()]
+            if result != ["ok"]:
+                raise TankError("The path cache db '%s' is damaged and cannot be repaired: %s" % 
+                                (self._path_cache_file, "; ".join(result)))
+            
+            # pick a random set of paths for measuring lookup times
+            res = c.execute("""SELECT root_id, path FROM path_cache WHERE primary_entity = 1 
+                               ORDER BY random() LIMIT ?""", (MAINTENANCE_NUM_SAMPLES, ))
+            sample_paths = res.fetchall()
+
+            before = self._get_maintenance_stats(c, sample_paths)
+            
+            problems = []
+            if dry_run:
+                for (description, count_sql, fix_sql) in MAINTENANCE_CHECKS:
+                    res = c.execute(count_sql)
+                    problems.append((description, res.fetchone()[0]))
+                return {"problems": problems, "before": before, "after": None}
+            
+            # fix all problems and rebuild the indices in a single transaction
+            self._log_debug(log, "Fixing path cache problems...")
+            self._connection.commit()
+            self._connection.isolation_level = None
+            try:
+                self._begin_write(c)
+                try:
+                    for (description, count_sql, fix_sql) in MAINTENANCE_CHECKS:
+                        if fix_sql is None:
+                            res = c.execute(count_sql)
+                            problems.append((description, res.fetchone()[0]))
+                        else:
+                            c.execute(fix_sql)
+                            problems.append((description, c.rowcount))
+                    for statement in PATH_CACHE_INDICES.split(";"):
+                        if statement.strip():
+                            c.execute(statement)
+                    c.execute("REINDEX")
+                    c.execute("COMMIT")
+                except:
+                    c.execute("ROLLBACK")
+                    raise
+                
+                # VACUUM builds a compacted copy of the db in a separate file and 
+                # copies it back inside a single transaction, so the swap is atomic 
+                # for other connections, which keep working against the same file 
+                # throughout. Renaming a compacted file over the db would leave 
+                # them on the previous file, see _copy_from_shadow_db().
+                self._log_debug(log, "Compacting path cache...")
+                c.execute("VACUUM")
+                
+                res = c.execute("PRAGMA journal_mode")
+                if res.fetchone()[0].lower() == "wal":
+                    # the compacted db went through the write-ahead log 
+                    c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            finally:
+                self._connection.isolation_level = ""
+            
+            self._invalidate_lookup_cache()
+            after = self._get_maintenance_stats(c, sample_paths)
+        
+        finally:
+            c.close()
+        
+        return {"problems": problems, "before": before, "after": after}
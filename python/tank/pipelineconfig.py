@@ -106,6 +106,7 @@ class PipelineConfiguration(object):
         self._cache_folder = None
         self._path_cache_path = None
         self._use_shotgun_path_cache = None
+        self._use_path_cache_for_contexts = None
 
     def _load_metadata_from_sg(self):
         """
@@ -285,6 +286,39 @@ class PipelineConfiguration(object):
 
         return self._use_shotgun_path_cache
 
+    def get_path_cache_contexts_enabled(self):
+        """
+        Returns true if contexts for Tasks should be built from the folders 
+        registered in the path cache, falling back on Shotgun for Tasks 
+        without folders. This is turned on via the use_path_cache_for_contexts
+        setting in pipeline_configuration.yml.
+        """
+        if self._use_path_cache_for_contexts is None:
+            # try to get it from the cache file
+            data = pipelineconfig_utils.get_metadata(self._pc_root)
+            self._use_path_cache_for_contexts = bool(data.get("use_path_cache_for_contexts", False))
+
+        return self._use_path_cache_for_contexts
+
+    def get_path_cache_location(self):
+        """
+        Returns the location of the path cache file for this configuration, 
+        as previously resolved and set up on disk by the path cache. 
+        
+        :returns: Path to the path cache file or None if not yet resolved
+        """
+        return self._path_cache_path
+    
+    def set_path_cache_location(self, path):
+        """
+        Remembers the location of the path cache file once it has been resolved
+        and set up on disk, so that subsequent path cache instances don't have
+        to do this work again.
+        
+        :param path: Path to the path cache file
+        """
+        self._path_cache_path = path
+
     def turn_on_shotgun_path_cache(self):
         """
         Updates the pipeline configuration settings to have the shotgun based (v0.15+)
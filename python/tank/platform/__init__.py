@@ -11,6 +11,7 @@
 
 # Engine management
 from .engine import start_engine, current_engine, get_engine_path, find_app_settings
+from .engine import prepare_context, start_prepared_engine
 
 # base classes to derive from
 from .application import Application
@@ -14,7 +14,10 @@ Defines the base class for all Tank Engines.
 """
 
 import os
+import logging
+import Queue
 import sys
+import threading
 import traceback
 import weakref
         
@@ -1163,6 +1166,41 @@ def start_engine(engine_name, tk, context):
     # get environment and engine location
     (env, engine_descriptor) = __get_env_and_descriptor_for_engine(engine_name, tk, context)
 
+    return _start_engine(engine_name, tk, context, env, engine_descriptor)
+
+def start_prepared_engine(prepared_context):
+    """
+    Creates an engine for a context resolved by prepare_context() and makes 
+    it the current engine. This is the same as calling start_engine(), but 
+    the environment picked in the background is reused. Any previously running 
+    engine has to be destroyed first.
+    
+    Returns the newly created engine object.
+
+    Raises the error which happened while preparing the context, if any, and
+    TankEngineInitError if an engine could not be started for the context.
+    
+    :param prepared_context: PreparedContext instance
+    """
+    if prepared_context.error:
+        raise prepared_context.error
+    
+    # first ensure that an engine is not currently running
+    if current_engine():
+        raise TankError("An engine (%s) is already running! Before you can start a new engine, "
+                        "please shut down the previous one using the command "
+                        "tank.platform.current_engine().destroy()." % current_engine())
+    
+    return _start_engine(prepared_context.engine_name, 
+                         prepared_context.context.tank, 
+                         prepared_context.context, 
+                         prepared_context.env, 
+                         prepared_context.engine_descriptor)
+
+def _start_engine(engine_name, tk, context, env, engine_descriptor):
+    """
+    Creates an engine from the given environment and makes it the current engine.
+    """
     # make sure it exists locally
     if not engine_descriptor.exists_local():
         raise TankEngineInitError("Cannot start engine! %s does not exist on disk" % engine_descriptor)
@@ -1180,6 +1218,150 @@ def start_engine(engine_name, tk, context):
 
     return obj
 
+class PreparedContext(object):
+    """
+    A context resolved by prepare_context(), together with the environment 
+    picked for it. 
+    
+    If anything went wrong while resolving the context, the exception is 
+    stored in the error member and the other members may be None.
+    """
+    def __init__(self, engine_name):
+        self.engine_name = engine_name
+        self.context = None
+        self.env = None
+        self.engine_descriptor = None
+        # template fields for the context, keyed by template name
+        self.template_fields = {}
+        self.error = None
+
+def prepare_context(engine_name, tk, callback, entity=None, path=None, template_names=None):
+    """
+    Resolves a context in a background thread, so that an engine can switch
+    context without blocking its UI. The context is created from either a 
+    shotgun entity or a path, and the data it depends on is looked up up front:
+    the entity fields and paths, the fields for the given templates and the 
+    environment picked for the engine.
+    
+    When done, the callback is called with a PreparedContext. If an engine is 
+    running, the callback is executed in the main thread via the engine's 
+    execute_in_main_thread(), so that the UI can switch over in one step, 
+    for example by destroying the current engine and passing the prepared 
+    context to start_prepared_engine(). 
+    
+    If no engine is running, there is no way to get to the main thread and 
+    the callback is called in the background thread instead. Callers without 
+    an engine have to hand the prepared context over to their main thread 
+    themselves before starting an engine with it.
+    
+    Exceptions raised by the callback are logged via the engine, or via the
+    sgtk.platform logger if no engine is running.
+    
+    :param engine_name: Name of the engine to pick the environment for
+    :param tk: Sgtk API instance
+    :param callback: Function to call with the PreparedContext
+    :param entity: Shotgun entity dictionary with keys type and id to create the context for
+    :param path: Path to create the context for, if no entity is given
+    :param template_names: Optional list of names of templates to resolve fields for
+    
+    :returns: threading.Event which is set once the callback has been called
+    """
+    if entity is None and path is None:
+        raise TankError("Cannot prepare a context without an entity or a path!")
+    
+    # keep hold of the engine which is running now - the current engine 
+    # may have changed by the time the work is done
+    engine = current_engine()
+    
+    done = threading.Event()
+    _get_prepare_context_queue().put((done, (engine, engine_name, tk, callback, 
+                                             entity, path, template_names or [])))
+    return done
+
+# queue of requests for the background thread preparing contexts. A single,
+# long lived thread is used, so that the thread local shotgun connection of 
+# each Sgtk API instance is reused from one request to the next.
+g_prepare_context_queue = None
+g_prepare_context_lock = threading.Lock()
+
+def _get_prepare_context_queue():
+    """
+    Returns the request queue of the background thread preparing contexts, 
+    starting the thread the first time this is called.
+    
+    :returns: Queue.Queue instance
+    """
+    global g_prepare_context_queue
+    g_prepare_context_lock.acquire()
+    try:
+        if g_prepare_context_queue is None:
+            g_prepare_context_queue = Queue.Queue()
+            worker = threading.Thread(target=_prepare_context_worker, args=(g_prepare_context_queue,))
+            worker.setDaemon(True)
+            worker.start()
+        return g_prepare_context_queue
+    finally:
+        g_prepare_context_lock.release()
+
+def _prepare_context_worker(requests):
+    """
+    Processes the requests made via prepare_context(), one at a time. 
+    Runs in a background thread for the lifetime of the process.
+    
+    :param requests: Queue of (done event, _prepare_context() arguments) tuples 
+    """
+    while True:
+        (done, args) = requests.get()
+        try:
+            try:
+                _prepare_context(*args)
+            except Exception:
+                # the callback failed - keep going with the next request
+                engine = args[0]
+                msg = "Failed to call back with a prepared context!"
+                if engine:
+                    engine.log_exception(msg)
+                else:
+                    logging.getLogger("sgtk.platform").exception(msg)
+        finally:
+            done.set()
+
+def _prepare_context(engine, engine_name, tk, callback, entity, path, template_names):
+    """
+    Resolves a context and calls back with it, see prepare_context(). 
+    Runs in the background thread, and so does the callback if no engine
+    is running.
+    """
+    prepared_context = PreparedContext(engine_name)
+    try:
+        if entity is not None:
+            ctx = tk.context_from_entity(entity["type"], entity["id"])
+        else:
+            ctx = tk.context_from_path(path)
+        
+        # look up the locations of the context entity and the template fields. 
+        # These are cached on the context object and in the path cache.
+        ctx.entity_locations
+        templates = [ tk.templates[x] for x in template_names ]
+        if templates:
+            fields = ctx.as_template_fields_many(templates)
+            for (template_name, template) in zip(template_names, templates):
+                prepared_context.template_fields[template_name] = fields[template]
+        
+        (env, engine_descriptor) = __get_env_and_descriptor_for_engine(engine_name, tk, ctx)
+        
+        prepared_context.context = ctx
+        prepared_context.env = env
+        prepared_context.engine_descriptor = engine_descriptor
+    
+    except Exception, e:
+        prepared_context.error = e
+    
+    if engine:
+        engine.execute_in_main_thread(callback, prepared_context)
+    else:
+        callback(prepared_context)
+
 def find_app_settings(engine_name, app_name, tk, context):
     """
     Utility method to find the settings for an app in an engine in the
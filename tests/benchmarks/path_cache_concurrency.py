@@ -0,0 +1,178 @@
+# Copyright (c) 2013 Shotgun Software Inc.
+#
+# CONFIDENTIAL AND PROPRIETARY
+#
+# This work is provided "AS IS" and subject to the Shotgun Pipeline Toolkit
+# Source Code License included in this distribution package. See LICENSE.
+# By accessing, using, copying or modifying this work you indicate your
+# agreement to the Shotgun Pipeline Toolkit Source Code License. All rights
+# not expressly granted therein are reserved by Shotgun Software Inc.
+
+"""
+Benchmark for concurrent access to the path cache db.
+
+N reader processes carry out path -> entity lookups while a single writer
+process registers batches of folders, the way folder creation does. This is
+done once with the default rollback journal and once with the write-ahead
+log used for path caches on local storage.
+
+Usage: python path_cache_concurrency.py [num_readers] [seconds] [folder]
+
+The db is created in the given folder, which defaults to the temp folder.
+Point it at a network share to see how the rollback journal behaves there.
+"""
+
+import os
+import sys
+import time
+import shutil
+import sqlite3
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "python"))
+from tank import path_cache
+
+# number of folders in the db before the benchmark starts
+NUM_ROWS = 50000
+
+# number of folders registered in each write transaction
+WRITE_BATCH_SIZE = 20
+
+
+def _create_db(db_file, journal_mode):
+    """
+    Creates a path cache db with the current layout and populates it.
+    """
+    conn = sqlite3.connect(db_file)
+    if journal_mode == "wal":
+        conn.execute("PRAGMA page_size = %d" % path_cache.PATH_CACHE_PAGE_SIZE)
+        conn.execute("PRAGMA journal_mode = WAL")
+    conn.executescript("""
+        CREATE TABLE path_cache (entity_type text, entity_id integer, entity_name text, root text, path text, primary_entity integer, root_id integer, path_hash integer);
+        %s
+        """ % path_cache.PATH_CACHE_INDICES)
+    conn.executemany("INSERT INTO path_cache VALUES(?, ?, ?, 'primary', ?, 1, 1, ?)",
+                     [("Shot", x, "shot_%d" % x, "/seq/shot_%d" % x, path_cache._path_hash("/seq/shot_%d" % x))
+                      for x in range(NUM_ROWS)])
+    conn.commit()
+    conn.close()
+
+def _connect(db_file, journal_mode):
+    """
+    Connects to the db the way the path cache does.
+    """
+    conn = sqlite3.connect(db_file)
+    if journal_mode == "wal":
+        conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+def _reader(db_file, journal_mode, end_time, results):
+    """
+    Looks up random paths until the end time and reports the lookup latencies.
+    """
+    conn = _connect(db_file, journal_mode)
+    latencies = []
+    errors = 0
+    entity_id = os.getpid()
+    while time.time() < end_time:
+        entity_id = (entity_id * 7919 + 1) % NUM_ROWS
+        path = "/seq/shot_%d" % entity_id
+        start = time.time()
+        try:
+            conn.execute("""SELECT entity_type, entity_id, entity_name FROM path_cache
+                            WHERE path_hash = ? AND root_id = 1 AND primary_entity = 1 AND path = ?""",
+                         (path_cache._path_hash(path), path)).fetchall()
+        except sqlite3.OperationalError:
+            # database is locked
+            errors += 1
+        latencies.append(time.time() - start)
+    conn.close()
+    results.put(("reader", latencies, errors))
+
+def _writer(db_file, journal_mode, end_time, results):
+    """
+    Registers batches of new folders until the end time.
+    """
+    conn = _connect(db_file, journal_mode)
+    latencies = []
+    errors = 0
+    entity_id = NUM_ROWS
+    while time.time() < end_time:
+        rows = []
+        for x in range(WRITE_BATCH_SIZE):
+            path = "/seq/shot_%d" % entity_id
+            rows.append(("Shot", entity_id, "shot_%d" % entity_id, path, path_cache._path_hash(path)))
+            entity_id += 1
+        start = time.time()
+        try:
+            conn.executemany("INSERT INTO path_cache VALUES(?, ?, ?, 'primary', ?, 1, 1, ?)", rows)
+            conn.commit()
+        except sqlite3.OperationalError:
+            conn.rollback()
+            errors += 1
+        latencies.append(time.time() - start)
+    conn.close()
+    results.put(("writer", latencies, errors))
+
+def _percentile(values, fraction):
+    if len(values) == 0:
+        return 0.0
+    return sorted(values)[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_benchmark(folder, journal_mode, num_readers, duration):
+    """
+    Runs the benchmark for a journal mode and prints the results.
+    """
+    db_file = os.path.join(folder, "path_cache_%s.db" % journal_mode)
+    _create_db(db_file, journal_mode)
+
+    results = multiprocessing.Queue()
+    end_time = time.time() + duration
+    processes = [multiprocessing.Process(target=_writer, args=(db_file, journal_mode, end_time, results))]
+    for x in range(num_readers):
+        processes.append(multiprocessing.Process(target=_reader, args=(db_file, journal_mode, end_time, results)))
+    for p in processes:
+        p.start()
+
+    data = {"reader": ([], 0), "writer": ([], 0)}
+    for p in processes:
+        (role, latencies, errors) = results.get()
+        data[role] = (data[role][0] + latencies, data[role][1] + errors)
+    for p in processes:
+        p.join()
+
+    print "journal mode %s:" % journal_mode
+    for role in ["reader", "writer"]:
+        (latencies, errors) = data[role]
+        print "  %s: %8.0f ops/s  p50 %7.2fms  p99 %7.2fms  max %7.2fms  locked errors %d" % (
+                role,
+                len(latencies) / float(duration),
+                _percentile(latencies, 0.5) * 1000,
+                _percentile(latencies, 0.99) * 1000,
+                max(latencies or [0]) * 1000,
+                errors)
+
+def main():
+    num_readers = 8
+    duration = 10
+    folder = None
+    if len(sys.argv) > 1:
+        num_readers = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        duration = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        folder = tempfile.mkdtemp(dir=sys.argv[3])
+    else:
+        folder = tempfile.mkdtemp()
+
+    print "Path cache concurrency benchmark: %d readers, 1 writer, %ds per run" % (num_readers, duration)
+    print "Local file system: %s" % path_cache._is_local_filesystem(folder)
+    try:
+        for journal_mode in ["delete", "wal"]:
+            run_benchmark(folder, journal_mode, num_readers, duration)
+    finally:
+        shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    main()
@@ -9,9 +9,11 @@
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
 import os
+import threading
 import unittest2 as unittest
 
 from tank_test.tank_test_base import *
+from mock import Mock, patch
 
 import tank
 from tank.context import Context
@@ -63,6 +65,90 @@ class TestStartEngine(TankTestBase):
         engine = tank.platform.start_engine(engine_name, self.tk, self.context)
         self.assertRaises(TankError, tank.platform.start_engine, engine_name, self.tk, self.context)
     
+    def _prepare_context(self, **kwargs):
+        results = []
+        done = tank.platform.prepare_context("test_engine", self.tk, results.append, **kwargs)
+        done.wait()
+        self.assertEquals(1, len(results))
+        return results[0]
+    
+    def test_prepare_context(self):
+        prepared_context = self._prepare_context(path=self.shot_step_path)
+        self.assertEquals(None, prepared_context.error)
+        self.assertEquals(self.context, prepared_context.context)
+        self.assertEquals("test_engine", prepared_context.engine_name)
+        self.assertEquals(tank.platform.get_engine_path("test_engine", self.tk, self.context), 
+                          prepared_context.engine_descriptor.get_path())
+        
+        engine = tank.platform.start_prepared_engine(prepared_context)
+        self.assertEquals(engine, tank.platform.current_engine())
+        self.assertEquals(self.context, engine.context)
+        
+        # callbacks go via the running engine
+        engine.execute_in_main_thread = Mock(side_effect=lambda func, *args: func(*args))
+        prepared_context = self._prepare_context(entity=self.context.entity)
+        self.assertEquals(1, engine.execute_in_main_thread.call_count)
+        self.assertEquals(self.context.entity, prepared_context.context.entity)
+        
+        # an engine is already running
+        self.assertRaises(TankError, tank.platform.start_prepared_engine, prepared_context)
+    
+    def test_prepare_context_error(self):
+        prepared_context = self._prepare_context(path=self.shot_step_path, template_names=["no_such_template"])
+        self.assertTrue(isinstance(prepared_context.error, KeyError))
+        self.assertEquals(None, prepared_context.context)
+        self.assertRaises(KeyError, tank.platform.start_prepared_engine, prepared_context)
+        
+        self.assertRaises(TankError, tank.platform.prepare_context, "test_engine", self.tk, Mock())
+    
+    @patch("logging.Logger.exception")
+    def test_prepare_context_thread(self, log_exception):
+        # all contexts are prepared in the same thread, so that
+        # the shotgun connection is reused
+        threads = []
+        def _callback(prepared_context):
+            threads.append(threading.currentThread())
+            raise Exception("Callback failed!")
+        
+        for x in range(2):
+            tank.platform.prepare_context("test_engine", self.tk, _callback, path=self.shot_step_path).wait()
+        self.assertEquals(2, len(threads))
+        self.assertTrue(threads[0] is threads[1])
+        self.assertFalse(threads[0] is threading.currentThread())
+        # failing callbacks don't stop the thread
+        self.assertEquals(2, log_exception.call_count)
+    
+    @patch("logging.Logger.exception")
+    def test_prepare_context_callback_thread(self, log_exception):
+        threads = []
+        def _callback(prepared_context):
+            threads.append(threading.currentThread())
+            raise Exception("Callback failed!")
+        
+        # without an engine, the callback is called in the background thread
+        tank.platform.prepare_context("test_engine", self.tk, _callback, path=self.shot_step_path).wait()
+        self.assertFalse(threads[0] is threading.currentThread())
+        self.assertEquals(1, log_exception.call_count)
+        
+        # with an engine, it is handed over to the engine's main thread, 
+        # and failures are logged by the engine
+        engine = tank.platform.start_engine("test_engine", self.tk, self.context)
+        main_thread_calls = []
+        engine.execute_in_main_thread = Mock(side_effect=lambda func, *args: main_thread_calls.append((func, args)))
+        engine.log_exception = Mock()
+        tank.platform.prepare_context("test_engine", self.tk, _callback, path=self.shot_step_path).wait()
+        self.assertEquals(1, len(threads))
+        self.assertEquals(1, len(main_thread_calls))
+        
+        (func, args) = main_thread_calls[0]
+        self.assertRaises(Exception, func, *args)
+        self.assertTrue(threads[1] is threading.currentThread())
+        
+        engine.execute_in_main_thread.side_effect = Exception("Engine failed!")
+        tank.platform.prepare_context("test_engine", self.tk, _callback, path=self.shot_step_path).wait()
+        self.assertEquals(1, engine.log_exception.call_count)
+        self.assertEquals(1, log_exception.call_count)
+    
     def tearDown(self):
         
         
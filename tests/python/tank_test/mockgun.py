@@ -23,6 +23,7 @@ which is read from disk.
 
 
 import os, copy, datetime
+import threading
 import cPickle as pickle
 import pprint
 
@@ -92,6 +93,8 @@ class Shotgun(object):
 
         self.base_url = base_url
         
+        self._batch_lock = threading.Lock()
+        
         # let's make sure there is at least one event log id in our mock db
         data = {}
         data["event_type"] = "Hello_Mockgun_World"
@@ -414,6 +417,18 @@ class Shotgun(object):
             
         results = [row for row in self._db[entity_type].values() if self._row_matches_filters(entity_type, row, resolved_filters_2, filter_operator, retired_only)]
         
+        # sort - apply the keys in reverse order, relying on the sort being stable
+        for order_item in reversed(order or []):
+            results.sort(key=lambda row: self._get_field_from_row(entity_type, row, order_item["field_name"]),
+                         reverse=(order_item.get("direction", "asc") == "desc"))
+        
+        # paging
+        if limit:
+            if page:
+                results = results[(page - 1) * limit:page * limit]
+            else:
+                results = results[:limit]
+        
         if fields is None:
             fields = set(["type", "id"])
         else:
@@ -429,6 +444,14 @@ class Shotgun(object):
         return results[0] if results else None
     
     def batch(self, requests):
+        # tests may run batches from several threads against the same mockgun instance
+        self._batch_lock.acquire()
+        try:
+            return self._batch(requests)
+        finally:
+            self._batch_lock.release()
+    
+    def _batch(self, requests):
         results = []
         for request in requests:
             if request["request_type"] == "create":
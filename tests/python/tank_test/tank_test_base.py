@@ -120,6 +120,9 @@ class TankTestBase(unittest.TestCase):
         # move away previous data
         self._move_project_data()
         
+        # the path cache db of the previous test is gone, so forget its state
+        path_cache._close_marker_connections()
+        
         # create new structure
         os.makedirs(self.project_root)
         os.makedirs(self.pipeline_config_root)
@@ -205,8 +208,10 @@ class TankTestBase(unittest.TestCase):
         pc = path_cache.PathCache(self.tk)
         path_cache_file = pc._get_path_cache_location()
         pc.close()
-        if os.path.exists(path_cache_file):
-            os.remove(path_cache_file)
+        # including any write-ahead log files
+        for path in [path_cache_file, "%s-wal" % path_cache_file, "%s-shm" % path_cache_file]:
+            if os.path.exists(path):
+                os.remove(path)
             
         # clear global shotgun accessor
         tank.util.shotgun.g_sg_cached_connection = None
@@ -10,12 +10,14 @@
 
 import os
 import copy
+import pickle
 
 from tank_test.tank_test_base import *
 
 from mock import Mock, patch
 
 from tank import context
+from tank import path_cache
 from tank.errors import TankError
 from tank.template import TemplatePath
 from tank.templatekey import StringKey, IntegerKey
@@ -175,6 +177,39 @@ class TestEq(TestContext):
         self.assertTrue(context_1 == context_2)
         self.assertFalse(context_1 != context_2)
 
+    @patch("tank.util.login.get_current_user")
+    def test_hash(self, get_current_user):
+        get_current_user.return_value = self.current_user
+        
+        kws1 = copy.deepcopy(self.kws)
+        kws1["entity"]["foo"] = "foo"
+        kws1["additional_entities"] = [{"type":"Asset", "id":123}, None]
+        context_1 = context.Context(self.tk, **kws1)
+        kws2 = copy.deepcopy(self.kws)
+        kws2["additional_entities"] = [{"type":"Asset", "id":123, "foo":"bar"}, {"type":"Asset", "id":123}]
+        context_2 = context.Context(self.tk, **kws2)
+        
+        # hashing doesn't need to look up the user
+        self.assertEquals(hash(context_1), hash(context_2))
+        self.assertEquals(0, get_current_user.call_count)
+        
+        kws3 = copy.deepcopy(self.kws)
+        kws3["task"] = {"id":45, "type": "Task"}
+        context_3 = context.Context(self.tk, **kws3)
+        
+        contexts = set([context_1, context_2, context_3, copy.deepcopy(context_3)])
+        self.assertEquals(2, len(contexts))
+        self.assertTrue(context.Context(self.tk, **copy.deepcopy(kws2)) in contexts)
+        self.assertEquals({context_1: 1, context_3: 3}, dict([(context_2, 1), (context_3, 3)]))
+
+    def test_additional_entities_none(self):
+        kws1 = copy.deepcopy(self.kws)
+        kws1["additional_entities"] = [None]
+        context_1 = context.Context(self.tk, **kws1)
+        context_2 = context.Context(self.tk, **self.kws)
+        self.assertFalse(context_1 == context_2)
+        self.assertTrue(context_1 != context_2)
+
 class TestUser(TestContext):
     def setUp(self):
         super(TestUser, self).setUp()
@@ -274,6 +309,132 @@ class TestFromPath(TestContext):
 
 
 
+class TestFromPaths(TestContext):
+
+    @patch("tank.util.login.get_current_user")
+    def test_from_paths(self, get_current_user):
+        get_current_user.return_value = self.current_user
+        paths = [self.shot_path, 
+                 self.other_user_path,
+                 os.path.join(self.step_path, "work", "file.ma"),
+                 self.alt_1_step_path,
+                 os.path.abspath(os.path.join(self.project_root, ".."))]
+        
+        result = self.tk.contexts_from_paths(paths)
+        self.assertEquals(set(paths), set(result.keys()))
+        for path in paths:
+            self.assertEquals(self.tk.context_from_path(path), result[path])
+        
+        self.assertEquals(self.step["id"], result[paths[2]].step["id"])
+        self.assertEquals(self.other_user["id"], result[paths[1]].user["id"])
+        self.assertIsNone(result[paths[4]].project)
+
+
+def _add_path_from_other_process(test, path, entity):
+    """
+    Registers a folder in the path cache without this process being 
+    notified about the change, as if it had been done by another process.
+    """
+    listeners = path_cache._change_listeners[:]
+    del path_cache._change_listeners[:]
+    try:
+        test.add_production_path(path, entity)
+    finally:
+        path_cache._change_listeners.extend(listeners)
+
+
+class TestEntityChainCache(TestContext):
+
+    def setUp(self):
+        super(TestEntityChainCache, self).setUp()
+        context.set_entity_chain_cache_size(100)
+    
+    def tearDown(self):
+        context.set_entity_chain_cache_size(0)
+        super(TestEntityChainCache, self).tearDown()
+    
+    def test_cache(self):
+        work_path = os.path.join(self.step_path, "work")
+        os.makedirs(work_path)
+        file_path = os.path.join(work_path, "file.ma")
+        open(file_path, "w").close()
+        
+        result = self.tk.context_from_path(work_path)
+        self.assertEquals(self.step["id"], result.step["id"])
+        self.assertEquals({"hits": 0, "misses": 1, "evictions": 0, "size": 1, "max_size": 100}, 
+                          context.get_entity_chain_cache_stats())
+        
+        # files share the entities of their folder
+        self.assertEquals(result, self.tk.context_from_path(file_path))
+        self.assertEquals(result, self.tk.context_from_path(work_path + os.path.sep))
+        self.assertEquals(2, context.get_entity_chain_cache_stats()["hits"])
+        
+        # registering folders clears the cache
+        task = {"type": "Task", "id": 1, "name": "task_name"}
+        self.add_production_path(work_path, task)
+        self.assertEquals(0, context.get_entity_chain_cache_stats()["size"])
+        result = self.tk.context_from_path(file_path)
+        self.assertEquals(task["id"], result.task["id"])
+        
+        context.set_entity_chain_cache_size(0)
+        self.assertEquals(None, context.get_entity_chain_cache_stats())
+    
+    def test_changes_by_other_processes(self):
+        work_path = os.path.join(self.step_path, "work")
+        os.makedirs(work_path)
+        
+        result = self.tk.context_from_path(work_path)
+        self.assertEquals(None, result.task)
+        self.assertEquals(1, context.get_entity_chain_cache_stats()["size"])
+        
+        # folders registered by another process are picked up by the next lookup
+        task = {"type": "Task", "id": 1, "name": "task_name"}
+        _add_path_from_other_process(self, work_path, task)
+        self.assertEquals(1, context.get_entity_chain_cache_stats()["size"])
+        result = self.tk.context_from_path(work_path)
+        self.assertEquals(task["id"], result.task["id"])
+        self.assertEquals(0, context.get_entity_chain_cache_stats()["hits"])
+
+
+class TestFilesystemLocations(TestContext):
+
+    def setUp(self):
+        super(TestFilesystemLocations, self).setUp()
+        # a user sandbox holding the shot
+        self.user_sandbox_path = os.path.join(self.project_root, "users", "user_login")
+        self.add_production_path(self.user_sandbox_path, self.other_user)
+        self.sandbox_shot_path = os.path.join(self.user_sandbox_path, "Seq", "shot_code")
+        self.add_production_path(self.sandbox_shot_path, self.shot)
+    
+    @patch("tank.util.login.get_current_user")
+    def test_user_sandbox(self, get_current_user):
+        get_current_user.return_value = self.current_user
+        
+        ctx = context.Context(self.tk, project=self.project, entity=self.shot, user=self.other_user)
+        self.assertEquals([self.sandbox_shot_path], ctx.filesystem_locations)
+        
+        ctx = context.Context(self.tk, project=self.project, entity=self.shot)
+        paths = ctx.filesystem_locations
+        self.assertNotIn(self.sandbox_shot_path, paths)
+        self.assertIn(self.shot_path, paths)
+        self.assertIn(self.alt_1_shot_path, paths)
+    
+    def test_single_pass(self):
+        ctx = context.Context(self.tk, project=self.project, entity=self.shot, user=self.other_user)
+        
+        path_cache.reset_stats()
+        stats_enabled = path_cache.enable_stats(True)
+        try:
+            ctx.filesystem_locations
+            stats = path_cache.get_stats()
+        finally:
+            path_cache.enable_stats(stats_enabled)
+            path_cache.reset_stats()
+        
+        self.assertEquals(1, stats["methods"]["get_entities_many"]["calls"])
+        self.assertNotIn("get_entity", stats["methods"])
+
+
 class TestFromPathWithPrevious(TestContext):
 
     @patch("tank.util.login.get_current_user")
@@ -483,6 +644,100 @@ class TestFromEntity(TestContext):
         task = {"type": "Task", "id": 13, "name": "never_seen_me_before", "content": "no_content"}
         self.assertRaises(TankError, context.from_entity, self.tk, task["type"], task["id"])
 
+    @patch("tank.util.login.get_current_user")
+    def test_from_entities(self, get_current_user):
+        get_current_user.return_value = self.current_user
+        
+        task_2 = {"id": 2,
+                  "type": "Task",
+                  "content": "task_2_content",
+                  "project": self.project,
+                  "entity": self.seq}
+        self.add_to_sg_mock_db(task_2)
+        published_files = [{"id": 1, "type": "PublishedFile", "project": self.project, "task": self.task},
+                           {"id": 2, "type": "PublishedFile", "project": self.project, "entity": self.shot},
+                           {"id": 3, "type": "PublishedFile", "project": self.project}]
+        for published_file in published_files:
+            self.add_to_sg_mock_db(published_file)
+        
+        entities = [("Task", 1), ("Task", 2), ("Shot", self.shot["id"]), ("Project", self.project["id"]),
+                    ("PublishedFile", 1), ("PublishedFile", 2), ("PublishedFile", 3)]
+        
+        # tasks and published files are fetched with one query each
+        num_finds_before = self.tk.shotgun.finds
+        result = self.tk.contexts_from_entities(entities)
+        self.assertEquals(2, self.tk.shotgun.finds - num_finds_before)
+        
+        self.assertEquals(set(entities), set(result.keys()))
+        for (entity_type, entity_id) in entities:
+            self.assertEquals(context.from_entity(self.tk, entity_type, entity_id), result[(entity_type, entity_id)])
+        
+        self.check_entity(self.step, result[("Shot", self.shot["id"])].step)
+        self.assertEquals(self.task["id"], result[("PublishedFile", 1)].task["id"])
+        self.assertEquals(self.shot["id"], result[("PublishedFile", 2)].entity["id"])
+        self.assertEquals(self.project["id"], result[("PublishedFile", 3)].project["id"])
+        self.assertEquals("task_2_content", result[("Task", 2)].task["name"])
+        
+        self.assertRaises(TankError, self.tk.contexts_from_entities, [("Task", 1), ("Task", 13)])
+
+    @patch("tank.pipelineconfig.PipelineConfiguration.get_path_cache_contexts_enabled")
+    @patch("tank.util.login.get_current_user")
+    def test_task_from_path_cache(self, get_current_user, get_path_cache_contexts_enabled):
+        get_current_user.return_value = self.current_user
+        get_path_cache_contexts_enabled.return_value = True
+        
+        # extra task fields can only be found in shotgun, so make the hook return none
+        execute_core_hook = self.tk.execute_core_hook
+        def execute_core_hook_without_task_fields(hook_name, **kwargs):
+            if hook_name == "context_additional_entities":
+                return {}
+            return execute_core_hook(hook_name, **kwargs)
+        self.tk.execute_core_hook = execute_core_hook_without_task_fields
+        
+        task_path = os.path.join(self.step_path, "task_content")
+        self.add_production_path(task_path, {"type": "Task", "id": self.task["id"], "name": "task_content"})
+        
+        # the task folder resolves the context without a shotgun query
+        num_finds_before = self.tk.shotgun.finds
+        result = context.from_entity(self.tk, "Task", self.task["id"])
+        self.assertEquals(0, self.tk.shotgun.finds - num_finds_before)
+        
+        self.check_entity(self.project, result.project)
+        self.check_entity(self.shot, result.entity)
+        self.check_entity(self.step, result.step)
+        self.assertEquals(self.task["id"], result.task["id"])
+        self.assertEquals("task_content", result.task["name"])
+        
+        # tasks without folders fall back onto shotgun
+        task_2 = {"id": 2,
+                  "type": "Task",
+                  "content": "task_2_content",
+                  "project": self.project,
+                  "entity": self.seq}
+        self.add_to_sg_mock_db(task_2)
+        num_finds_before = self.tk.shotgun.finds
+        result = context.from_entity(self.tk, "Task", task_2["id"])
+        self.assertEquals(1, self.tk.shotgun.finds - num_finds_before)
+        self.assertEquals("task_2_content", result.task["name"])
+        self.check_entity(self.seq, result.entity)
+        
+        # as do task folders without a step folder above them, since the 
+        # step of the task can't be taken from the path cache
+        task_3 = {"id": 3,
+                  "type": "Task",
+                  "content": "task_3_content",
+                  "project": self.project,
+                  "entity": self.shot,
+                  "step": self.step}
+        self.add_production_path(os.path.join(self.shot_path, "task_3_content"), 
+                                 {"type": "Task", "id": task_3["id"], "name": "task_3_content"})
+        self.add_to_sg_mock_db(task_3)
+        num_finds_before = self.tk.shotgun.finds
+        result = context.from_entity(self.tk, "Task", task_3["id"])
+        self.assertEquals(1, self.tk.shotgun.finds - num_finds_before)
+        self.check_entity(self.shot, result.entity)
+        self.check_entity(self.step, result.step)
+
     def check_entity(self, first_entity, second_entity):
         "Checks two entity dictionaries have the same values for keys type, id and name."
         self.assertEquals(first_entity["type"], second_entity["type"])
@@ -589,6 +844,123 @@ class TestAsTemplateFields(TestContext):
         # Check that the shotgun method find_one was not used
         self.assertEqual(finds, self.tk.shotgun.finds)
 
+    def test_query_batched(self):
+        """
+        Test that all fields needed from an entity are fetched in one query 
+        and shared between contexts.
+        """
+        self.keys["shot_extra"] = StringKey("shot_extra", shotgun_entity_type="Shot", shotgun_field_name="extra_field")
+        self.keys["shot_code"] = StringKey("shot_code", shotgun_entity_type="Shot", shotgun_field_name="code")
+        template_1 = TemplatePath("/sequence/{Sequence}/{Shot}/{Step}/work/{shot_extra}.{shot_code}.ext", 
+                                  self.keys, self.project_root)
+        template_2 = TemplatePath("/sequence/{Sequence}/{Shot}/{Step}/publish/{shot_code}.ext", 
+                                  self.keys, self.project_root)
+        
+        finds = self.tk.shotgun.finds
+        result = self.ctx.as_template_fields_many([template_1, template_2])
+        self.assertEqual(finds + 1, self.tk.shotgun.finds)
+        self.assertEquals("extravalue", result[template_1]["shot_extra"])
+        self.assertEquals("shot_name", result[template_1]["shot_code"])
+        self.assertEquals("shot_name", result[template_2]["shot_code"])
+        self.assertEquals(self.ctx.as_template_fields(template_2), result[template_2])
+        
+        # a new context for the same api instance reuses the values
+        ctx = context.Context(self.tk, project=self.project, entity=self.shot, step=self.step)
+        self.assertEquals(result[template_1], ctx.as_template_fields(template_1))
+        self.assertEqual(finds + 1, self.tk.shotgun.finds)
+    
+    @patch("tank.context.time.time")
+    def test_query_expired(self, time_mock):
+        """
+        Test that values shared between contexts expire.
+        """
+        time_mock.return_value = 1000.0
+        self.keys["shot_extra"] = StringKey("shot_extra", shotgun_entity_type="Shot", shotgun_field_name="extra_field")
+        template = TemplatePath("/sequence/{Sequence}/{Shot}/{Step}/work/{shot_extra}.ext", self.keys, self.project_root)
+        self.ctx.as_template_fields(template)
+        
+        finds = self.tk.shotgun.finds
+        time_mock.return_value = 1000.0 + context.SG_FIELD_CACHE_TTL + 1
+        ctx = context.Context(self.tk, project=self.project, entity=self.shot, step=self.step)
+        self.assertEquals("extravalue", ctx.as_template_fields(template)["shot_extra"])
+        self.assertEqual(finds + 1, self.tk.shotgun.finds)
+
+    @patch("tank.api.Tank.paths_from_entity")
+    def test_cached_results(self, paths_from_entity):
+        """
+        Test that results are cached per template until the path cache changes.
+        """
+        paths_from_entity.return_value = [self.shot_path, self.alt_1_shot_path]
+        result = self.ctx.as_template_fields(self.template)
+        self.assertEquals(1, paths_from_entity.call_count)
+        
+        # the cached values can't be changed by the caller
+        result["Shot"] = "changed"
+        self.assertEquals("shot_code", self.ctx.as_template_fields(self.template)["Shot"])
+        self.assertEquals(1, paths_from_entity.call_count)
+        
+        # folder creation invalidates the cached results
+        self.add_production_path(os.path.join(self.step_path, "work"), {"type": "Shot", "id": 99, "name": "other"})
+        self.assertEquals("shot_code", self.ctx.as_template_fields(self.template)["Shot"])
+        self.assertEquals(2, paths_from_entity.call_count)
+        self.ctx.as_template_fields(self.template)
+        self.assertEquals(2, paths_from_entity.call_count)
+        
+        # and so do folders registered by other processes
+        _add_path_from_other_process(self, os.path.join(self.step_path, "publish"), 
+                                     {"type": "Shot", "id": 98, "name": "other"})
+        self.assertEquals("shot_code", self.ctx.as_template_fields(self.template)["Shot"])
+        self.assertEquals(3, paths_from_entity.call_count)
+
+    @patch("tank.api.Tank.paths_from_entity")
+    def test_cached_results_check(self, paths_from_entity):
+        """
+        Test that looking for changes made by other processes doesn't open a path cache.
+        """
+        paths_from_entity.return_value = [self.shot_path, self.alt_1_shot_path]
+        self.ctx.as_template_fields(self.template)
+        
+        _add_path_from_other_process(self, os.path.join(self.step_path, "publish"), 
+                                     {"type": "Shot", "id": 98, "name": "other"})
+        self.assertEquals("shot_code", self.ctx.as_template_fields(self.template)["Shot"])
+        self.assertEquals(2, paths_from_entity.call_count)
+        
+        patcher = patch("tank.context.PathCache")
+        path_cache_mock = patcher.start()
+        try:
+            self.assertEquals("shot_code", self.ctx.as_template_fields(self.template)["Shot"])
+            self.assertEquals(2, paths_from_entity.call_count)
+            self.assertFalse(path_cache_mock.called)
+        finally:
+            patcher.stop()
+
+    def test_shared_ancestors(self):
+        """
+        Test that templates sharing a branch of the template tree share the template ancestors.
+        """
+        template = TemplatePath("/sequence/{Sequence}/{Shot}/{Step}/work/{static_key}", self.keys, self.project_root)
+        ancestors = context._get_template_ancestors(template)
+        self.assertEquals(["sequence/{Sequence}", 
+                           "sequence/{Sequence}/{Shot}", 
+                           "sequence/{Sequence}/{Shot}/{Step}", 
+                           "sequence/{Sequence}/{Shot}/{Step}/work", 
+                           "sequence/{Sequence}/{Shot}/{Step}/work/{static_key}"], 
+                          [ x.definition for x in ancestors ])
+        
+        self_ancestors = context._get_template_ancestors(self.template)
+        self.assertEquals(4, len(self_ancestors))
+        for (ancestor, self_ancestor) in zip(ancestors, self_ancestors):
+            self.assertTrue(ancestor is self_ancestor)
+        
+        # validation results of the shared templates are reused
+        entities = {"Shot": self.shot, "Step": self.step}
+        entity_paths = self.ctx._get_entity_paths(entities)
+        validation_cache = {}
+        self.ctx._fields_from_template_tree(template, {}, entities, entity_paths, validation_cache)
+        num_validations = len(validation_cache)
+        self.ctx._fields_from_template_tree(self.template, {}, entities, entity_paths, validation_cache)
+        self.assertEquals(num_validations, len(validation_cache))
+
     def test_shot_step(self):
         expected_step_name = "step_short_name"
         expected_shot_name = "shot_code"
@@ -851,3 +1223,45 @@ class TestSerailize(TestContext):
         serialized = tank.context.serialize(context_1)
         context_2 = tank.context.deserialize(serialized)
         self.assertTrue(context_1 == context_2)
+
+    def test_live_instance(self):
+        context_1 = context.Context(**self.kws)
+        context_2 = tank.context.deserialize(tank.context.serialize(context_1))
+        self.assertTrue(context_2.tank is self.tk)
+        context_2 = yaml.load(yaml.dump(context_1))
+        self.assertTrue(context_2.tank is self.tk)
+    
+    @patch("tank.api.get_live_instance")
+    def test_lazy_instance(self, get_live_instance):
+        get_live_instance.return_value = None
+        context_1 = context.Context(**self.kws)
+        context_2 = tank.context.deserialize(tank.context.serialize(context_1))
+        self.assertEquals(None, context_2._Context__tk)
+        self.assertTrue(context_1.entity == context_2.entity)
+        
+        # the api instance is created on first access
+        self.assertEquals(self.tk.pipeline_configuration.get_path(), 
+                          context_2.tank.pipeline_configuration.get_path())
+        self.assertFalse(context_2.tank is self.tk)
+    
+    def test_format(self):
+        context_1 = context.Context(**self.kws)
+        serialized = tank.context.serialize(context_1, use_json=True)
+        self.assertTrue(serialized.startswith("{"))
+        context_2 = tank.context.deserialize(serialized)
+        self.assertEquals(str, type(context_2.entity["name"]))
+        self.assertTrue(context_1 == context_2)
+        
+        # pickle is the default, so that older versions can read the contexts
+        data = {"project": self.project,
+                "entity": self.shot,
+                "user": None,
+                "step": self.step,
+                "task": {"id": 45, "type": "Task"},
+                "additional_entities": [],
+                "_pc_path": self.tk.pipeline_configuration.get_path()}
+        self.assertEquals(data, pickle.loads(tank.context.serialize(context_1)))
+        context_2 = tank.context.deserialize(pickle.dumps(data))
+        self.assertTrue(context_1.entity == context_2.entity)
+        
+        self.assertRaises(TankError, tank.context.deserialize, serialized.replace('"_version":1', '"_version":99'))
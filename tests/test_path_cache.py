@@ -9,14 +9,26 @@
 # not expressly granted therein are reserved by Shotgun Software Inc.
 
 import os
+import sys
+import glob
 import sqlite3
 import shutil
+import gzip
+import logging
+import StringIO
+import unittest2 as unittest
+
+from mock import patch
 
 from tank_test.tank_test_base import *
 
 from tank import path_cache
 from tank import folder
 from tank.platform import constants
+from tank.errors import TankError
+from tank.deploy.tank_commands.path_cache import (UnregisterFoldersAction, FolderSyncAgentAction, 
+                                                  ExportFoldersAction, ImportFoldersAction, 
+                                                  PathCacheMaintenanceAction, PathCacheStatsAction)
 
 def add_item_to_cache(path_cache, entity, path, primary = True):
     
@@ -60,6 +72,30 @@ class TestInit(TestPathCache):
         pc.close()
         self.assertTrue(os.path.exists(self.path_cache_location))
 
+    def test_location_cached(self):
+        """Test that the path cache location is only resolved once per configuration"""
+        self.path_cache.close()
+        self.assertEquals(self.path_cache_location, self.tk.pipeline_configuration.get_path_cache_location())
+        
+        def _hook_not_expected(*args, **kwargs):
+            raise Exception("Unexpected hook execution!")
+        
+        hook_fn = self.tk.execute_core_hook_method
+        self.tk.execute_core_hook_method = _hook_not_expected
+        try:
+            self.path_cache = path_cache.PathCache(self.tk)
+            self.assertEquals(self.path_cache_location, self.path_cache._path_cache_file)
+            self.path_cache.close()
+            
+            # once the settings are reloaded, the location is resolved again
+            self.tk.pipeline_configuration._clear_cached_settings()
+            self.assertRaises(Exception, path_cache.PathCache, self.tk)
+        finally:
+            self.tk.execute_core_hook_method = hook_fn
+        
+        self.path_cache = path_cache.PathCache(self.tk)
+        self.assertEquals(self.path_cache_location, self.path_cache._path_cache_file)
+
     def test_root_map(self):
         """Test that mapping of project root locations is created"""
         # More specific testing of loading roots happens in test_root
@@ -68,12 +104,244 @@ class TestInit(TestPathCache):
         
     def test_db_columns(self):
         """Test that expected columns are created in db"""
-        expected = ["entity_type", "entity_id", "entity_name", "root", "path", "primary_entity"]
+        expected = ["entity_type", "entity_id", "entity_name", "root", "path", "primary_entity", "root_id", "path_hash"]
         self.db_cursor = self.path_cache._connection.cursor()
         ret = self.db_cursor.execute("PRAGMA table_info(path_cache)")
         column_names = [x[1] for x in ret.fetchall()]
         self.assertEquals(expected, column_names)
 
+    def test_roots_registered(self):
+        """Test that all storage roots are registered in the root table"""
+        self.db_cursor = self.path_cache._connection.cursor()
+        ret = self.db_cursor.execute("SELECT id, name FROM path_cache_root")
+        root_ids = dict([(x[1], x[0]) for x in ret.fetchall()])
+        for root_name in self.path_cache._roots:
+            self.assertIn(root_name, root_ids)
+        self.assertEquals(root_ids, self.path_cache._root_ids)
+
+    def test_lookups_use_covering_indices(self):
+        """Test that path lookups are served from an index alone"""
+        self.db_cursor = self.path_cache._connection.cursor()
+        ret = self.db_cursor.execute("""EXPLAIN QUERY PLAN 
+                                        SELECT entity_type, entity_id, entity_name FROM path_cache 
+                                        WHERE root_id = ? AND path = ? AND primary_entity = 1""", 
+                                     (1, "/foo"))
+        plan = " ".join([str(x[-1]) for x in ret.fetchall()])
+        self.assertIn("COVERING INDEX path_cache_tree", plan)
+        
+        ret = self.db_cursor.execute("""EXPLAIN QUERY PLAN 
+                                        SELECT path, primary_entity, entity_type, entity_id, entity_name 
+                                        FROM path_cache WHERE root_id = ? AND path IN (?, ?)""", 
+                                     (1, "/foo", "/bar"))
+        plan = " ".join([str(x[-1]) for x in ret.fetchall()])
+        self.assertIn("COVERING INDEX path_cache_tree", plan)
+        
+        ret = self.db_cursor.execute("""EXPLAIN QUERY PLAN 
+                                        SELECT root_id, path FROM path_cache 
+                                        WHERE entity_type = ? AND entity_id = ? and primary_entity = 1""", 
+                                     ("Shot", 1))
+        plan = " ".join([str(x[-1]) for x in ret.fetchall()])
+        self.assertIn("INDEX path_cache_all", plan)
+    
+    def test_file_size(self):
+        """Test that the path cache db is smaller than one using the previous layout"""
+        rows = [ ("Step", x, "step_%d" % x, "/sequences/seq_%03d/shot_%04d/step_%d/work" % (x / 1000, x, x % 4)) 
+                 for x in range(5000) ]
+        
+        legacy_db = os.path.join(self.tank_temp, "legacy_size.db")
+        conn = sqlite3.connect(legacy_db)
+        conn.executescript("""
+            CREATE TABLE path_cache (entity_type text, entity_id integer, entity_name text, root text, path text, primary_entity integer);
+            CREATE INDEX path_cache_entity ON path_cache(entity_type, entity_id);
+            CREATE INDEX path_cache_path ON path_cache(root, path, primary_entity);
+            CREATE UNIQUE INDEX path_cache_all ON path_cache(entity_type, entity_id, root, path, primary_entity);
+            """)
+        conn.executemany("INSERT INTO path_cache VALUES(?, ?, ?, 'primary', ?, 1)", rows)
+        conn.commit()
+        conn.close()
+        
+        db = os.path.join(self.tank_temp, "size.db")
+        conn = sqlite3.connect(db)
+        conn.executescript(path_cache.PATH_CACHE_TABLES)
+        conn.executemany("INSERT INTO path_cache(entity_type, entity_id, entity_name, root, path, "
+                         "primary_entity, root_id, path_hash) VALUES(?, ?, ?, 'primary', ?, 1, 1, ?)", 
+                         [ x + (path_cache._path_hash(x[3]), ) for x in rows ])
+        conn.commit()
+        conn.close()
+        
+        try:
+            self.assertTrue(os.path.getsize(db) < os.path.getsize(legacy_db))
+        finally:
+            os.remove(db)
+            os.remove(legacy_db)
+    
+    def test_upgrade_layout_3(self):
+        """Test that the indices of a path cache holding the path in every index are replaced"""
+        shot_1_path = os.path.join(self.project_root, "seq", "shot_1")
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, shot_1_path)
+        self.path_cache._connection.executescript("""
+            DROP INDEX path_cache_all;
+            CREATE INDEX path_cache_path ON path_cache(path_hash, root_id, primary_entity, path, entity_type, entity_id, entity_name);
+            CREATE UNIQUE INDEX path_cache_all ON path_cache(entity_type, entity_id, primary_entity, root_id, path);
+            CREATE INDEX path_cache_root_path ON path_cache(root, path, primary_entity);
+            PRAGMA user_version = 3;
+            """)
+        self.path_cache.close()
+        
+        self.path_cache = path_cache.PathCache(self.tk)
+        ret = self.path_cache._connection.execute("SELECT name, sql FROM sqlite_master "
+                                                  "WHERE type='index' AND tbl_name='path_cache'")
+        index_sql = dict(ret.fetchall())
+        self.assertEquals(["path_cache_all", "path_cache_tree"], sorted(index_sql.keys()))
+        self.assertIn("path_hash", index_sql["path_cache_all"])
+        self.assertEquals({"type": "Shot", "id": 1, "name": "shot_1"}, self.path_cache.get_entity(shot_1_path))
+
+    def test_upgrade_legacy_schema(self):
+        """Test that a path cache storing root names in each row is upgraded in place"""
+        self.path_cache.close()
+        os.remove(self.path_cache_location)
+        
+        # create a path cache using the previous layout
+        conn = sqlite3.connect(self.path_cache_location)
+        conn.executescript("""
+            CREATE TABLE path_cache (entity_type text, entity_id integer, entity_name text, root text, path text, primary_entity integer);
+            CREATE INDEX path_cache_entity ON path_cache(entity_type, entity_id);
+            CREATE INDEX path_cache_path ON path_cache(root, path, primary_entity);
+            CREATE UNIQUE INDEX path_cache_all ON path_cache(entity_type, entity_id, root, path, primary_entity);
+            CREATE TABLE event_log_sync (last_id integer);
+            CREATE TABLE shotgun_status (path_cache_id integer, shotgun_id integer);
+            CREATE UNIQUE INDEX shotgun_status_id ON shotgun_status(path_cache_id);
+            INSERT INTO path_cache VALUES('Shot', 1, 'shot_1', 'primary', '/seq/shot_1', 1);
+            INSERT INTO path_cache VALUES('Shot', 2, 'shot_2', 'alternate_1', '/seq/shot_2', 1);
+            INSERT INTO path_cache VALUES('Sequence', 3, 'seq', 'primary', '/seq/shot_1', 0);
+            INSERT INTO shotgun_status VALUES(2, 22);
+            INSERT INTO event_log_sync VALUES(123);
+            """)
+        conn.commit()
+        conn.close()
+        
+        self.path_cache = path_cache.PathCache(self.tk)
+        
+        ret = self.path_cache._connection.execute("PRAGMA table_info(path_cache)")
+        field_names = [x[1] for x in ret.fetchall()]
+        self.assertIn("root_id", field_names)
+        self.assertIn("root", field_names)
+        
+        shot_1_path = os.path.join(self.project_root, "seq", "shot_1")
+        shot_2_path = os.path.join(self.alt_root_1, "seq", "shot_2")
+        
+        self.assertEquals({"type": "Shot", "id": 1, "name": "shot_1"}, self.path_cache.get_entity(shot_1_path))
+        self.assertEquals({"type": "Shot", "id": 2, "name": "shot_2"}, self.path_cache.get_entity(shot_2_path))
+        self.assertEquals([{"type": "Sequence", "id": 3, "name": "seq"}], 
+                          self.path_cache.get_secondary_entities(shot_1_path))
+        self.assertEquals([shot_2_path], self.path_cache.get_paths("Shot", 2, primary_only=True))
+        
+        # row ids must be preserved so that the shotgun status table stays valid
+        ret = self.path_cache._connection.execute("""SELECT pc.entity_id FROM path_cache pc 
+                                                     JOIN shotgun_status ss ON ss.path_cache_id = pc.rowid 
+                                                     WHERE ss.shotgun_id = 22""")
+        self.assertEquals([(2,)], ret.fetchall())
+        
+        # and the db is now tagged with the current schema version
+        ret = self.path_cache._connection.execute("PRAGMA user_version")
+        self.assertEquals(path_cache.PATH_CACHE_SCHEMA_VERSION, ret.fetchone()[0])
+
+    def test_earlier_core_versions(self):
+        """Test that the db stays usable for earlier core versions which only know the root names"""
+        shot_1_path = os.path.join(self.project_root, "seq", "shot_1")
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, shot_1_path)
+        
+        # earlier core versions look up and register folders by root name
+        conn = self.path_cache._connection
+        ret = conn.execute("SELECT entity_type, entity_id, entity_name FROM path_cache "
+                           "WHERE path = ? AND root = ? and primary_entity = 1", ("/seq/shot_1", "primary"))
+        self.assertEquals([("Shot", 1, "shot_1")], ret.fetchall())
+        conn.execute("INSERT INTO path_cache(entity_type, entity_id, entity_name, root, path, primary_entity) "
+                     "VALUES('Shot', 2, 'shot_2', 'alternate_1', '/seq/shot_2', 1)")
+        # a duplicate of an existing row, synchronized from shotgun
+        ret = conn.execute("INSERT INTO path_cache(entity_type, entity_id, entity_name, root, path, primary_entity) "
+                           "VALUES('Shot', 1, 'shot_1', 'primary', '/seq/shot_1', 1)")
+        conn.execute("INSERT INTO shotgun_status(path_cache_id, shotgun_id) VALUES(?, 1234)", (ret.lastrowid, ))
+        conn.commit()
+        self.path_cache.close()
+        
+        # and these folders are picked up the next time the path cache is opened
+        self.path_cache = path_cache.PathCache(self.tk)
+        shot_2_path = os.path.join(self.alt_root_1, "seq", "shot_2")
+        self.assertEquals({"type": "Shot", "id": 2, "name": "shot_2"}, self.path_cache.get_entity(shot_2_path))
+        self.assertEquals([shot_2_path], self.path_cache.get_paths("Shot", 2, primary_only=True))
+        ret = self.path_cache._connection.execute("SELECT count(*) FROM path_cache WHERE path_hash IS NULL OR root_id IS NULL")
+        self.assertEquals(0, ret.fetchone()[0])
+        
+        # the duplicate is removed without leaving an orphaned shotgun status record
+        self.assertEquals([shot_1_path], self.path_cache.get_paths("Shot", 1, primary_only=True))
+        ret = self.path_cache._connection.execute("SELECT count(*) FROM shotgun_status WHERE shotgun_id = 1234 OR "
+                                                  "path_cache_id NOT IN (SELECT rowid FROM path_cache)")
+        self.assertEquals(0, ret.fetchone()[0])
+
+    def test_schema_version(self):
+        """Test that the layout of a versioned db is not probed on startup"""
+        ret = self.path_cache._connection.execute("PRAGMA user_version")
+        self.assertEquals(path_cache.PATH_CACHE_SCHEMA_VERSION, ret.fetchone()[0])
+        self.path_cache.close()
+        
+        def _upgrade_not_expected(*args, **kwargs):
+            raise Exception("Unexpected schema upgrade!")
+        
+        upgrade_fn = path_cache.PathCache._upgrade_schema
+        path_cache.PathCache._upgrade_schema = _upgrade_not_expected
+        try:
+            self.path_cache = path_cache.PathCache(self.tk)
+        finally:
+            path_cache.PathCache._upgrade_schema = upgrade_fn
+        
+    def test_local_settings(self):
+        """Test that write-ahead logging is only used for path caches on local storage"""
+        self.path_cache.close()
+        
+        is_local_fn = path_cache._is_local_filesystem
+        for (is_local, journal_mode, page_size) in [(True, "wal", path_cache.PATH_CACHE_PAGE_SIZE), 
+                                                    (False, "delete", None)]:
+            os.remove(self.path_cache_location)
+            path_cache._is_local_filesystem = lambda path: is_local
+            try:
+                self.path_cache = path_cache.PathCache(self.tk)
+            finally:
+                path_cache._is_local_filesystem = is_local_fn
+            ret = self.path_cache._connection.execute("PRAGMA journal_mode")
+            self.assertEquals(journal_mode, ret.fetchone()[0].lower())
+            if page_size:
+                ret = self.path_cache._connection.execute("PRAGMA page_size")
+                self.assertEquals(page_size, ret.fetchone()[0])
+            self.path_cache.close()
+        
+        self.path_cache = path_cache.PathCache(self.tk)
+        
+    @patch("__builtin__.open")
+    def test_is_local_filesystem(self, open_mock):
+        """Test the detection of network file systems"""
+        mounts = ("rootfs / rootfs rw 0 0\n"
+                  "/dev/sda1 /home ext4 rw 0 0\n"
+                  "server:/export /home/shared nfs4 rw 0 0\n"
+                  "/dev/sdb1 /mnt/local\\040disk xfs rw 0 0\n")
+        open_mock.side_effect = lambda *args: StringIO.StringIO(mounts)
+        
+        for (path, expected) in [("/home/user/path_cache.db", True),
+                                 ("/home/shared/path_cache.db", False),
+                                 ("/home/shared", False),
+                                 ("/home/sharedfoo/path_cache.db", True),
+                                 ("/mnt/local disk/path_cache.db", True)]:
+            self.assertEquals(expected, path_cache._is_local_filesystem_linux(path))
+        
+        # platforms without a check are treated as network storage
+        path_cache._local_filesystem_lookup.clear()
+        platform = sys.platform
+        sys.platform = "sunos5"
+        try:
+            self.assertFalse(path_cache._is_local_filesystem(self.path_cache_location))
+        finally:
+            sys.platform = platform
+            path_cache._local_filesystem_lookup.clear()
 
 
 class TestAddMapping(TestPathCache):
@@ -96,7 +364,7 @@ class TestAddMapping(TestPathCache):
         full_path = os.path.join(self.project_root, relative_path)
         add_item_to_cache(self.path_cache, self.entity, full_path)
 
-        res = self.db_cursor.execute("SELECT path, root FROM path_cache WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]))
+        res = self.db_cursor.execute("SELECT pc.path, pcr.name FROM path_cache pc JOIN path_cache_root pcr ON pcr.id = pc.root_id WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]))
         entry = res.fetchall()[0]
         self.assertEquals("/shot", entry[0])
         self.assertEquals("primary", entry[1])
@@ -121,7 +389,7 @@ class TestAddMapping(TestPathCache):
         self.assertRaises(tank.TankError, add_item_to_cache, self.path_cache, ne2, full_path)         
 
         # finally, make sure that there is exactly a single record in the db representing the path
-        res = self.db_cursor.execute("SELECT path, root FROM path_cache WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]))
+        res = self.db_cursor.execute("SELECT pc.path, pcr.name FROM path_cache pc JOIN path_cache_root pcr ON pcr.id = pc.root_id WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]))
         self.assertEqual( len(res.fetchall()), 1)
         
 
@@ -173,7 +441,7 @@ class TestAddMapping(TestPathCache):
         self.assertEquals( paths[0], full_path)
 
         # finally, make sure that there no dupe records
-        res = self.db_cursor.execute("SELECT path, root FROM path_cache WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]+3))
+        res = self.db_cursor.execute("SELECT pc.path, pcr.name FROM path_cache pc JOIN path_cache_root pcr ON pcr.id = pc.root_id WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]+3))
         self.assertEqual( len(res.fetchall()), 1)
 
 
@@ -186,7 +454,7 @@ class TestAddMapping(TestPathCache):
         full_path = os.path.join(self.alt_root_1, relative_path)
         add_item_to_cache(self.path_cache, self.entity, full_path)
 
-        res = self.db_cursor.execute("SELECT path, root FROM path_cache WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]))
+        res = self.db_cursor.execute("SELECT pc.path, pcr.name FROM path_cache pc JOIN path_cache_root pcr ON pcr.id = pc.root_id WHERE entity_type = ? AND entity_id = ?", (self.entity["type"], self.entity["id"]))
         entry = res.fetchall()[0]
         self.assertEquals("/shot", entry[0])
         self.assertEquals("alternate_1", entry[1])
@@ -207,6 +475,278 @@ class TestAddMapping(TestPathCache):
         self.assertEquals(entity_name, entry[0])
 
 
+class TestBatchMappings(TestPathCache):
+    """
+    Tests for validating and adding lists of mappings in one go.
+    """
+    def setUp(self):
+        super(TestBatchMappings, self).setUp()
+        self.db_cursor = self.path_cache._connection.cursor()
+        # the fixtures register the project roots
+        res = self.db_cursor.execute("SELECT count(*) FROM path_cache")
+        self.num_fixture_rows = res.fetchone()[0]
+
+    def _mapping(self, entity_id, path, primary=True, name=None):
+        entity = {"type": "Shot", "id": entity_id, "name": name or "shot_%s" % entity_id}
+        return {"entity": entity, "path": path, "primary": primary, "metadata": {}}
+
+    def test_bulk_insert(self):
+        """
+        Test that a large batch, including in-batch duplicates, is inserted correctly.
+        """
+        data = []
+        for x in range(1500):
+            data.append(self._mapping(x, os.path.join(self.project_root, "seq", "shot_%s" % x)))
+        # add some secondary entities and duplicates
+        shot_0_path = os.path.join(self.project_root, "seq", "shot_0")
+        data.append(self._mapping(5000, shot_0_path, primary=False))
+        data.append(self._mapping(5000, shot_0_path, primary=False))
+        data.append(self._mapping(0, shot_0_path, name="renamed"))
+        
+        self.path_cache.validate_mappings(data)
+        self.path_cache.add_mappings(data, "Shot", [])
+        
+        res = self.db_cursor.execute("SELECT count(*) FROM path_cache")
+        self.assertEquals(1501 + self.num_fixture_rows, res.fetchone()[0])
+        
+        # row ids are handed back for the newly created items only
+        self.assertFalse("path_cache_row_id" in data[-1])
+        res = self.db_cursor.execute("SELECT entity_id FROM path_cache WHERE rowid = ?", (data[1234]["path_cache_row_id"],))
+        self.assertEquals(1234, res.fetchone()[0])
+        
+        self.assertEquals({"type": "Shot", "id": 0, "name": "shot_0"}, self.path_cache.get_entity(shot_0_path))
+        self.assertEquals([{"type": "Shot", "id": 5000, "name": "shot_5000"}], 
+                          self.path_cache.get_secondary_entities(shot_0_path))
+
+    def test_in_batch_conflict(self):
+        """
+        Test that conflicts within a batch are detected and nothing is written.
+        """
+        path = os.path.join(self.project_root, "seq", "shot_a")
+        data = [self._mapping(1, os.path.join(self.project_root, "seq", "shot_b")),
+                self._mapping(2, path), 
+                self._mapping(3, path)]
+        
+        self.assertRaisesRegexp(tank.TankError, 
+                                "Database concurrency problems: The path '%s'" % path, 
+                                self.path_cache.add_mappings, data, "Shot", [])
+        
+        res = self.db_cursor.execute("SELECT count(*) FROM path_cache")
+        self.assertEquals(self.num_fixture_rows, res.fetchone()[0])
+
+    def test_validation_order(self):
+        """
+        Test that the first conflicting item in a batch is reported.
+        """
+        seq_path = os.path.join(self.project_root, "seq")
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, os.path.join(seq_path, "shot_1"))
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 2, "name": "shot_2"}, os.path.join(seq_path, "shot_2"))
+        
+        # renamed shot 2, then a path clash with shot 1
+        data = [self._mapping(3, os.path.join(seq_path, "shot_3")),
+                self._mapping(2, os.path.join(seq_path, "shot_2_renamed")),
+                self._mapping(4, os.path.join(seq_path, "shot_1"))]
+        
+        self.assertRaisesRegexp(tank.TankError, 
+                                "The path '%s' cannot be created because another" % os.path.join(seq_path, "shot_2_renamed"),
+                                self.path_cache.validate_mappings, data)
+        
+        self.assertRaisesRegexp(tank.TankError, 
+                                "The path '%s' cannot be processed because it is already associated "
+                                "with Shot 'shot_1'" % os.path.join(seq_path, "shot_1"),
+                                self.path_cache.validate_mappings, data[2:])
+        
+        # secondary items are not validated
+        self.path_cache.validate_mappings([self._mapping(4, os.path.join(seq_path, "shot_1"), primary=False)])
+
+
+class TestGetEntitiesUnder(TestPathCache):
+    """
+    Tests for subtree lookups.
+    """
+    def setUp(self):
+        super(TestGetEntitiesUnder, self).setUp()
+        self.seq_path = os.path.join(self.project_root, "seq")
+        self.shot_path = os.path.join(self.seq_path, "shot_1")
+        self.task_path = os.path.join(self.shot_path, "anim")
+        
+        add_item_to_cache(self.path_cache, {"type": "Sequence", "id": 1, "name": "seq"}, self.seq_path)
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, self.shot_path)
+        add_item_to_cache(self.path_cache, {"type": "Task", "id": 1, "name": "anim"}, self.task_path)
+        add_item_to_cache(self.path_cache, {"type": "Step", "id": 1, "name": "anim"}, self.task_path, primary=False)
+        # siblings sorting close to the shot folder
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 2, "name": "shot_1-b"}, os.path.join(self.seq_path, "shot_1-b"))
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 3, "name": "shot_10"}, os.path.join(self.seq_path, "shot_10"))
+        # same relative path in another storage
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 4, "name": "shot_1"}, 
+                          os.path.join(self.alt_root_1, "seq", "shot_1"))
+
+    def test_subtree(self):
+        items = list(self.path_cache.get_entities_under(self.shot_path))
+        self.assertEquals([self.shot_path, self.task_path, self.task_path], [x["path"] for x in items])
+        self.assertEquals([("Shot", 1, True), ("Step", 1, False), ("Task", 1, True)], 
+                          sorted([(x["entity"]["type"], x["entity"]["id"], x["primary"]) for x in items]))
+
+    def test_entity_type_filter(self):
+        items = list(self.path_cache.get_entities_under(self.seq_path, entity_types=["Shot", "Step"]))
+        self.assertEquals([("Shot", 1), ("Step", 1), ("Shot", 2), ("Shot", 3)], 
+                          sorted([(x["entity"]["type"], x["entity"]["id"]) for x in items], 
+                                 key=lambda x: x[1]))
+        self.assertEquals([], list(self.path_cache.get_entities_under(self.seq_path, entity_types=[])))
+
+    def test_invalid_path(self):
+        self.assertEquals([], list(self.path_cache.get_entities_under(os.path.join(self.project_root, "missing"))))
+        self.assertEquals([], list(self.path_cache.get_entities_under("/some/other/place")))
+
+    def test_range_scan(self):
+        """Test that the lookup is a range scan of the subtree index"""
+        cursor = self.path_cache._connection.cursor()
+        ret = cursor.execute("""EXPLAIN QUERY PLAN 
+                                SELECT path, entity_type, entity_id, entity_name, primary_entity
+                                FROM path_cache
+                                WHERE root_id = ? AND path >= ? AND path < ? AND (path >= ? OR path = ?)
+                                ORDER BY path""", (1, "/a", "/a0", "/a/", "/a"))
+        plan = " ".join([str(x[-1]) for x in ret.fetchall()])
+        self.assertIn("COVERING INDEX path_cache_tree (root_id=? AND path>? AND path<?)", plan)
+
+
+class TestMaintenance(TestPathCache):
+    """
+    Tests for the path cache integrity checks.
+    """
+    def setUp(self):
+        super(TestMaintenance, self).setUp()
+        self.shot_path = os.path.join(self.project_root, "seq", "shot_1")
+        self.shot_2_path = os.path.join(self.project_root, "seq", "shot_2")
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, self.shot_path)
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 2, "name": "shot_2"}, self.shot_2_path)
+        
+        # now damage the db. A copy of a record with a stale path hash gets 
+        # past the unique index.
+        self.path_cache._connection.executescript("""
+            INSERT INTO path_cache(entity_type, entity_id, entity_name, root, root_id, path, path_hash, primary_entity) 
+                SELECT entity_type, entity_id, entity_name, root, root_id, path, 0, primary_entity FROM path_cache WHERE entity_type = 'Shot' AND entity_id = 1;
+            INSERT INTO path_cache(entity_type, entity_id, entity_name, root, root_id, path, path_hash, primary_entity) 
+                SELECT entity_type, 3, 'shot_3', root, root_id, path, path_hash, primary_entity FROM path_cache WHERE entity_type = 'Shot' AND entity_id = 2;
+            INSERT INTO path_cache(entity_type, entity_id, entity_name, root_id, path, path_hash, primary_entity) 
+                VALUES('Shot', 4, 'shot_4', 999, '/seq/shot_4', 0, 1);
+            INSERT INTO shotgun_status(path_cache_id, shotgun_id) VALUES(12345, 1);
+            INSERT INTO event_log_sync(last_id) VALUES(10);
+            INSERT INTO event_log_sync(last_id) VALUES(11);
+            INSERT INTO sync_agent(pid, host, interval, last_poll) VALUES(1, 'host', 10.0, 0.0);
+            """)
+        self.path_cache._connection.commit()
+    
+    def test_maintenance(self):
+        # a dry run checks for each problem separately, so a record 
+        # can be reported more than once
+        result = self.path_cache.run_maintenance(dry_run=True)
+        self.assertEquals([1, 2, 1, 1, 2, 1, 2, 1], [x[1] for x in result["problems"]])
+        self.assertEquals(None, result["after"])
+        self.assertRaises(TankError, self.path_cache.get_entity, self.shot_2_path)
+        
+        result = self.path_cache.run_maintenance()
+        # conflicting primary records are reported but not removed, since 
+        # they also exist in Shotgun. The remaining stale path hash went 
+        # with the duplicate record.
+        self.assertEquals([1, 1, 1, 0, 0, 1, 2, 1], [x[1] for x in result["problems"]])
+        self.assertEquals(result["before"]["num_records"] - 2, result["after"]["num_records"])
+        
+        self.assertEquals({"type": "Shot", "id": 1, "name": "shot_1"}, self.path_cache.get_entity(self.shot_path))
+        self.assertRaises(TankError, self.path_cache.get_entity, self.shot_2_path)
+        
+        ret = self.path_cache._connection.execute("SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='path_cache'")
+        self.assertIn("path_cache_all", [x[0] for x in ret.fetchall()])
+        ret = self.path_cache._connection.execute("SELECT last_id FROM event_log_sync")
+        self.assertEquals([(11,)], ret.fetchall())
+        
+        action = PathCacheMaintenanceAction()
+        action.tk = self.tk
+        result = action.run_noninteractive(logging.getLogger("test_maintenance"), {"dry_run": True})
+        self.assertEquals([0, 1, 0, 0, 0, 0, 0, 0], [x[1] for x in result["problems"]])
+        
+        # the conflicts are left for the unregister_folders command to resolve
+        result = action.run_noninteractive(logging.getLogger("test_maintenance"), {"dry_run": False})
+        self.assertEquals([0, 1, 0, 0, 0, 0, 0, 0], [x[1] for x in result["problems"]])
+
+
+class TestStats(TestPathCache):
+    """
+    Tests for the path cache access statistics.
+    """
+    def setUp(self):
+        super(TestStats, self).setUp()
+        self.shot_path = os.path.join(self.project_root, "seq", "shot_1")
+        path_cache.reset_stats()
+        self._stats_enabled = path_cache.enable_stats(False)
+    
+    def tearDown(self):
+        path_cache.enable_stats(self._stats_enabled)
+        path_cache.reset_stats()
+        super(TestStats, self).tearDown()
+    
+    def test_disabled(self):
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, self.shot_path)
+        self.path_cache.get_entity(self.shot_path)
+        stats = path_cache.get_stats()
+        self.assertEquals({}, stats["methods"])
+        self.assertEquals(0, stats["lock_waits"]["calls"])
+    
+    def test_stats(self):
+        path_cache.enable_stats(True)
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, self.shot_path)
+        for x in range(3):
+            self.path_cache.get_entity(self.shot_path)
+        self.path_cache.get_paths("Shot", 1, True)
+        
+        stats = path_cache.get_stats()
+        self.assertEquals(3, stats["methods"]["get_entity"]["calls"])
+        self.assertEquals(3, sum(stats["methods"]["get_entity"]["histogram"]))
+        self.assertEquals(len(path_cache.LATENCY_BUCKETS) + 1, len(stats["methods"]["get_entity"]["histogram"]))
+        self.assertEquals(1, stats["methods"]["get_paths"]["calls"])
+        self.assertEquals(1, stats["methods"]["add_mappings"]["calls"])
+        self.assertTrue(stats["methods"]["get_entity"]["max_time"] <= stats["methods"]["get_entity"]["total_time"])
+        # add_mappings takes the write lock
+        self.assertEquals(1, stats["lock_waits"]["calls"])
+        self.assertEquals(len(stats["methods"]) + 1, len(path_cache.format_stats(stats)))
+        
+        path_cache.reset_stats()
+        self.assertEquals({}, path_cache.get_stats()["methods"])
+    
+    def test_generator_stats(self):
+        path_cache.enable_stats(True)
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, self.shot_path)
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 2, "name": "shot_2"}, self.shot_path + "_2")
+        seq_path = os.path.dirname(self.shot_path)
+        
+        # nothing is recorded until the items have been produced
+        items = self.path_cache.get_entities_under(seq_path)
+        self.assertFalse("get_entities_under" in path_cache.get_stats()["methods"])
+        self.assertEquals(2, len(list(items)))
+        self.assertEquals(1, path_cache.get_stats()["methods"]["get_entities_under"]["calls"])
+        
+        # a generator which is closed early is recorded too
+        items = self.path_cache.get_entities_under(seq_path)
+        items.next()
+        items.close()
+        self.assertEquals(2, path_cache.get_stats()["methods"]["get_entities_under"]["calls"])
+    
+    def test_command(self):
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_1"}, self.shot_path)
+        workload_file = os.path.join(self.tank_temp, "workload.txt")
+        fh = open(workload_file, "wt")
+        fh.write("# shots\n%s\n\n%s\n" % (self.shot_path, os.path.join(self.project_root, "unknown")))
+        fh.close()
+        
+        action = PathCacheStatsAction()
+        action.tk = self.tk
+        stats = action.run_noninteractive(logging.getLogger("test_stats"), {"path": workload_file, "repeat": 2})
+        self.assertEquals(4, stats["methods"]["get_entity"]["calls"])
+        self.assertEquals(2, stats["methods"]["get_paths"]["calls"])
+        # the previous setting is restored
+        self.assertEquals(False, path_cache.enable_stats(False))
+
+
 class TestGetEntity(TestPathCache):
     """
     Tests for get_entity. 
@@ -267,6 +807,74 @@ class TestGetEntity(TestPathCache):
         result = self.path_cache.get_entity(non_project_path)
         self.assertIsNone(result)
 
+    def test_get_entities_many(self):
+        shot_path = os.path.join(self.project_root, "seq", "shot_name")
+        seq_path = os.path.join(self.project_root, "seq")
+        add_item_to_cache(self.path_cache, {"type": "Shot", "id": 1, "name": "shot_name"}, shot_path)
+        add_item_to_cache(self.path_cache, {"type": "Sequence", "id": 2, "name": "seq"}, shot_path, primary=False)
+        paths = [shot_path, seq_path, self.project_root, self.alt_root_1, 
+                 os.path.join("path", "not", "in", "project")]
+        
+        # bypass the chunking limit to make sure that results are combined correctly
+        max_parameters = path_cache.SQLITE_MAX_PARAMETERS
+        path_cache.SQLITE_MAX_PARAMETERS = 2
+        try:
+            result = self.path_cache.get_entities_many(paths)
+        finally:
+            path_cache.SQLITE_MAX_PARAMETERS = max_parameters
+        
+        self.assertEquals(set(paths), set(result.keys()))
+        for path in paths:
+            self.assertEquals((self.path_cache.get_entity(path), self.path_cache.get_secondary_entities(path)), 
+                              result[path])
+        self.assertEquals(({"type": "Shot", "id": 1, "name": "shot_name"}, [{"type": "Sequence", "id": 2, "name": "seq"}]), 
+                          result[shot_path])
+        self.assertEquals((None, []), result[seq_path])
+
+
+    def test_get_entity_ancestry_many(self):
+        shot = {"type": "Shot", "id": 1, "name": "shot_name"}
+        step = {"type": "Step", "id": 3, "name": "step_name"}
+        shot_path = os.path.join(self.project_root, "seq", "shot_name")
+        step_path = os.path.join(shot_path, "step_name")
+        alt_shot_path = os.path.join(self.alt_root_1, "seq", "shot_name")
+        add_item_to_cache(self.path_cache, shot, shot_path)
+        add_item_to_cache(self.path_cache, step, step_path)
+        add_item_to_cache(self.path_cache, shot, alt_shot_path)
+        add_item_to_cache(self.path_cache, {"type": "Sequence", "id": 2, "name": "seq"}, shot_path, primary=False)
+        
+        entities = [("Shot", 1), ("Step", 3), ("Shot", 2)]
+        
+        # bypass the chunking limit to make sure that results are combined correctly
+        max_parameters = path_cache.SQLITE_MAX_PARAMETERS
+        path_cache.SQLITE_MAX_PARAMETERS = 2
+        try:
+            result = self.path_cache.get_entity_ancestry_many(entities)
+        finally:
+            path_cache.SQLITE_MAX_PARAMETERS = max_parameters
+        
+        self.assertEquals(set(entities), set(result.keys()))
+        self.assertEquals([], result[("Shot", 2)])
+        
+        project = {"type": "Project", "id": self.project["id"], "name": self.project["name"]}
+        self.assertEquals([(step_path, [step, shot, None, project])], result[("Step", 3)])
+        self.assertEquals(sorted([(shot_path, [shot, None, project]), (alt_shot_path, [shot, None, project])]), 
+                          sorted(result[("Shot", 1)]))
+        
+        # the results match the paths and entities for the folders
+        for (key, ancestry) in result.items():
+            self.assertEquals(sorted(self.path_cache.get_paths(key[0], key[1], primary_only=True)), 
+                              sorted([ x[0] for x in ancestry ]))
+        
+        # the results are cached
+        result[("Step", 3)][0][1][0]["name"] = "changed"
+        self.assertEquals(step, self.path_cache.get_entity_ancestry_many([("Step", 3)])[("Step", 3)][0][1][0])
+
+    def test_get_db_path_chain(self):
+        self.assertEquals(["/seq/shot", "/seq", ""], path_cache._get_db_path_chain("/seq/shot"))
+        self.assertEquals(["seq/shot", "seq", ""], path_cache._get_db_path_chain("seq/shot"))
+        self.assertEquals([""], path_cache._get_db_path_chain(""))
+
 
 class TestGetPaths(TestPathCache):
     def test_add_and_find_shot(self):
@@ -297,6 +905,41 @@ class TestGetPaths(TestPathCache):
         self.assertIn(self.project_root, result)
         self.assertIn(self.alt_root_1, result)
 
+    def test_get_paths_many(self):
+        shot_paths = {}
+        for shot_id in range(1, 6):
+            e = {"type": "Shot", "id": shot_id, "name": "shot_%d" % shot_id}
+            shot_paths[shot_id] = [os.path.join(self.project_root, "seq", e["name"]),
+                                   os.path.join(self.alt_root_1, "seq", e["name"])]
+            for path in shot_paths[shot_id]:
+                add_item_to_cache(self.path_cache, e, path)
+        # a secondary entity
+        add_item_to_cache(self.path_cache, {"type": "Sequence", "id": 1, "name": "seq"}, 
+                          shot_paths[1][0], primary=False)
+        
+        entities = [("Shot", x) for x in range(1, 8)] + [("Sequence", 1)]
+        
+        # bypass the id chunking limit to make sure that results are combined correctly
+        max_parameters = path_cache.SQLITE_MAX_PARAMETERS
+        path_cache.SQLITE_MAX_PARAMETERS = 2
+        try:
+            for primary_only in [True, False]:
+                result = self.path_cache.get_paths_many(entities, primary_only=primary_only)
+                self.assertEquals(set(entities), set(result.keys()))
+                for (entity_type, entity_id) in entities:
+                    self.assertEquals(self.path_cache.get_paths(entity_type, entity_id, primary_only), 
+                                      result[(entity_type, entity_id)])
+        finally:
+            path_cache.SQLITE_MAX_PARAMETERS = max_parameters
+        
+        self.assertEquals(sorted(shot_paths[2]), sorted(result[("Shot", 2)]))
+        self.assertEquals([], result[("Shot", 7)])
+        self.assertEquals([shot_paths[1][0]], result[("Sequence", 1)])
+        
+        # and the api wrapper
+        result = self.tk.paths_from_entities([("Shot", 3), ("Shot", 7)])
+        self.assertEquals({("Shot", 3): self.tk.paths_from_entity("Shot", 3), ("Shot", 7): []}, result)
+
 class Test_SeperateRoots(TestPathCache):
     def test_different_case(self):
         """
@@ -311,6 +954,36 @@ class Test_SeperateRoots(TestPathCache):
         self.assertEquals(os.sep + relative_path, relative_result)
 
 
+class TestLookupCache(unittest.TestCase):
+    """
+    Tests for the size limited store of lookup results.
+    """
+    def test_least_recently_used(self):
+        cache = path_cache._LookupCache(2)
+        cache.validate(1)
+        cache.set("a", 1, cache.generation)
+        cache.set("b", 2, cache.generation)
+        self.assertEquals((True, 1), cache.get("a"))
+        
+        # b is now the least recently used item
+        cache.set("c", 3, cache.generation)
+        self.assertEquals((False, None), cache.get("b"))
+        self.assertEquals((True, 1), cache.get("a"))
+        self.assertEquals((True, 3), cache.get("c"))
+        self.assertEquals(1, cache.get_stats()["evictions"])
+        
+        cache.resize(1)
+        self.assertEquals((False, None), cache.get("a"))
+        self.assertEquals((True, 3), cache.get("c"))
+        self.assertEquals(2, cache.get_stats()["evictions"])
+        
+        # values read before the cache was cleared are discarded
+        generation = cache.generation
+        cache.validate(2)
+        cache.set("d", 4, generation)
+        self.assertEquals(0, cache.get_stats()["size"])
+
+
 class TestShotgunSync(TankTestBase):
     
     def setUp(self, project_tank_name = "project_code"):
@@ -426,16 +1099,622 @@ class TestShotgunSync(TankTestBase):
         # and that the content is the same
         path_cache_contents_3 = self._get_path_cache()
         self.assertEqual(path_cache_contents_3, path_cache_contents_1)
+
+    def test_full_sync_shadow_db(self):
+        """Test that a full sync does not affect the path cache until it is complete."""
         
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)
+        path_cache_contents = self._get_path_cache()
         
+        pc = tank.path_cache.PathCache(self.tk)
+        pcl = pc._get_path_cache_location()
+        pc.close()
+        
+        # the new records are built in a separate file, while 
+        # other processes still see the existing data
+        seen_by_others = []
+        insert_fn = tank.path_cache.PathCache._insert_sg_records
+        def _failing_insert(*args, **kwargs):
+            insert_fn(*args, **kwargs)
+            self.assertEqual(len(glob.glob("%s.*.sync" % pcl)), 1)
+            seen_by_others.extend(self._get_path_cache())
+            raise Exception("Interrupted sync!")
         
+        tank.path_cache.PathCache._insert_sg_records = _failing_insert
+        try:
+            self.assertRaises(Exception, sync_path_cache, self.tk, True)
+        finally:
+            tank.path_cache.PathCache._insert_sg_records = insert_fn
         
+        self.assertEqual(seen_by_others, path_cache_contents)
+        self.assertEqual(self._get_path_cache(), path_cache_contents)
+        self.assertEqual(glob.glob("%s.*.sync" % pcl), [])
         
+        sync_path_cache(self.tk, force_full_sync=True)
+        self.assertEqual(sorted(self._get_path_cache()), sorted(path_cache_contents))
+        self.assertEqual(glob.glob("%s.*.sync" % pcl), [])
+    
+    def test_concurrent_full_sync(self):
+        """Test that full syncs of the same path cache running at the same time don't interfere."""
         
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)
+        path_cache_contents = self._get_path_cache()
         
+        pc = tank.path_cache.PathCache(self.tk)
+        pcl = pc._get_path_cache_location()
+        pc.close()
         
+        # another full sync runs while the shadow db of the first one is being built
+        shadow_files = []
+        insert_fn = tank.path_cache.PathCache._insert_sg_records
+        def _concurrent_insert(*args, **kwargs):
+            result = insert_fn(*args, **kwargs)
+            if not shadow_files:
+                shadow_files.extend(glob.glob("%s.*.sync" % pcl))
+                sync_path_cache(self.tk, force_full_sync=True)
+                # the shadow db of the first sync is left alone
+                self.assertEqual(glob.glob("%s.*.sync" % pcl), shadow_files)
+            return result
         
+        tank.path_cache.PathCache._insert_sg_records = _concurrent_insert
+        try:
+            sync_path_cache(self.tk, force_full_sync=True)
+        finally:
+            tank.path_cache.PathCache._insert_sg_records = insert_fn
         
+        self.assertEqual(len(shadow_files), 1)
+        self.assertEqual(sorted(self._get_path_cache()), sorted(path_cache_contents))
+        self.assertEqual(glob.glob("%s.*.sync" % pcl), [])
 
+    def _get_create_events(self):
+        return self.tk.shotgun.find("EventLogEntry", [["event_type", "is", "Toolkit_Folders_Create"]], ["meta"])
+
+    def test_chunked_upload(self):
+        """Test that records are uploaded in chunks under a single event."""
+        
+        num_events = len(self._get_create_events())
+        batch_size = tank.path_cache.SG_BATCH_SIZE
+        tank.path_cache.SG_BATCH_SIZE = 2
+        try:
+            folder.process_filesystem_structure(self.tk, 
+                                                self.task["type"], 
+                                                self.task["id"], 
+                                                preview=False,
+                                                engine=None)
+        finally:
+            tank.path_cache.SG_BATCH_SIZE = batch_size
+        
+        # project / seq / shot / step
+        sg_records = self.tk.shotgun.find(tank.path_cache.SHOTGUN_ENTITY, [])
+        self.assertEqual(len(sg_records), 4)
+        self.assertEqual(len(self._get_path_cache()), 4)
+        
+        events = self._get_create_events()
+        self.assertEqual(len(events), num_events + 1)
+        self.assertEqual(len(events[-1]["meta"]["sg_folder_ids"]), 3)
+
+    def test_partial_upload(self):
+        """Test that a failed upload can be resumed."""
+        
+        sg = self.tk.shotgun
+        batch_fn = sg.batch
+        self.num_batches = 0
+        def _failing_batch(requests):
+            self.num_batches += 1
+            if self.num_batches == 2:
+                raise Exception("Connection lost!")
+            return batch_fn(requests)
+        
+        num_events = len(self._get_create_events())
+        batch_size = tank.path_cache.SG_BATCH_SIZE
+        tank.path_cache.SG_BATCH_SIZE = 1
+        sg.batch = _failing_batch
+        try:
+            self.assertRaises(tank.TankError, 
+                              folder.process_filesystem_structure, 
+                              self.tk, 
+                              self.task["type"], 
+                              self.task["id"], 
+                              preview=False,
+                              engine=None)
+        finally:
+            tank.path_cache.SG_BATCH_SIZE = batch_size
+            del sg.batch
+        
+        # the first record made it into shotgun and the path cache, and was announced
+        self.assertEqual(len(sg.find(tank.path_cache.SHOTGUN_ENTITY, [])), 2)
+        self.assertEqual(len(self._get_path_cache()), 2)
+        events = self._get_create_events()
+        self.assertEqual(len(events), num_events + 1)
+        self.assertEqual(len(events[-1]["meta"]["sg_folder_ids"]), 1)
+        
+        # a second run picks up the rest
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)
+        self.assertEqual(len(sg.find(tank.path_cache.SHOTGUN_ENTITY, [])), 4)
+        self.assertEqual(len(self._get_path_cache()), 4)
+        
+        path_cache = tank.path_cache.PathCache(self.tk)
+        c = path_cache._connection.cursor()
+        self.assertEqual(len(list(c.execute("select * from shotgun_status"))), 4)
+        c.close()
+        path_cache.close()
+        
+        # and the result is the same as a full sync
+        path_cache_contents = self._get_path_cache()
+        sync_path_cache(self.tk, force_full_sync=True)
+        self.assertEqual(self._get_path_cache(), path_cache_contents)
+
+    def test_failed_event_upload(self):
+        """Test that records are removed from Shotgun if they cannot be announced."""
+        
+        sg = self.tk.shotgun
+        create_fn = sg.create
+        def _failing_create(entity_type, data, return_fields=None):
+            if entity_type == "EventLogEntry":
+                raise Exception("Connection lost!")
+            return create_fn(entity_type, data, return_fields)
+        
+        sg.create = _failing_create
+        try:
+            self.assertRaises(tank.TankError, 
+                              folder.process_filesystem_structure, 
+                              self.tk, 
+                              self.task["type"], 
+                              self.task["id"], 
+                              preview=False,
+                              engine=None)
+        finally:
+            del sg.create
+        
+        # no orphans in shotgun and nothing written locally
+        self.assertEqual(len(sg.find(tank.path_cache.SHOTGUN_ENTITY, [])), 1)
+        self.assertEqual(len(self._get_path_cache()), 1)
+
+    def test_reconcile_with_shotgun(self):
+        """Test the comparison and upload of path cache data to Shotgun."""
+        
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)
+        sg = self.tk.shotgun
+        sg_records = sg.find(tank.path_cache.SHOTGUN_ENTITY, [], ["linked_entity_type", "is_primary"])
+        self.assertEqual(len(sg_records), 4)
+        sg_records = dict([ (x["linked_entity_type"], x) for x in sg_records ])
+        
+        # missing in shotgun
+        sg.delete(tank.path_cache.SHOTGUN_ENTITY, sg_records["Shot"]["id"])
+        # different primary flag
+        sg.update(tank.path_cache.SHOTGUN_ENTITY, sg_records["Sequence"]["id"], {"is_primary": False})
+        # only in shotgun
+        sg.create(tank.path_cache.SHOTGUN_ENTITY, {"project": self.project,
+                                                   "linked_entity_type": "Shot",
+                                                   "linked_entity_id": 1234,
+                                                   "path": {"local_path": os.path.join(self.project_root, "extra")},
+                                                   "is_primary": True})
+        # linked to an entity which doesn't exist in shotgun
+        pc = tank.path_cache.PathCache(self.tk)
+        pc._connection.execute("INSERT INTO path_cache(entity_type, entity_id, entity_name, root_id, path, primary_entity) "
+                               "VALUES('Shot', 5678, 'deleted', ?, '/deleted', 1)", (pc._root_ids["primary"],))
+        pc._connection.commit()
+        pc.close()
+        
+        num_events = len(self._get_create_events())
+        log = logging.getLogger("test_reconcile")
+        
+        page_size = tank.path_cache.SG_PAGE_SIZE
+        batch_size = tank.path_cache.SG_BATCH_SIZE
+        tank.path_cache.SG_PAGE_SIZE = 2
+        tank.path_cache.SG_BATCH_SIZE = 1
+        pc = tank.path_cache.PathCache(self.tk)
+        try:
+            expected = {"missing": 1, "mismatched": 1, "extra": 1, "invalid": 1}
+            self.assertEqual(pc.ensure_all_entries_are_in_shotgun(log, dry_run=True), expected)
+            self.assertEqual(len(sg.find(tank.path_cache.SHOTGUN_ENTITY, [])), 4)
+            self.assertEqual(len(self._get_create_events()), num_events)
+            
+            self.assertEqual(pc.ensure_all_entries_are_in_shotgun(log, num_threads=3), expected)
+            self.assertEqual(len(sg.find(tank.path_cache.SHOTGUN_ENTITY, [])), 5)
+            # the update is announced separately
+            self.assertEqual(len(self._get_create_events()), num_events + 1)
+            self.assertTrue(sg.find_one(tank.path_cache.SHOTGUN_ENTITY, 
+                                        [["id", "is", sg_records["Sequence"]["id"]]], 
+                                        ["is_primary"])["is_primary"])
+            
+            expected = {"missing": 0, "mismatched": 0, "extra": 1, "invalid": 1}
+            self.assertEqual(pc.ensure_all_entries_are_in_shotgun(log, dry_run=True), expected)
+            
+            # parallel batches return their results in request order
+            sg_ids = [x["id"] for x in sg.find(tank.path_cache.SHOTGUN_ENTITY, [])]
+            requests = [ {"request_type": "update", 
+                          "entity_type": tank.path_cache.SHOTGUN_ENTITY, 
+                          "entity_id": sg_id, 
+                          "data": {"is_primary": True}} for sg_id in sg_ids ]
+            (response, error) = pc._execute_sg_batches(requests, log, num_threads=3)
+            self.assertEqual(error, None)
+            self.assertEqual([x["id"] for x in response], sg_ids)
+        finally:
+            pc.close()
+            tank.path_cache.SG_PAGE_SIZE = page_size
+            tank.path_cache.SG_BATCH_SIZE = batch_size
+
+    def test_reconcile_announces_updates(self):
+        """Test that primary flag updates pushed to Shotgun reach other path caches."""
+        
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)
+        pc = tank.path_cache.PathCache(self.tk)
+        pcl = pc._get_path_cache_location()
+        
+        # another path cache, synchronized at this point
+        shutil.copy(pcl, "%s.snap1" % pcl)
+        
+        pc._connection.execute("UPDATE path_cache SET primary_entity = 0 WHERE entity_type = 'Sequence'")
+        pc._connection.commit()
+        try:
+            log = logging.getLogger("test_reconcile")
+            expected = {"missing": 0, "mismatched": 1, "extra": 0, "invalid": 0}
+            self.assertEqual(pc.ensure_all_entries_are_in_shotgun(log), expected)
+        finally:
+            pc.close()
+        
+        sg_record = self.tk.shotgun.find_one(tank.path_cache.SHOTGUN_ENTITY, 
+                                             [["linked_entity_type", "is", "Sequence"]])
+        # a single update event is written, so that cores which don't know
+        # about updates don't see a deletion and fall back onto a full sync
+        update_events = self.tk.shotgun.find("EventLogEntry", 
+                                             [["event_type", "is", "Toolkit_Folders_Update"]], 
+                                             ["meta"])
+        self.assertEqual([x["meta"]["sg_folder_ids"] for x in update_events], [[sg_record["id"]]])
+        self.assertEqual(self.tk.shotgun.find("EventLogEntry", [["event_type", "is", "Toolkit_Folders_Delete"]]), [])
+        
+        num_full_syncs = []
+        full_sync = tank.path_cache.PathCache._do_full_sync
+        def _do_full_sync(*args, **kwargs):
+            num_full_syncs.append(1)
+            return full_sync(*args, **kwargs)
+        
+        # the other path cache picks up the change incrementally
+        shutil.copy("%s.snap1" % pcl, pcl)
+        tank.path_cache.PathCache._do_full_sync = _do_full_sync
+        try:
+            sync_path_cache(self.tk)
+        finally:
+            tank.path_cache.PathCache._do_full_sync = full_sync
+        self.assertEqual(num_full_syncs, [])
+        
+        pc = tank.path_cache.PathCache(self.tk)
+        try:
+            res = pc._connection.execute("SELECT primary_entity FROM path_cache "
+                                         "WHERE entity_type = 'Sequence'").fetchall()
+        finally:
+            pc.close()
+        self.assertEqual(res, [(0,)])
+        self.assertEqual(len(self._get_path_cache()), 4)
+
+    def test_lookup_cache(self):
+        """Test the in-memory lookup cache and its invalidation."""
+        
+        tank.path_cache.set_lookup_cache_size(10)
+        try:
+            folder.process_filesystem_structure(self.tk, 
+                                                self.seq["type"], 
+                                                self.seq["id"], 
+                                                preview=False,
+                                                engine=None)
+            
+            seq_path = os.path.join(self.project_root, "sequences", "seq_code")
+            seq_entity = {"type": "Sequence", "id": self.seq["id"], "name": "seq_code"}
+            
+            pc = tank.path_cache.PathCache(self.tk)
+            self.assertEqual(pc.get_entity(seq_path), seq_entity)
+            # returned values are copies
+            pc.get_entity(seq_path)["id"] = 1234
+            self.assertEqual(pc.get_entity(seq_path), seq_entity)
+            self.assertEqual(pc.get_paths("Sequence", self.seq["id"], False), [seq_path])
+            self.assertEqual(pc.get_paths("Sequence", self.seq["id"], False), [seq_path])
+            stats = pc.get_lookup_cache_stats()
+            self.assertEqual((stats["hits"], stats["misses"]), (3, 2))
+            # bulk lookups share the cached data
+            self.assertEqual(pc.get_paths_many([("Sequence", self.seq["id"])], False), 
+                             {("Sequence", self.seq["id"]): [seq_path]})
+            self.assertEqual(pc.get_lookup_cache_stats()["hits"], 4)
+            pc.close()
+            
+            # lookups are shared by all instances for the same path cache file
+            pc = tank.path_cache.PathCache(self.tk)
+            self.assertEqual(pc.get_entity(seq_path), seq_entity)
+            self.assertEqual(pc.get_lookup_cache_stats()["hits"], 5)
+            
+            # folder creation in this process clears the data
+            folder.process_filesystem_structure(self.tk, 
+                                                self.task["type"], 
+                                                self.task["id"], 
+                                                preview=False,
+                                                engine=None)
+            self.assertEqual(pc.get_lookup_cache_stats()["size"], 0)
+            self.assertEqual(len(pc.get_paths("Shot", self.shot["id"], False)), 1)
+            pc.close()
+            
+            # changes made by another process are detected via the event log marker
+            conn = sqlite3.connect(pc._path_cache_file)
+            conn.execute("DELETE FROM path_cache WHERE entity_type = 'Shot'")
+            conn.execute("UPDATE event_log_sync SET last_id = last_id + 1")
+            conn.commit()
+            conn.close()
+            
+            pc = tank.path_cache.PathCache(self.tk)
+            self.assertEqual(pc.get_paths("Shot", self.shot["id"], False), [])
+            
+            # the cache is size limited
+            for x in range(20):
+                pc.get_entity(os.path.join(self.project_root, "sequences", "seq_%s" % x))
+            stats = pc.get_lookup_cache_stats()
+            self.assertTrue(stats["size"] <= 10)
+            self.assertTrue(stats["evictions"] > 0)
+            pc.close()
+            
+            # turning it off
+            tank.path_cache.set_lookup_cache_size(0)
+            pc = tank.path_cache.PathCache(self.tk)
+            self.assertEqual(pc.get_lookup_cache_stats(), None)
+            self.assertEqual(pc.get_entity(seq_path), seq_entity)
+            pc.close()
+            
+        finally:
+            tank.path_cache.set_lookup_cache_size(0)
+
+    def _get_event_log_marker(self):
+        path_cache = tank.path_cache.PathCache(self.tk)
+        c = path_cache._connection.cursor()
+        marker = c.execute("select max(last_id) from event_log_sync").fetchone()[0]
+        c.close()
+        path_cache.close()
+        return marker
+
+    def test_sync_agent(self):
+        """Test that a folder sync agent keeps the path cache up to date for other processes."""
+        
+        path_cache = tank.path_cache.PathCache(self.tk)
+        pcl = path_cache._get_path_cache_location()
+        path_cache.close()
+        
+        # make a copy of the path cache before any folders are created.
+        # This represents a farm node which has not yet seen the folders.
+        shutil.copy(pcl, "%s.snap1" % pcl)
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)
+        path_cache_contents = sorted(self._get_path_cache())
+        shutil.copy("%s.snap1" % pcl, pcl)
+        
+        # a single poll of the agent brings the path cache up to date
+        action = FolderSyncAgentAction()
+        action.tk = self.tk
+        action.run_noninteractive(logging.getLogger("test_sync_agent"), {"interval": 0.1, "max_iterations": 1})
+        self.assertEqual(sorted(self._get_path_cache()), path_cache_contents)
         
+        # and its heartbeat is removed when it exits
+        path_cache = tank.path_cache.PathCache(self.tk)
+        c = path_cache._connection.cursor()
+        self.assertEqual(list(c.execute("select * from sync_agent")), [])
+        self.assertEqual(path_cache._get_sync_agent(c), None)
+        c.close()
+        
+        # while an agent is active, other processes skip their sync
+        path_cache.sync_agent_poll(None, 60.0)
+        
+        def _sync_not_expected(*args, **kwargs):
+            raise Exception("Unexpected sync!")
+        
+        sync_fn = tank.path_cache.PathCache._do_sync
+        tank.path_cache.PathCache._do_sync = _sync_not_expected
+        try:
+            sync_path_cache(self.tk)
+            # full syncs are always carried out
+            self.assertRaises(Exception, sync_path_cache, self.tk, True)
+            # and so are syncs before folders are created, since the agent may
+            # not have seen the folders created elsewhere since its last poll
+            self.assertRaises(Exception, folder.process_filesystem_structure, self.tk, 
+                              self.task["type"], self.task["id"], preview=False, engine=None)
+            
+            # an agent which has stopped polling is ignored
+            path_cache._connection.execute("UPDATE sync_agent SET last_poll = last_poll - 1000")
+            path_cache._connection.commit()
+            self.assertRaises(Exception, sync_path_cache, self.tk)
+        finally:
+            tank.path_cache.PathCache._do_sync = sync_fn
+        
+        # folders created while the agent is active do not move the
+        # event log marker forward - the agent will pick up the event
+        path_cache.sync_agent_poll(None, 60.0)
+        marker = self._get_event_log_marker()
+        
+        seq2 = {"type": "Sequence", "id": 5, "code": "seq2_code", "project": self.project}
+        self.add_to_sg_mock_db([seq2])
+        folder.process_filesystem_structure(self.tk, 
+                                            seq2["type"], 
+                                            seq2["id"], 
+                                            preview=False,
+                                            engine=None)
+        self.assertEqual(len(self._get_path_cache()), len(path_cache_contents) + 1)
+        self.assertEqual(self._get_event_log_marker(), marker)
+        
+        path_cache.sync_agent_poll(None, 60.0)
+        self.assertTrue(self._get_event_log_marker() > marker)
+        self.assertEqual(len(self._get_path_cache()), len(path_cache_contents) + 1)
+        
+        path_cache.sync_agent_stop()
+        path_cache.close()
+
+    def test_snapshot(self):
+        """Test that a path cache can be bootstrapped from a snapshot."""
+        
+        log = logging.getLogger("test_snapshot")
+        snapshot_file = os.path.join(self.tank_temp, "folders.snapshot")
+        
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)
+        
+        action = ExportFoldersAction()
+        action.tk = self.tk
+        action.run_noninteractive(log, {"path": snapshot_file})
+        
+        # records are stored sorted by path
+        fh = gzip.GzipFile(snapshot_file, "rb")
+        lines = fh.readlines()
+        fh.close()
+        header = tank.path_cache.json.loads(lines[0])
+        self.assertEqual(header["version"], tank.path_cache.SNAPSHOT_VERSION)
+        self.assertEqual(header["event_log_id"], self._get_event_log_marker())
+        records = [tank.path_cache.json.loads(x) for x in lines[1:]]
+        self.assertEqual(len(records), 4)
+        self.assertEqual(records, sorted(records))
+        
+        # more folders are created after the snapshot was taken
+        seq2 = {"type": "Sequence", "id": 5, "code": "seq2_code", "project": self.project}
+        self.add_to_sg_mock_db([seq2])
+        folder.process_filesystem_structure(self.tk, 
+                                            seq2["type"], 
+                                            seq2["id"], 
+                                            preview=False,
+                                            engine=None)
+        path_cache_contents = sorted(self._get_path_cache())
+        
+        # now start from scratch on a new machine
+        pc = tank.path_cache.PathCache(self.tk)
+        pcl = pc._get_path_cache_location()
+        pc.close()
+        os.remove(pcl)
+        
+        def _full_sync_not_expected(*args, **kwargs):
+            raise Exception("Unexpected full sync!")
+        
+        # a snapshot import by another process is in progress
+        other_import = "%s.import" % pcl
+        fh = open(other_import, "wb")
+        fh.write("in progress")
+        fh.close()
+        
+        full_sync_fn = tank.path_cache.PathCache._do_full_sync
+        tank.path_cache.PathCache._do_full_sync = _full_sync_not_expected
+        try:
+            action = ImportFoldersAction()
+            action.tk = self.tk
+            action.run_noninteractive(log, {"path": snapshot_file})
+        finally:
+            tank.path_cache.PathCache._do_full_sync = full_sync_fn
+        
+        self.assertEqual(sorted(self._get_path_cache()), path_cache_contents)
+        pc = tank.path_cache.PathCache(self.tk)
+        c = pc._connection.cursor()
+        self.assertEqual(len(list(c.execute("select * from shotgun_status"))), 5)
+        c.close()
+        
+        # a snapshot from a newer version of toolkit is rejected
+        lines[0] = "%s\n" % tank.path_cache.json.dumps(dict(header, version=tank.path_cache.SNAPSHOT_VERSION + 1))
+        fh = gzip.GzipFile(snapshot_file, "wb")
+        fh.writelines(lines)
+        fh.close()
+        self.assertRaises(TankError, pc.import_snapshot, snapshot_file)
+        
+        # and a corrupt snapshot leaves the path cache untouched
+        lines[0] = "%s\n" % tank.path_cache.json.dumps(header)
+        lines[-1] = "[1, 2"
+        fh = gzip.GzipFile(snapshot_file, "wb")
+        fh.writelines(lines)
+        fh.close()
+        self.assertRaises(TankError, pc.import_snapshot, snapshot_file)
+        pc.close()
+        self.assertEqual(sorted(self._get_path_cache()), path_cache_contents)
+        
+        # only the shadow dbs created by this process have been removed
+        self.assertEqual(glob.glob("%s.*import" % pcl), [other_import])
+        fh = open(other_import, "rb")
+        self.assertEqual(fh.read(), "in progress")
+        fh.close()
+
+    @patch("__builtin__.raw_input")
+    def test_unregister(self, raw_input):
+        """Test that folder deletions are synced incrementally."""
+        
+        raw_input.return_value = "y"
+        
+        path_cache = tank.path_cache.PathCache(self.tk)
+        pcl = path_cache._get_path_cache_location()
+        path_cache.close()
+        
+        folder.process_filesystem_structure(self.tk, 
+                                            self.task["type"], 
+                                            self.task["id"], 
+                                            preview=False,
+                                            engine=None)        
+        
+        # now have project / seq / shot / step 
+        self.assertEqual(len(self.tk.shotgun.find(tank.path_cache.SHOTGUN_ENTITY, [])), 4)
+        self.assertEqual( len(self._get_path_cache()), 4)
+        
+        # make a copy of the path cache at this point. This represents
+        # another machine which has not yet seen the deletion.
+        shutil.copy(pcl, "%s.snap1" % pcl) 
+        
+        # now unregister the shot and the folders below it
+        action = UnregisterFoldersAction()
+        action.tk = self.tk
+        action.context = self.tk.context_from_entity(self.shot["type"], self.shot["id"])
+        action.run_interactive(logging.getLogger("test_unregister"), [])
+        
+        # shot and step entries should be gone, both in shotgun and locally
+        self.assertEqual(len(self.tk.shotgun.find(tank.path_cache.SHOTGUN_ENTITY, [])), 2)
+        self.assertEqual( len(self._get_path_cache()), 2)
+        path_cache_contents_1 = self._get_path_cache()
+        
+        # now replace our path cache with snap1 and sync. The deletion 
+        # should be applied incrementally.
+        shutil.copy("%s.snap1" % pcl, pcl)
+        self.assertEqual( len(self._get_path_cache()), 4)
+        
+        def _full_sync_not_expected(*args, **kwargs):
+            raise Exception("Unexpected full sync!")
+        
+        full_sync_fn = tank.path_cache.PathCache._do_full_sync
+        tank.path_cache.PathCache._do_full_sync = _full_sync_not_expected
+        try:
+            sync_path_cache(self.tk)
+        finally:
+            tank.path_cache.PathCache._do_full_sync = full_sync_fn
+        
+        self.assertEqual( len(self._get_path_cache()), 2)
+        self.assertEqual( self._get_path_cache(), path_cache_contents_1)
+        
+        # shotgun_status entries for the removed records should be gone too
+        path_cache = tank.path_cache.PathCache(self.tk)
+        c = path_cache._connection.cursor()
+        self.assertEqual( len(list(c.execute("select * from shotgun_status"))), 2)
+        c.close()
+        path_cache.close()
         
+        # lastly, a full sync should produce the same result
+        sync_path_cache(self.tk, force_full_sync=True)
+        self.assertEqual( self._get_path_cache(), path_cache_contents_1)